@@ -5,10 +5,41 @@ from mesa import Agent
 from shapely.geometry import Point
 from shapely import contains_xy
 from collections import Counter
+from operator import attrgetter
 
 
 # Import functions from functions.py
-from functions import generate_random_location_within_map_domain, get_flood_depth, calculate_basic_flood_damage, floodplain_multipolygon, calculate_subsidies_received
+from functions import generate_random_location_within_map_domain, get_flood_depth, calculate_subsidies_received
+
+# Order of the categorical codes that the households store instead of strings
+INCOME_LABELS = ('Poor', 'Middle-Class', 'Rich')
+MEASURES = ('None', 'Sandbags', 'Drains', 'Heightening')  # code 0 means no measure has been chosen
+INCOME_LABEL_CODES = {label: code for code, label in enumerate(INCOME_LABELS)}
+MEASURE_CODES = {measure: code for code, measure in enumerate(MEASURES)}
+
+# The adaptation measures of the households as ((depth, cost per m2) per measure), one shared tuple per combination
+_shared_adaptation_measures = {}
+
+
+def _household_attribute(name, metric=None, adaptation_input=False):
+    """
+    Attribute stored in a private slot. Setting an attribute that is summed in the totals per income label of the
+    model (metric, see aggregation.METRICS) adds the change to the totals, setting an attribute that the adaptation
+    choices depend on (adaptation_input) clears the memoized choices.
+    """
+    private_name = '_' + name
+
+    def set_value(self, value):
+        if metric is not None:
+            # The totals are counted once all households have been created
+            totals = getattr(self.model, 'income_label_totals', None)
+            if totals is not None:
+                totals.replace(self.income_label, metric, getattr(self, private_name), value)
+        setattr(self, private_name, value)
+        if adaptation_input:
+            self._adaptation_choices = None
+
+    return property(attrgetter(private_name), set_value)
 
 
 # Define the Households agent class
@@ -19,50 +50,141 @@ class Households(Agent):
     In a real scenario, this would be based on actual geographical data or more complex logic.
     """
 
-    def __init__(self, unique_id, model):
+    # The attributes are stored in slots instead of a dictionary per household. The location is stored as the floats
+    # x and y, the income label and the measure as codes, and the adaptation measures as a tuple that is shared by
+    # all households with the same measures; the public attributes (location, income_label, optimal_measure,
+    # adaptation_measures, network) are created from them when they are read
+    __slots__ = ('unique_id', 'model', 'pos', '_is_adapted', 'going_to_adapt', '_income_label', '_income', 'savings',
+                 '_housesize', 'adaptation_depth', '_cost_of_adaptation', '_subsidies_received', '_optimal_measure',
+                 'adaptation_step', 'x', 'y', 'in_floodplain', '_flood_depth_estimated', '_flood_damage_estimated',
+                 'flood_depth_actual', '_flood_damage_actual', 'own_flood_perception', 'network_flood_perception',
+                 '_adaptation_measures', '_adaptation_choices')
+
+    # The attributes that the margins and costs of the adaptation measures depend on, see adaptation_choices.
+    # The adaptation measures are changed by assigning a new dictionary
+    housesize = _household_attribute('housesize', adaptation_input=True)
+    flood_depth_estimated = _household_attribute('flood_depth_estimated', adaptation_input=True)
+    flood_damage_estimated = _household_attribute('flood_damage_estimated', 'damage_estimated', adaptation_input=True)
+    # The other attributes that are summed in the totals per income label of the model
+    is_adapted = _household_attribute('is_adapted', 'adapted')
+    income = _household_attribute('income', 'income')
+    cost_of_adaptation = _household_attribute('cost_of_adaptation', 'cost_of_adaptation')
+    subsidies_received = _household_attribute('subsidies_received', 'subsidies_received')
+    flood_damage_actual = _household_attribute('flood_damage_actual', 'damage_actual')
+
+    @property
+    def adaptation_measures(self):
+        """The measures available to this household as {measure: [depth reduction, cost per m2]}"""
+        return {measure: list(values) for measure, values in zip(MEASURES[1:], self._adaptation_measures)}
+
+    @adaptation_measures.setter
+    def adaptation_measures(self, adaptation_measures):
+        values = tuple(tuple(adaptation_measures[measure]) for measure in MEASURES[1:])
+        self._adaptation_measures = _shared_adaptation_measures.setdefault(values, values)
+        self._adaptation_choices = None
+
+    def adaptation_measure(self, measure):
+        """The (depth reduction, cost per m2) of a measure, without creating the adaptation_measures dictionary"""
+        return self._adaptation_measures[MEASURE_CODES[measure] - 1]
+
+    @property
+    def location(self):
+        """Location as a shapely Point, created on demand"""
+        return Point(self.x, self.y)
+
+    @location.setter
+    def location(self, location):
+        if isinstance(location, Point):
+            location = location.x, location.y
+        self.x, self.y = float(location[0]), float(location[1])
+
+    @property
+    def income_label(self):
+        return INCOME_LABELS[self._income_label]
+
+    @income_label.setter
+    def income_label(self, income_label):
+        totals = getattr(self.model, 'income_label_totals', None)
+        if totals is not None:
+            totals.relabel(self, income_label)
+        self._income_label = INCOME_LABEL_CODES[income_label]
+
+    @property
+    def optimal_measure(self):
+        """Chosen measure, with the step of adaptation appended once it is installed (e.g. 'Drains_12')"""
+        if self.is_adapted:
+            return MEASURES[self._optimal_measure] + '_' + str(self.adaptation_step)
+        return MEASURES[self._optimal_measure]
+
+    @optimal_measure.setter
+    def optimal_measure(self, optimal_measure):
+        self._optimal_measure = MEASURE_CODES[optimal_measure.split('_')[0]]
+
+    @property
+    def network(self):
+        """For verification purposes: the own flood perception of every friend as {unique_id: perception}"""
+        all_households = self.model.all_households
+        return {all_households[friend].unique_id: all_households[friend].own_flood_perception
+                for friend in self.model.neighbour_index.friends(self.pos)}
+
+    def __init__(self, unique_id, model, location=None, in_floodplain=None, flood_depth_estimated=None,
+                 income_label=None, income=None, housesize=None, own_flood_perception=None):
+        """The location (x, y), whether it is in the floodplain and the estimated flood depth can be given by the
+        model, which samples them for all households at once. Otherwise the household draws its own location and
+        looks them up itself. The income label, income, house size and initial flood perception can be given when
+        the household is restored from a population snapshot (see snapshot.py), otherwise they are drawn."""
         super().__init__(unique_id, model)
         self.is_adapted = False  # Initial adaptation status set to False
         self.going_to_adapt = False #Flicks to True when a Household decides to adapt and flicks back when the adaptation is completed
-        self.income_label = self.assign_income_label() #Household receives an income label: 'Poor', 'Middle-Class', 'Rich'
-        self.income = self.calculate_income() #Income per step is calculated based on income label
+        if income_label is None:
+            income_label = self.assign_income_label()
+        self.income_label = income_label #Household receives an income label: 'Poor', 'Middle-Class', 'Rich'
+        if income is None:
+            income = self.calculate_income()
+        self.income = income #Income per step is calculated based on income label
         self.savings = 0 #Savings start at 0 for every household, a part of income is saved each step
-        self.housesize = self.assign_housesize() #Based on income label, a household is assigned a certain house size in m2
+        if housesize is None:
+            housesize = self.assign_housesize()
+        self.housesize = housesize #Based on income label, a household is assigned a certain house size in m2
         self.adaptation_depth = 0 #Initial adaptation depth is 0 as Household have no adaptation at initialization
         self.cost_of_adaptation = 0 #Initial cost of adaptation is 0 as Households have no adaptation at initialization
         self.subsidies_received = 0 #Initial subsidies received is 0 when Households have not managed to do adaptation yet
         self.optimal_measure = 'None' #Initial optimal measure is None, is assigned from the first step and can change over time
+        self.adaptation_step = -1 #Step in which the optimal measure is installed, -1 as long as the household has not adapted
         # getting flood map values
         # Get a random location on the map
-        loc_x, loc_y = generate_random_location_within_map_domain(model)
-        self.location = Point(loc_x, loc_y)
-
-        #For verification purposes, the network of the agent is collected in the following variable
-        self.network = {}
+        if location is None:
+            location = generate_random_location_within_map_domain(model)
+        self.location = location
 
         # Check whether the location is within floodplain
-        self.in_floodplain = False
-        if contains_xy(geom=floodplain_multipolygon, x=self.location.x, y=self.location.y):
-            self.in_floodplain = True
+        if in_floodplain is None:
+            in_floodplain = contains_xy(geom=model.geometry.floodplain_multipolygon, x=self.x, y=self.y)
+        self.in_floodplain = bool(in_floodplain)
 
         # Get the estimated flood depth at those coordinates. 
         # the estimated flood depth is calculated based on the flood map (i.e., past data) so this is not the actual flood depth
         # Flood depth can be negative if the location is at a high elevation
-        self.flood_depth_estimated = get_flood_depth(corresponding_map=model.flood_map, location=self.location, band=model.band_flood_img)
+        if flood_depth_estimated is None:
+            flood_depth_estimated = get_flood_depth(corresponding_map=model.flood_map, location=self.location, band=model.band_flood_img)
+        self.flood_depth_estimated = flood_depth_estimated
         # handle negative values of flood depth
         if self.flood_depth_estimated < 0:
             self.flood_depth_estimated = 0
         
         # calculate the estimated flood damage given the estimated flood depth. Flood damage is a factor between 0 and 1
-        self.flood_damage_estimated = calculate_basic_flood_damage(flood_depth=self.flood_depth_estimated, housesize= self.housesize)
+        self.flood_damage_estimated = model.depth_damage.scalar_damage(self.flood_depth_estimated, self.housesize)
 
         # Add an attribute for the actual flood depth. This is set to zero at the beginning of the simulation since there is not flood yet
         # and will update its value when there is a shock (i.e., actual flood). Shock happens at some point during the simulation
         self.flood_depth_actual = 0
         #calculate the actual flood damage given the actual flood depth. Flood damage is a factor between 0 and 1
-        self.flood_damage_actual = calculate_basic_flood_damage(flood_depth=self.flood_depth_actual, housesize = self.housesize)
+        self.flood_damage_actual = model.depth_damage.scalar_damage(self.flood_depth_actual, self.housesize)
 
         # Base the initial flood perception on whether the household is in a floodplain or not
-        self.own_flood_perception = self.initial_own_flood_perception()
+        if own_flood_perception is None:
+            own_flood_perception = self.initial_own_flood_perception()
+        self.own_flood_perception = own_flood_perception
         #The perception within the network is calculated in step 1, so initially set to 0
         self.network_flood_perception = 0
 
@@ -76,7 +198,7 @@ class Households(Agent):
         # Randomly choose a label based on the distribution
         while True:
             # Randomly choose a label based on the distribution
-            rand_num = self.random.uniform(0, 100)
+            rand_num = self.model.random_stream('income_label').uniform(0, 100)
             cumulative_prob = 0
 
             for income_label, prob in income_label_distribution.items():
@@ -93,9 +215,9 @@ class Households(Agent):
             probabilities = [0.15, 0.25, 0.3, 0.3]
 
             # Assign a value based on chance
-            flood_perception = self.random.choices(options, probabilities)[0]
+            flood_perception = self.model.random_stream('perception').choices(options, probabilities)[0]
         else:
-            flood_perception = self.random.randint(1, 4)
+            flood_perception = self.model.random_stream('perception').randint(1, 4)
 
         return flood_perception
     def calculate_income(self):
@@ -105,7 +227,7 @@ class Households(Agent):
         #income_distribution = 'Label': [mean, standard_deviation]
         #Income is per tick which is quarter of a year
         while income <= 0:
-            income = round(self.random.normalvariate(income_distribution[self.income_label][0],
+            income = round(self.model.random_stream('income').normalvariate(income_distribution[self.income_label][0],
                                                 income_distribution[self.income_label][1]))
         return income
 
@@ -114,7 +236,7 @@ class Households(Agent):
         household_size = 0
         average_household_surfaces = self.model.average_household_surfaces
         while household_size < 30:
-            household_size = round(self.random.normalvariate(average_household_surfaces[self.income_label][0],
+            household_size = round(self.model.random_stream('housesize').normalvariate(average_household_surfaces[self.income_label][0],
                                                  average_household_surfaces[self.income_label][1]))
         return household_size
 
@@ -151,17 +273,11 @@ class Households(Agent):
     def calculate_network_flood_perception(self, all_households):
         """This function calculates the flood perception that is most frequently present among the friends of the household
         which will influence their own flood perception via another function"""
-        radius = 1 #Change this variable to a different radius to change the dynamic of choosing friends
-        friends = self.model.grid.get_neighborhood(self.pos, include_center=False, radius=radius)
-
-        #To access the households in the network better, they are appended to a dictionary with their keys and flood perception
-        network = {}
-        for friend in friends:
-            network[all_households[friend].unique_id] = all_households[friend].own_flood_perception
+        #The friends within the network radius of the model are looked up in the precomputed neighbour index
+        friends = self.model.neighbour_index.friends(self.pos)
 
-        self.network = network
-        #This counts the number of values in the network
-        value_counts = Counter(network.values())
+        #This counts the flood perceptions in the network (the network property gives them per friend)
+        value_counts = Counter([all_households[friend].own_flood_perception for friend in friends])
         if len(value_counts) > 0: #If the household has no friends, no error will occur
             most_common_value, count = value_counts.most_common(1)[0] #The most common value is saved a the network flood perception
             self.network_flood_perception = most_common_value
@@ -177,60 +293,56 @@ class Households(Agent):
             self.own_flood_perception = self.network_flood_perception
         return self.own_flood_perception
 
-    def decide_on_optimal_adaptation(self):
-        """This function decides which adaption measure is most optimal for that specific household. This greatly depends on
-         location, income and subsidies package."""
-        if self.is_adapted == True: #If the household has already adapted, it does not need to go through this process again
-            return
+    def adaptation_choices(self):
+        """The measure that the household chooses with every own flood perception (None for no measure), indexed by
+        the perception. The margins and costs of the measures only change with the estimated flood depth, the house
+        size and the adaptation measures, so the choices are calculated again only after one of those has changed."""
+        if self._adaptation_choices is not None:
+            return self._adaptation_choices
 
         #The margins for every adaptation measure are calculated
         #Margins are defined as the damage with initial flood depth minus the damage with adapted flood depth, which effectively
         #shows how much the households could save with that adaptation measure
         margin_of_sandbags = (self.flood_damage_estimated -
-                              calculate_basic_flood_damage((self.flood_depth_estimated-self.adaptation_measures['Sandbags'][0]), self.housesize))
+                              self.model.depth_damage.scalar_damage((self.flood_depth_estimated-self.adaptation_measure('Sandbags')[0]), self.housesize))
 
         margin_of_drains = (self.flood_damage_estimated -
-                              calculate_basic_flood_damage((self.flood_depth_estimated -self.adaptation_measures['Drains'][0]), self.housesize))
+                              self.model.depth_damage.scalar_damage((self.flood_depth_estimated -self.adaptation_measure('Drains')[0]), self.housesize))
 
         margin_of_heightening = (self.flood_damage_estimated -
-                              calculate_basic_flood_damage((self.flood_depth_estimated -self.adaptation_measures['Heightening'][0]), self.housesize))
+                              self.model.depth_damage.scalar_damage((self.flood_depth_estimated -self.adaptation_measure('Heightening')[0]), self.housesize))
 
         #The costs for each adaptation measure are calculated to see if they are greater or smaller than the margin
         #The cost is the cost (which depends on subsidies package received by the household) per m2 multiplied by the housesize
-        costs_for_sandbags = self.adaptation_measures['Sandbags'][1]*self.housesize
-        costs_for_drains = self.adaptation_measures['Drains'][1]*self.housesize
-        costs_for_heightening = self.adaptation_measures['Heightening'][1]*self.housesize
+        costs_for_sandbags = self.adaptation_measure('Sandbags')[1]*self.housesize
+        costs_for_drains = self.adaptation_measure('Drains')[1]*self.housesize
+        costs_for_heightening = self.adaptation_measure('Heightening')[1]*self.housesize
 
         #Depending on the flood perception of the household, it will choose to adapt to floods
         #However, someone with percepts a minor risk to floods shall never heighten their house, therefore is not able to via this code
         #The ones with more risk averse flood perception will only choose a certain adaptation measure if the costs outpay the margin
-        if self.own_flood_perception == 2 and margin_of_sandbags > costs_for_sandbags:
-            self.optimal_measure = 'Sandbags'
-            self.going_to_adapt = True
-
-        if self.own_flood_perception == 3 and margin_of_sandbags > costs_for_sandbags:
-            self.optimal_measure = 'Sandbags'
-            self.going_to_adapt = True
-
-        if self.own_flood_perception == 3 and margin_of_drains > costs_for_drains:
-            self.optimal_measure = 'Drains'
-            self.going_to_adapt = True
-
-        if self.own_flood_perception == 3 and margin_of_heightening > costs_for_heightening:
-            self.optimal_measure = 'Heightening'
-            self.going_to_adapt = True
+        #With perception 3 or 4, a later measure in the order sandbags, drains, heightening overrules an earlier one
+        sandbags = 'Sandbags' if margin_of_sandbags > costs_for_sandbags else None
+        risk_averse_choice = sandbags
+        if margin_of_drains > costs_for_drains:
+            risk_averse_choice = 'Drains'
+        if margin_of_heightening > costs_for_heightening:
+            risk_averse_choice = 'Heightening'
+        self._adaptation_choices = (None, None, sandbags, risk_averse_choice, risk_averse_choice)
+        return self._adaptation_choices
 
-        if self.own_flood_perception == 4 and margin_of_sandbags > costs_for_sandbags:
-            self.optimal_measure = 'Sandbags'
-            self.going_to_adapt = True
+    def decide_on_optimal_adaptation(self):
+        """This function decides which adaption measure is most optimal for that specific household. This greatly depends on
+         location, income and subsidies package."""
+        if self.is_adapted == True: #If the household has already adapted, it does not need to go through this process again
+            return
 
-        if self.own_flood_perception == 4 and margin_of_drains > costs_for_drains:
-            self.optimal_measure = 'Drains'
+        #The measure follows from the own flood perception, without a measure the household keeps its previous choice
+        measure = self.adaptation_choices()[self.own_flood_perception]
+        if measure is not None:
+            self.optimal_measure = measure
             self.going_to_adapt = True
 
-        if self.own_flood_perception == 4 and margin_of_heightening > costs_for_heightening:
-            self.optimal_measure = 'Heightening'
-            self.going_to_adapt = True
     def save_income(self):
         """This function takes the income every step saves it up for the household"""
         #A person with flood_perception 4 saves 10% of their income (do we want to randomize that 10%?)
@@ -239,20 +351,20 @@ class Households(Agent):
 
     def execute_adaptation(self):
         """This function executes the optimal adaptation if the household is able to"""
-        if self.optimal_measure == 'None' or self.is_adapted == True:
+        if self._optimal_measure == 0 or self.is_adapted == True:
             # If the agent has not decided to adapt, this function will end here.
             return
 
         else:
             #If the household has decided to adapt and can their savings are high enough to pay for the adaptation measure
             #The household will adapt to flood accordingly
-            if (self.savings / self.housesize) >= self.adaptation_measures[self.optimal_measure][1] and self.going_to_adapt == True:
+            if (self.savings / self.housesize) >= self.adaptation_measure(self.optimal_measure)[1] and self.going_to_adapt == True:
                 #The given height that is lessened by taking that adaptation measure
-                self.adaptation_depth = self.adaptation_measures[self.optimal_measure][0]
+                self.adaptation_depth = self.adaptation_measure(self.optimal_measure)[0]
                 #Show that the houhsehold has "paid" by substracting the number from savings
-                self.savings -= self.adaptation_measures[self.optimal_measure][1]*self.housesize
+                self.savings -= self.adaptation_measure(self.optimal_measure)[1]*self.housesize
                 #The number that was substracted previously shown as the cost for adaptation
-                self.cost_of_adaptation = self.adaptation_measures[self.optimal_measure][1]*self.housesize
+                self.cost_of_adaptation = self.adaptation_measure(self.optimal_measure)[1]*self.housesize
                 #The difference in what they would originally pay for the measure and have paid to show how much the subsidies cost
                 self.subsidies_received = calculate_subsidies_received(self.optimal_measure, self.cost_of_adaptation, self.housesize)
                 #Change the flood_depth to fully install the flood depth
@@ -261,12 +373,13 @@ class Households(Agent):
                 if self.flood_depth_estimated < 0:
                     self.flood_depth_estimated = 0
                 #Calculate the new estimated flood damage with the adapted flood depth
-                self.flood_damage_estimated = calculate_basic_flood_damage(self.flood_depth_estimated, self.housesize)
+                self.flood_damage_estimated = self.model.depth_damage.scalar_damage(self.flood_depth_estimated, self.housesize)
                 #Switch of that they are going to adapt
                 self.going_to_adapt = False
                 #Save the measure they have installed
                 self.optimal_measure = str(self.optimal_measure) + '_' + str(self.model.schedule.steps)
-                #Show that they have adapted
+                self.adaptation_step = self.model.schedule.steps
+                #Show that they have adapted (the attributes add their changes to the totals of the model)
                 self.is_adapted = True
             return
 
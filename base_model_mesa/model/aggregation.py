@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+"""
+Running totals of the households per income label, for the model reporters.
+
+The model reporters used to scan all households several times each, every step. Instead, the sums and counts per
+income label are counted once when the households have been created and then updated by the households whenever their
+state changes: when they adapt (Households.execute_adaptation and HouseholdArrays.execute_adaptation) and when the
+flood hits (AdaptationModel.step). Reading a reporter then no longer depends on the number of households.
+
+The public household attributes of both engines add their changes to the totals when they are written (see
+agents._household_attribute and vectorized._array_attribute), so code that writes them, e.g. in a notebook, keeps the
+totals up to date as well. Code that changes the arrays of the vectorized engine directly should call
+IncomeLabelTotals.recount afterwards.
+
+Floating point sums that are updated with differences drift away from the sum of the current values over a long run.
+The totals are therefore kept exactly, as integer multiples of 2**-SCALE_BITS: a changed value is subtracted and the
+new value added without rounding, and a total is rounded only when it is read. It is then the correctly rounded sum of
+the current values of the households, the same as math.fsum of them, whatever changes came before.
+
+IncomeLabelTotals.columns gives all totals and averages per income label as flat scalar columns (COLUMNS), with NaN
+for an income label without households. With AdaptationModel(reporter_schema='flat') they are the model reporters,
+instead of the four dictionaries, so batch_run results no longer have to be unpacked with pd.json_normalize.
+"""
+from operator import attrgetter
+
+import numpy as np
+
+from vectorized import INCOME_LABELS
+
+# Every float is an integer multiple of 2**-1074, and np.frexp splits it into a 53 bit integer times a power of 2 of
+# at least 2**-1127, so the totals are integer multiples of 2**-SCALE_BITS
+SCALE_BITS = 1127
+SCALE = 1 << SCALE_BITS
+# The integers of the values are summed in two halves of HALF_BITS bits, which float64 bincounts sum exactly for up
+# to 2**26 values
+HALF_BITS = 26
+# The powers of 2 of the integers relative to 2**-SCALE_BITS are below SHIFTS, as np.frexp gives exponents up to 1024
+SHIFTS = SCALE_BITS - 53 + 1024 + 1
+
+
+def exact_value(value):
+    """A single value as an exact integer multiple of 2**-SCALE_BITS"""
+    numerator, denominator = float(value).as_integer_ratio()
+    return numerator << (SCALE_BITS + 1 - denominator.bit_length())
+
+
+def exact_sums(labels, values):
+    """
+    Exact sums of the values per income label, as integer multiples of 2**-SCALE_BITS.
+
+    Parameters
+    ----------
+    labels: array with the income label code of every value
+    values: array with the values
+
+    Returns
+    -------
+    sums: list with the sum of every income label
+    """
+    mantissa, exponent = np.frexp(np.asarray(values, dtype=float))
+    # values = integers * 2**(shifts - SCALE_BITS)
+    integers = np.ldexp(mantissa, 53).astype(np.int64)
+    shifts = exponent.astype(np.int64) + (SCALE_BITS - 53)
+    high = integers >> HALF_BITS
+    low = integers - (high << HALF_BITS)
+    keys = np.asarray(labels, dtype=np.int64) * SHIFTS + shifts
+    high_sums = np.bincount(keys, weights=high, minlength=len(INCOME_LABELS) * SHIFTS)
+    low_sums = np.bincount(keys, weights=low, minlength=len(INCOME_LABELS) * SHIFTS)
+    sums = [0] * len(INCOME_LABELS)
+    for key in np.flatnonzero(high_sums.astype(bool) | low_sums.astype(bool)).tolist():
+        code, shift = divmod(key, SHIFTS)
+        sums[code] += ((int(high_sums[key]) << HALF_BITS) + int(low_sums[key])) << shift
+    return sums
+
+# The summed quantities, with the household attribute (or array of the vectorized engine) they are summed from
+METRICS = {
+    'households': None,
+    'adapted': 'is_adapted',
+    'damage_actual': 'flood_damage_actual',
+    'damage_estimated': 'flood_damage_estimated',
+    'income': 'income',
+    'cost_of_adaptation': 'cost_of_adaptation',
+    'subsidies_received': 'subsidies_received',
+}
+
+# How the income labels are written in the column names, e.g. 'AverageDamagePerMiddleClassHousehold'
+COLUMN_LABELS = ('Poor', 'MiddleClass', 'Rich')
+
+# The flat columns of the model reporters: {name: (summed metric, metric it is divided by, income label code)}
+# Totals are summed over all income labels, averages are divided by the number of households of the income label
+TOTAL_COLUMNS = {
+    'TotalAdaptedHouseholds': 'adapted',
+    'TotalActualDamage': 'damage_actual',
+    'TotalExpectedDamage': 'damage_estimated',
+    'TotalAdaptationCosts': 'cost_of_adaptation',
+    'TotalCostsOfSubsidies': 'subsidies_received',
+}
+PER_INCOME_LABEL_COLUMNS = {
+    'AverageDamagePer{}Household': ('damage_actual', 'households'),
+    'EstimatedAverageDamagePer{}Household': ('damage_estimated', 'households'),
+    'AverageIncomeToDamage{}Household': ('damage_actual', 'income'),
+    'EstimatedAverageIncomeToDamage{}Household': ('damage_estimated', 'income'),
+}
+COLUMNS = {name: (metric, None, None) for name, metric in TOTAL_COLUMNS.items()}
+COLUMNS.update({name.format(label): (metric, per_metric, code)
+                for name, (metric, per_metric) in PER_INCOME_LABEL_COLUMNS.items()
+                for code, label in enumerate(COLUMN_LABELS)})
+
+
+class IncomeLabelTotals:
+    """
+    Sums and counts of the households per income label, kept up to date as the households change.
+
+    Attributes
+    ----------
+    sums: {metric: list with the exact sum of every income label, as integer multiples of 2**-SCALE_BITS}
+    """
+
+    def __init__(self):
+        self.sums = {metric: [0] * len(INCOME_LABELS) for metric in METRICS}
+        self.codes = {label: code for code, label in enumerate(INCOME_LABELS)}
+
+    @property
+    def totals(self):
+        """The sums as {metric: array with the sum of every income label}, correctly rounded"""
+        return {metric: np.array([total / SCALE for total in sums]) for metric, sums in self.sums.items()}
+
+    @classmethod
+    def from_model(cls, model):
+        """Count the totals of all households of a model"""
+        totals = cls()
+        totals.recount(model)
+        return totals
+
+    def recount(self, model):
+        """Count all totals again, in one pass over the households"""
+        attributes = {metric: attribute for metric, attribute in METRICS.items() if attribute}
+        households = getattr(model, 'households', None)
+        if households is not None:
+            # The vectorized engine already stores every attribute as an array
+            labels = households.income_label
+            values = {metric: getattr(households, attribute) for metric, attribute in attributes.items()}
+        else:
+            getters = [attrgetter(attribute) for attribute in attributes.values()]
+            rows = np.array([(self.codes[agent.income_label], *(get_value(agent) for get_value in getters))
+                             for agent in model.schedule.agents], dtype=float).reshape(-1, len(attributes) + 1)
+            labels = rows[:, 0].astype(np.int64)
+            values = {metric: rows[:, column] for column, metric in enumerate(attributes, start=1)}
+        self.sums['households'] = exact_sums(labels, np.ones(len(labels)))
+        for metric, value in values.items():
+            self.sums[metric] = exact_sums(labels, value)
+
+    def add(self, income_label, **values):
+        """Add values to the totals of a single income label, e.g. add('Poor', adapted=1)"""
+        code = self.codes[income_label]
+        for metric, value in values.items():
+            self.sums[metric][code] += exact_value(value)
+
+    def replace(self, income_label, metric, old_value, new_value):
+        """Replace the value of a metric of a single household"""
+        code = self.codes[income_label]
+        self.sums[metric][code] += exact_value(new_value) - exact_value(old_value)
+
+    def relabel(self, household, income_label):
+        """Move all metrics of a household to another income label, before its income label is changed"""
+        values = {metric: float(getattr(household, attribute)) for metric, attribute in METRICS.items() if attribute}
+        self.add(household.income_label, households=-1, **{metric: -value for metric, value in values.items()})
+        self.add(income_label, households=1, **values)
+
+    def add_arrays(self, income_labels, **values):
+        """Add the values of many households, given with the arrays of their income label codes"""
+        for metric, value in values.items():
+            for code, total in enumerate(exact_sums(income_labels, value)):
+                self.sums[metric][code] += total
+
+    def replace_arrays(self, income_labels, metric, old_values, new_values):
+        """Replace the values of a metric of many households, given with the arrays of their income label codes"""
+        for code, (old, new) in enumerate(zip(exact_sums(income_labels, old_values),
+                                              exact_sums(income_labels, new_values))):
+            self.sums[metric][code] += new - old
+
+    def total(self, metric):
+        """Sum of a metric over all households"""
+        return sum(self.sums[metric]) / SCALE
+
+    def label_total(self, metric, code):
+        """Sum of a metric over the households of the income label with the given code"""
+        return self.sums[metric][code] / SCALE
+
+    def number_of_households(self, income_label):
+        return self.sums['households'][self.codes[income_label]] >> SCALE_BITS
+
+    def column(self, name):
+        """
+        The value of a single flat column, see COLUMNS.
+
+        Returns
+        -------
+        value: the total over all households (an integer for the number of adapted households), or the value for one
+        income label, NaN when the income label has no households
+        """
+        metric, per_metric, code = COLUMNS[name]
+        if code is None:
+            total = self.total(metric)
+            return int(round(total)) if metric == 'adapted' else total
+        if self.sums['households'][code] == 0:
+            return np.nan
+        # The average per household of the metric, divided by the average of per_metric, i.e. the ratio of their sums
+        return float(np.float64(self.label_total(metric, code)) / self.label_total(per_metric, code))
+
+    def columns(self):
+        """All model reporters of the totals as flat scalar columns: {column name: value}"""
+        return {name: self.column(name) for name in COLUMNS}
@@ -0,0 +1,303 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of the Flood Adaptation Model, to see whether a change made the model faster or slower.
+
+For every combination of population size, network type and subsidies package, the benchmark measures:
+- construction: seconds to create the AdaptationModel
+- step: median seconds of an AdaptationModel.step before the flood (including its data collection)
+- collect: median seconds of one datacollector.collect
+- model_run: seconds of a full model_run of a second model, and the number of steps it ran
+- peak_rss_mb: peak resident memory of the process that ran the case, and baseline_rss_mb after the imports
+
+Every case runs in a fresh process, so the peak memory belongs to that case and one case cannot warm up the next.
+The benchmark uses a small synthetic flood map, model domain and floodplain (input_data/synthetic), so it runs
+without the real GeoTIFFs and shapefiles. They are generated with write_synthetic_inputs when they are missing.
+
+The results are written as JSON, together with the code version (see result_cache.code_version), the git commit and
+the machine, and can be compared with the results of another commit:
+
+    python benchmark.py --output ../output_data/benchmark.json
+    python benchmark.py --sizes 1000 10000 --networks watts_strogatz --packages 0 --output new.json --compare old.json
+    python benchmark.py --quick
+
+The full grid (3 sizes, 5 networks and 4 packages) takes long with the agents engine and the networkx backend, since
+networkx generates the Erdos-Renyi network of 100k households in O(n^2) time; --network-backend native avoids that.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+from result_cache import canonical, code_version
+
+# Increase when the layout of the results changes
+BENCHMARK_VERSION = 1
+
+SIZES = (1000, 10000, 100000)
+NETWORKS = ('erdos_renyi', 'barabasi_albert', 'watts_strogatz', 'spatial', 'no_network')
+PACKAGES = (0, 1, 2, 3)
+TIMINGS = ('construction', 'step', 'collect', 'model_run')
+
+MODEL_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+SYNTHETIC_DIRECTORY = os.path.join(MODEL_DIRECTORY, '..', 'input_data', 'synthetic')
+SYNTHETIC_FLOOD_MAP = os.path.join(SYNTHETIC_DIRECTORY, 'synthetic_depth_meters.tif')
+SYNTHETIC_DOMAIN = os.path.join(SYNTHETIC_DIRECTORY, 'synthetic_domain.shp')
+SYNTHETIC_FLOODPLAIN = os.path.join(SYNTHETIC_DIRECTORY, 'synthetic_floodplain.shp')
+SYNTHETIC_EPSG = 26915
+
+# Centre (m) of the synthetic model domain in EPSG:26915, near Houston like the real domain, and its size
+SYNTHETIC_CENTRE = (275000, 3300000)
+SYNTHETIC_RADIUS = 15000
+SYNTHETIC_CELL_SIZE = 200
+
+
+def synthetic_river(t):
+    """Points (x, y) of the synthetic river for parameters t between -1 and 1, which meanders through the domain"""
+    x = SYNTHETIC_CENTRE[0] + t * 1.2 * SYNTHETIC_RADIUS
+    y = SYNTHETIC_CENTRE[1] + 0.25 * SYNTHETIC_RADIUS * np.sin(3 * t)
+    return x, y
+
+
+def write_synthetic_inputs(directory=SYNTHETIC_DIRECTORY):
+    """
+    Write the synthetic flood map (GeoTIFF), model domain and floodplain (shapefiles) to a directory. The domain is an
+    irregular polygon, the floodplain a corridor along a meandering river, and the flood depth is deepest along the
+    river, with negative depths (higher ground) far from it. The inputs only depend on this code.
+    """
+    import geopandas as gpd
+    import rasterio as rs
+    from rasterio.transform import from_origin
+    from shapely.geometry import LineString, MultiPolygon, Polygon
+
+    os.makedirs(directory, exist_ok=True)
+    centre_x, centre_y = SYNTHETIC_CENTRE
+    angles = np.linspace(0, 2 * np.pi, 48, endpoint=False)
+    radii = SYNTHETIC_RADIUS * (1 + 0.15 * np.sin(3 * angles) + 0.08 * np.cos(5 * angles))
+    domain = Polygon(np.column_stack([centre_x + radii * np.cos(angles), centre_y + radii * np.sin(angles)]))
+    river = LineString(np.column_stack(synthetic_river(np.linspace(-1, 1, 200))))
+    floodplain = river.buffer(1500).intersection(domain)
+    if not isinstance(floodplain, MultiPolygon):
+        floodplain = MultiPolygon([floodplain])
+    for path, shape in ((os.path.join(directory, 'synthetic_domain.shp'), domain),
+                        (os.path.join(directory, 'synthetic_floodplain.shp'), floodplain)):
+        gpd.GeoDataFrame(geometry=[shape], crs=f'EPSG:{SYNTHETIC_EPSG}').to_file(path)
+
+    # The raster covers the bounding box of the domain with a margin of one cell
+    minx, miny, maxx, maxy = domain.bounds
+    left, top = minx - SYNTHETIC_CELL_SIZE, maxy + SYNTHETIC_CELL_SIZE
+    width = int(np.ceil((maxx - minx) / SYNTHETIC_CELL_SIZE)) + 2
+    height = int(np.ceil((maxy - miny) / SYNTHETIC_CELL_SIZE)) + 2
+    x = left + (np.arange(width) + 0.5) * SYNTHETIC_CELL_SIZE
+    y = top - (np.arange(height) + 0.5) * SYNTHETIC_CELL_SIZE
+    grid_x, grid_y = np.meshgrid(x, y)
+    river_x, river_y = synthetic_river(np.linspace(-1, 1, 400))
+    distance = np.full(grid_x.shape, np.inf)
+    for point_x, point_y in zip(river_x, river_y):
+        distance = np.minimum(distance, np.hypot(grid_x - point_x, grid_y - point_y))
+    depth = 3.5 * np.exp(-(distance / 2500) ** 2) + 0.4 * np.sin(grid_x / 1700) * np.cos(grid_y / 2300) - 0.3
+    profile = {'driver': 'GTiff', 'height': height, 'width': width, 'count': 1, 'dtype': 'float32',
+               'crs': f'EPSG:{SYNTHETIC_EPSG}', 'transform': from_origin(left, top, SYNTHETIC_CELL_SIZE,
+                                                                         SYNTHETIC_CELL_SIZE),
+               'compress': 'deflate', 'predictor': 3}
+    with rs.open(os.path.join(directory, 'synthetic_depth_meters.tif'), 'w', **profile) as flood_map:
+        flood_map.write(np.round(depth, 3).astype(np.float32), 1)
+
+
+def use_synthetic_inputs():
+    """
+    Write the synthetic inputs when they are missing and return the GeometryRegistry of the synthetic model domain and
+    floodplain, so they can be loaded before a model is timed. Models with flood_map_choice='synthetic' use the same
+    loaded geometries.
+    """
+    from model import flood_map_geometry
+    if not all(os.path.exists(path) for path in (SYNTHETIC_FLOOD_MAP, SYNTHETIC_DOMAIN, SYNTHETIC_FLOODPLAIN)):
+        write_synthetic_inputs()
+    return flood_map_geometry('synthetic')
+
+
+def peak_rss_mb():
+    """Peak resident memory of this process in MB"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10
+
+
+def current_rss_mb():
+    """Current resident memory of this process in MB, or the peak where /proc is not available"""
+    try:
+        with open('/proc/self/statm') as file:
+            return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except OSError:
+        return peak_rss_mb()
+
+
+def run_case(case, step_repeats=5, collect_repeats=5):
+    """
+    Benchmark one case in this process.
+
+    Parameters
+    ----------
+    case: dictionary of AdaptationModel parameters
+    step_repeats: number of steps that are timed, fewer when the flood comes earlier
+    collect_repeats: number of data collections that are timed
+
+    Returns
+    -------
+    result: dictionary with the case, the TIMINGS in seconds, the number of steps of model_run and the memory
+    """
+    # The model is imported here, so the baseline memory includes the imports but no model
+    os.chdir(MODEL_DIRECTORY)
+    geometry = use_synthetic_inputs()
+    from model import AdaptationModel
+    # Load the inputs before the timing, as the experiment runner does once for all runs
+    geometry.map_domain_polygon, geometry.floodplain_multipolygon
+    baseline_rss = current_rss_mb()
+
+    start = time.perf_counter()
+    model = AdaptationModel(**case)
+    construction = time.perf_counter() - start
+
+    step_times = []
+    # The step of the flood stops the model, it is not a regular step
+    while len(step_times) < step_repeats and model.schedule.steps + 1 < model.flood_step:
+        start = time.perf_counter()
+        model.step()
+        step_times.append(time.perf_counter() - start)
+
+    collect_times = []
+    for _ in range(collect_repeats):
+        start = time.perf_counter()
+        model.datacollector.collect(model)
+        collect_times.append(time.perf_counter() - start)
+    del model
+
+    model = AdaptationModel(**case)
+    start = time.perf_counter()
+    model.model_run()
+    model_run = time.perf_counter() - start
+
+    return {'case': case, 'construction': construction,
+            'step': statistics.median(step_times) if step_times else None,
+            'collect': statistics.median(collect_times), 'model_run': model_run,
+            'model_run_steps': model.schedule.steps, 'baseline_rss_mb': baseline_rss, 'peak_rss_mb': peak_rss_mb()}
+
+
+def run_case_in_process(case, step_repeats=5, collect_repeats=5):
+    """Benchmark one case in a fresh process, see run_case"""
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(1, maxtasksperchild=1) as pool:
+        return pool.apply(run_case, (case, step_repeats, collect_repeats))
+
+
+def cases(sizes=SIZES, networks=NETWORKS, packages=PACKAGES, engines=('agents',), network_backend='networkx',
+          number_of_steps=80, seed=1):
+    """The model parameters of every case of the benchmark grid"""
+    return [{'seed': seed, 'number_of_households': size, 'number_of_steps': number_of_steps, 'network': network,
+             'subsidies_package': package, 'engine': engine, 'network_backend': network_backend,
+             'flood_map_choice': 'synthetic', 'reporter_schema': 'flat'}
+            for engine in engines for size in sizes for network in networks for package in packages]
+
+
+def git_commit():
+    """The git commit of the model code, with '+' when there are uncommitted changes, or None outside a git tree"""
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=MODEL_DIRECTORY, capture_output=True, text=True,
+                                check=True).stdout.strip()
+        changed = subprocess.run(['git', 'status', '--porcelain', '--', '.'], cwd=MODEL_DIRECTORY,
+                                 capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit + ('+' if changed else '')
+
+
+def metadata():
+    """Description of the code and machine that the benchmark ran on"""
+    return {'version': BENCHMARK_VERSION, 'code_version': code_version(), 'git_commit': git_commit(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(),
+            'platform': platform.platform(), 'processor': platform.processor(), 'cpu_count': os.cpu_count()}
+
+
+def case_key(case):
+    """Key of a case, to find the same case in other results"""
+    return json.dumps(case, sort_keys=True, default=canonical)
+
+
+def compare(results, baseline):
+    """
+    Compare results with the results of another run of the benchmark.
+
+    Returns
+    -------
+    rows: for every case in both, (case, {timing or 'peak_rss_mb': new value / baseline value})
+    """
+    baseline_results = {case_key(result['case']): result for result in baseline['results']}
+    rows = []
+    for result in results['results']:
+        old = baseline_results.get(case_key(result['case']))
+        if old is None:
+            continue
+        ratios = {name: result[name] / old[name] for name in TIMINGS + ('peak_rss_mb',)
+                  if result.get(name) and old.get(name)}
+        rows.append((result['case'], ratios))
+    return rows
+
+
+def describe(case):
+    return (f"{case['engine']:<10} {case['number_of_households']:>7} {case['network']:<16} "
+            f"package {case['subsidies_package']}")
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description='Benchmark AdaptationModel on synthetic inputs')
+    parser.add_argument('--sizes', type=int, nargs='+', default=list(SIZES))
+    parser.add_argument('--networks', nargs='+', default=list(NETWORKS), choices=NETWORKS)
+    parser.add_argument('--packages', type=int, nargs='+', default=list(PACKAGES), choices=PACKAGES)
+    parser.add_argument('--engines', nargs='+', default=['agents'], choices=['agents', 'vectorized'])
+    parser.add_argument('--network-backend', default='networkx', choices=['networkx', 'native'])
+    parser.add_argument('--steps', type=int, default=80, help='number_of_steps of the models (default: 80)')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--step-repeats', type=int, default=5, help='number of steps that are timed (default: 5)')
+    parser.add_argument('--quick', action='store_true', help='only 1000 households and 10 steps')
+    parser.add_argument('--output', help='JSON file to write the results to')
+    parser.add_argument('--compare', help='JSON file with earlier results to compare with')
+    parser.add_argument('--write-synthetic-inputs', action='store_true',
+                        help='write the synthetic inputs again and stop')
+    arguments = parser.parse_args(arguments)
+
+    if arguments.write_synthetic_inputs:
+        write_synthetic_inputs()
+        return
+    if arguments.quick:
+        arguments.sizes, arguments.steps = [1000], 10
+    results = {'metadata': metadata(), 'results': []}
+    for case in cases(arguments.sizes, arguments.networks, arguments.packages, arguments.engines,
+                      arguments.network_backend, arguments.steps, arguments.seed):
+        result = run_case_in_process(case, arguments.step_repeats)
+        results['results'].append(result)
+        step = f"{result['step']:9.4f}" if result['step'] is not None else '        -'
+        print(f"{describe(case)}  construction {result['construction']:8.3f} s  step {step} s  "
+              f"collect {result['collect']:8.4f} s  model_run {result['model_run']:8.3f} s "
+              f"({result['model_run_steps']} steps)  peak {result['peak_rss_mb']:7.1f} MB", flush=True)
+        if arguments.output:
+            # Written after every case, so an interrupted benchmark keeps its results
+            with open(arguments.output, 'w') as file:
+                json.dump(results, file, indent=1, default=canonical)
+
+    if arguments.compare:
+        with open(arguments.compare) as file:
+            baseline = json.load(file)
+        print(f"\nCompared with {baseline['metadata'].get('git_commit')} (new / old, below 1 is better):")
+        for case, ratios in compare(results, baseline):
+            print(f"{describe(case)}  " + '  '.join(f'{name} {ratio:5.2f}' for name, ratio in ratios.items()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,360 @@
+# -*- coding: utf-8 -*-
+"""
+Checkpoints of a running model, to pause, inspect and resume long runs.
+
+A checkpoint holds the full state of an AdaptationModel between two steps: the parameters, the network (as an array
+of edges), every household attribute as a typed array, the flood step, the step count, the states of all random
+generators, the flood events so far (with flood_events) and the data collected so far. The totals per income label are
+counted again from the households. A model restored from a checkpoint continues exactly like the original model would
+have:
+
+    save_checkpoint(model, '../output_data/run.npz')
+    model = load_checkpoint('../output_data/run.npz')
+    model.model_run()
+
+run_with_checkpoints runs a model and saves a checkpoint every few steps to a directory (see CheckpointDirectory), so
+a run that fails can be resumed from the last checkpoint. Every checkpoint only writes the data collected since the
+previous one, and they are written uncompressed by default, which is much faster than compressing them.
+
+Checkpoint files are .npz files with the arrays and a JSON description, without pickles, so they can be read by any
+version of Python and numpy. Models that collect the agent reporters returning Python objects
+(collect_object_reporters=True) cannot be checkpointed.
+"""
+import glob
+import inspect
+import json
+import os
+
+import numpy as np
+
+from flood_events import FloodHistory
+from flood_map_cache import write_atomic
+from model import AdaptationModel
+from result_cache import canonical
+from snapshot import PopulationSnapshot, POPULATION_ARRAYS, POPULATION_PARAMETERS, random_states
+from vectorized import INCOME_LABELS, MEASURES, MEASURE_DEPTHS
+
+# Increase when the layout of the checkpoint files changes
+CHECKPOINT_VERSION = 4
+
+# All attributes of the households, with the dtype they are stored with (the arrays of the vectorized engine)
+HOUSEHOLD_STATE = dict(POPULATION_ARRAYS, **{
+    'savings': float,
+    'flood_damage_estimated': float,
+    'flood_depth_actual': float,
+    'flood_damage_actual': float,
+    'network_flood_perception': np.int8,  # -1 when the household has no friends
+    'is_adapted': bool,
+    'going_to_adapt': bool,
+    'optimal_measure': np.int8,  # code in vectorized.MEASURES
+    'adaptation_step': np.int32,
+    'adaptation_depth': float,
+    'cost_of_adaptation': float,
+    'subsidies_received': float,
+    'adaptation_costs': np.int64,  # cost per m2 of every measure, shape (households, measures)
+})
+
+
+def model_parameters(model):
+    """The values of all parameters of AdaptationModel, read from the model"""
+    return {name: getattr(model, name) for name in inspect.signature(AdaptationModel).parameters
+            if name != 'population'}
+
+
+def household_state(model):
+    """All attributes of the households as arrays, see HOUSEHOLD_STATE"""
+    if model.engine == 'vectorized':
+        return {name: getattr(model.households, name).astype(dtype) for name, dtype in HOUSEHOLD_STATE.items()}
+
+    agents = model.schedule.agents
+    income_labels = {label: code for code, label in enumerate(INCOME_LABELS)}
+    measures = {measure: code for code, measure in enumerate(MEASURES)}
+    state = {
+        'income_label': [income_labels[agent.income_label] for agent in agents],
+        'network_flood_perception': [-1 if agent.network_flood_perception is None else agent.network_flood_perception
+                                     for agent in agents],
+        # The installed measure carries the step of adaptation as suffix, e.g. 'Drains_12'
+        'optimal_measure': [measures[agent.optimal_measure.rsplit('_', 1)[0]] for agent in agents],
+        'adaptation_costs': [[0] + [agent.adaptation_measures[measure][1] for measure in MEASURES[1:]]
+                             for agent in agents],
+    }
+    for name in HOUSEHOLD_STATE:
+        if name not in state:
+            state[name] = [getattr(agent, name) for agent in agents]
+    return {name: np.array(values, dtype=HOUSEHOLD_STATE[name]) for name, values in state.items()}
+
+
+def set_household_state(model, state):
+    """Set all attributes of the households to the arrays given by household_state"""
+    if model.engine == 'vectorized':
+        for name, dtype in HOUSEHOLD_STATE.items():
+            setattr(model.households, name, state[name].astype(dtype))
+        model.households.update_adaptation_margins()
+        return
+
+    # Python values, so the households calculate exactly as before
+    values = {name: array.tolist() for name, array in state.items()}
+    for i, agent in enumerate(model.schedule.agents):
+        for name in ('savings', 'flood_damage_estimated', 'flood_depth_actual', 'flood_damage_actual',
+                     'is_adapted', 'going_to_adapt', 'adaptation_step', 'adaptation_depth', 'cost_of_adaptation',
+                     'subsidies_received', 'own_flood_perception', 'flood_depth_estimated'):
+            setattr(agent, name, values[name][i])
+        network_flood_perception = values['network_flood_perception'][i]
+        agent.network_flood_perception = None if network_flood_perception == -1 else network_flood_perception
+        optimal_measure = MEASURES[values['optimal_measure'][i]]
+        if agent.adaptation_step >= 0:
+            optimal_measure = f'{optimal_measure}_{agent.adaptation_step}'
+        agent.optimal_measure = optimal_measure
+        agent.adaptation_measures = {measure: [MEASURE_DEPTHS[code].item(), values['adaptation_costs'][i][code]]
+                                     for code, measure in enumerate(MEASURES) if code > 0}
+
+
+def model_state(model):
+    """The state of a model without its collected data: (arrays, JSON description)"""
+    if model.collect_object_reporters:
+        raise ValueError("Models with collect_object_reporters=True cannot be checkpointed")
+    arrays = {'edges': model.edges}
+    arrays.update({f'household/{name}': values for name, values in household_state(model).items()})
+    if model.flood_ensemble is not None:
+        history = model.flood_ensemble.history.arrays()
+        arrays.update({f'flood_events/{name}': values for name, values in history.items()})
+    metadata = {
+        'version': CHECKPOINT_VERSION,
+        'parameters': model_parameters(model),
+        'flood_step': model.flood_step,
+        'steps': model.schedule.steps,
+        'time': model.schedule.time,
+        'running': model.running,
+        'perceptions_settled': model.perceptions_settled,
+        'income_distribution_label': model.income_distribution_label,
+        'random_states': random_states(model),
+        'next_flood_event': model.flood_ensemble.next_event if model.flood_ensemble is not None else None,
+    }
+    return arrays, metadata
+
+
+def collected_data(collector, start=0):
+    """
+    The rows of the collected data from row start on: (arrays, JSON values of the model reporters that are not
+    numbers). The nested model reporters are dictionaries (or strings), which are stored in the JSON description.
+    """
+    steps, agent_ids, agent_columns = collector.get_agent_vars_arrays()
+    arrays = {'collector/steps': steps[start:]}
+    object_columns = {}
+    for name, column in collector.model_vars.items():
+        if column.dtype == object:
+            object_columns[name] = column[start:].tolist()
+        else:
+            arrays[f'model/{name}'] = column[start:]
+    if agent_ids is not None:
+        arrays['collector/agent_ids'] = agent_ids
+        arrays.update({f'agent/{name}': column[start:] for name, column in agent_columns.items()})
+    return arrays, object_columns
+
+
+def write_checkpoint_file(path, arrays, metadata, compress):
+    """Write arrays and their JSON description to a .npz file, atomically so a good checkpoint is never lost"""
+    arrays = dict(arrays, metadata=np.array(json.dumps(metadata, default=canonical)))
+    save = np.savez_compressed if compress else np.savez
+    write_atomic(path, lambda file: save(file, **arrays))
+
+
+def read_checkpoint_metadata(path):
+    """Read only the JSON description of a file written by write_checkpoint_file"""
+    with np.load(path, allow_pickle=False) as data:
+        return json.loads(str(data['metadata']))
+
+
+def read_checkpoint_file(path):
+    """Read a file written by write_checkpoint_file: (arrays, JSON description)"""
+    with np.load(path, allow_pickle=False) as data:
+        metadata = json.loads(str(data['metadata']))
+        if metadata['version'] != CHECKPOINT_VERSION:
+            raise ValueError(f"The checkpoint {path} has version {metadata['version']}, this code reads version "
+                             f"{CHECKPOINT_VERSION}")
+        return {name: data[name] for name in data.files if name != 'metadata'}, metadata
+
+
+def save_checkpoint(model, path, compress=True):
+    """
+    Save the state of a model between two steps to a single file.
+
+    Parameters
+    ----------
+    model: AdaptationModel
+    path: path of the .npz file
+    compress: compress the arrays, which makes the file smaller but the saving slower
+    """
+    arrays, metadata = model_state(model)
+    collected, metadata['object_model_columns'] = collected_data(model.datacollector)
+    write_checkpoint_file(path, dict(arrays, **collected), metadata, compress)
+
+
+class CheckpointDirectory:
+    """
+    Checkpoints of a run in a directory, for checkpointing every few steps. The data collected since the previous
+    checkpoint is written to a new file rows-<first row>.npz, and checkpoint.npz holds the state of the model and the
+    list of those files. Every checkpoint then only writes what is new, however long the run is.
+
+    A model restored from the checkpoint in the directory (load_checkpoint(directory)) continues it after resume(model),
+    keeping the files of the rows that were already saved. Otherwise the checkpoint in the directory is replaced at the
+    first save. The files of segments that are not listed in checkpoint.npz, e.g. after a crash, are removed at the next
+    checkpoint.
+
+    Parameters
+    ----------
+    directory: directory of the checkpoints, created when needed
+    compress: compress the arrays, see save_checkpoint
+    """
+
+    def __init__(self, directory, compress=False):
+        self.directory = directory
+        self.compress = compress
+        self.segments = []
+        self.number_of_rows = 0
+        os.makedirs(directory, exist_ok=True)
+        # The description of the checkpoint that is already in the directory, until the first save
+        self.previous = None
+        if os.path.exists(self.path('checkpoint.npz')):
+            self.previous = read_checkpoint_metadata(self.path('checkpoint.npz'))
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def resume(self, model):
+        """
+        Continue the checkpoint in the directory with a model that was restored from it and has not stepped since.
+
+        Returns
+        -------
+        resumed: whether the checkpoint is continued, otherwise it is replaced at the first save
+        """
+        previous = self.previous
+        if previous is None or previous.get('version') != CHECKPOINT_VERSION:
+            return False
+        parameters = json.loads(json.dumps(model_parameters(model), default=canonical))
+        if (previous['parameters'] != parameters or previous['steps'] != model.schedule.steps
+                or previous.get('number_of_rows') != model.datacollector.number_of_rows):
+            return False
+        self.segments = list(previous['segments'])
+        self.number_of_rows = previous['number_of_rows']
+        self.previous = None
+        return True
+
+    def save(self, model):
+        """Save a checkpoint of the model"""
+        if self.previous is not None:
+            # The checkpoint of another run is removed before its segments are overwritten
+            os.remove(self.path('checkpoint.npz'))
+            self.previous = None
+        collector = model.datacollector
+        if collector.number_of_rows > self.number_of_rows:
+            segment = f'rows-{self.number_of_rows:06d}.npz'
+            collected, object_columns = collected_data(collector, self.number_of_rows)
+            write_checkpoint_file(self.path(segment), collected,
+                                  {'version': CHECKPOINT_VERSION, 'object_model_columns': object_columns},
+                                  self.compress)
+            self.segments.append(segment)
+            self.number_of_rows = collector.number_of_rows
+        arrays, metadata = model_state(model)
+        # checkpoint.npz is written last, a segment only becomes part of the checkpoint once it is listed there
+        metadata['segments'] = self.segments
+        metadata['number_of_rows'] = self.number_of_rows
+        write_checkpoint_file(self.path('checkpoint.npz'), arrays, metadata, self.compress)
+        for path in glob.glob(self.path('rows-*.npz')):
+            if os.path.basename(path) not in self.segments:
+                os.remove(path)
+
+
+def read_checkpoint_directory(directory):
+    """Read the state and all collected rows of a CheckpointDirectory, like a single checkpoint file"""
+    arrays, metadata = read_checkpoint_file(os.path.join(directory, 'checkpoint.npz'))
+    segments = [read_checkpoint_file(os.path.join(directory, segment)) for segment in metadata['segments']]
+    if not segments:
+        metadata['object_model_columns'] = {}
+        return arrays, metadata
+    for name in segments[0][0]:
+        if name == 'collector/agent_ids':
+            arrays[name] = segments[0][0][name]
+        else:
+            arrays[name] = np.concatenate([segment_arrays[name] for segment_arrays, _ in segments])
+    metadata['object_model_columns'] = {name: [value for _, segment_metadata in segments
+                                               for value in segment_metadata['object_model_columns'][name]]
+                                        for name in segments[0][1]['object_model_columns']}
+    return arrays, metadata
+
+
+def load_checkpoint(path):
+    """
+    Restore a model from a checkpoint saved with save_checkpoint, or from a CheckpointDirectory.
+
+    Returns
+    -------
+    model: AdaptationModel that continues with the next step of the saved model
+    """
+    if os.path.isdir(path):
+        arrays, metadata = read_checkpoint_directory(path)
+    else:
+        arrays, metadata = read_checkpoint_file(path)
+
+    # The model is created from its current households, like a forked population, and then set to the saved state
+    parameters = metadata['parameters']
+    state = {name: arrays[f'household/{name}'] for name in HOUSEHOLD_STATE}
+    population = PopulationSnapshot({name: parameters[name] for name in POPULATION_PARAMETERS},
+                                    metadata['flood_step'], arrays['edges'],
+                                    {name: state[name] for name in POPULATION_ARRAYS}, metadata['random_states'])
+    model = population.fork(**{name: value for name, value in parameters.items()
+                               if name not in POPULATION_PARAMETERS})
+    set_household_state(model, state)
+    # The totals per income label are the exact sums of the households, so they are counted again
+    model.income_label_totals.recount(model)
+    model.schedule.steps = metadata['steps']
+    model.schedule.time = metadata['time']
+    model.running = metadata['running']
+    model.perceptions_settled = metadata['perceptions_settled']
+    model.income_distribution_label = metadata['income_distribution_label']
+    if model.flood_ensemble is not None:
+        model.flood_ensemble.next_event = metadata['next_flood_event']
+        model.flood_ensemble.history = FloodHistory.from_arrays({name[len('flood_events/'):]: values
+                                                                 for name, values in arrays.items()
+                                                                 if name.startswith('flood_events/')})
+
+    model_columns = {name[len('model/'):]: values for name, values in arrays.items() if name.startswith('model/')}
+    for name, values in metadata['object_model_columns'].items():
+        model_columns[name] = np.empty(len(values), dtype=object)
+        model_columns[name][:] = values
+    # The columns in the order of the reporters, as they were collected
+    model_columns = {name: model_columns[name] for name in model.datacollector.model_reporters
+                     if name in model_columns}
+    agent_columns = {name: arrays[f'agent/{name}'] for name in model.datacollector.agent_reporters
+                     if f'agent/{name}' in arrays}
+    model.datacollector.restore(arrays.get('collector/steps', np.zeros(0, dtype=np.int64)), model_columns,
+                                arrays.get('collector/agent_ids'), agent_columns)
+    return model
+
+
+def run_with_checkpoints(model, directory, every, max_steps=None, compress=False):
+    """
+    Run a model like AdaptationModel.model_run, saving a checkpoint to a CheckpointDirectory every few steps and when
+    the run ends. Resume a failed run with run_with_checkpoints(load_checkpoint(directory), directory, every).
+
+    Parameters
+    ----------
+    model: AdaptationModel
+    directory: directory of the checkpoints
+    every: number of steps between checkpoints
+    max_steps: number of steps after which the run ends, by default the number_of_steps of the model
+    compress: compress the checkpoints, see save_checkpoint
+    """
+    checkpoints = CheckpointDirectory(directory, compress)
+    checkpoints.resume(model)
+    if max_steps is None:
+        max_steps = model.number_of_steps
+    while model.running and model.schedule.steps < max_steps:
+        model.step()
+        if model.schedule.steps % every == 0:
+            checkpoints.save(model)
+    checkpoints.save(model)
+    if model.profiler is not None:
+        model.profiler.close()
+    return model
@@ -0,0 +1,285 @@
+# -*- coding: utf-8 -*-
+"""
+Columnar data collector for the Flood Adaptation Model.
+
+mesa's DataCollector stores every agent report as a tuple of Python objects, which dominates memory and makes results
+slow to send back from batch_run workers. The ColumnarDataCollector keeps one typed NumPy array per reporter instead,
+preallocated for the number of steps of the run, and stores categorical reporters (income label, measure) as small
+integer codes. Reporters that return Python objects (Location, AdaptationMeasures, Network) are opt-in.
+
+The collector offers the parts of mesa's DataCollector that the notebooks and batch_run use: collect,
+get_model_vars_dataframe, get_agent_vars_dataframe, model_vars, agent_reporters and _agent_records.
+"""
+import inspect
+from operator import attrgetter
+
+import numpy as np
+import pandas as pd
+
+
+def value_dtype(value):
+    """Return the dtype of the column a model reporter value is stored in"""
+    if isinstance(value, (bool, np.bool_)):
+        return np.dtype(bool)
+    if isinstance(value, (int, np.integer)):
+        return np.dtype(np.int64)
+    if isinstance(value, (float, np.floating)):
+        return np.dtype(np.float64)
+    return np.dtype(object)
+
+
+class AgentColumn:
+    """
+    A typed agent reporter.
+
+    Parameters
+    ----------
+    attribute: name of the household attribute, may be dotted (e.g. 'location.x')
+    dtype: numpy dtype of the column, object for reporters that return Python objects
+    categories: for categorical attributes, the possible values; the column then stores their index as int8
+    array: name of the array in the vectorized engine (model.households) holding this attribute, if it differs
+    missing: value stored when the attribute is None
+    step_suffix: name of a column with the step of adaptation, which is appended to the value ('Drains_12') once it
+        is 0 or higher, as the Households class does for the optimal measure
+    """
+
+    def __init__(self, attribute, dtype=np.float64, categories=None, array=None, missing=None, step_suffix=None):
+        self.attribute = attribute
+        self.categories = categories
+        self.dtype = np.dtype(np.int8 if categories else dtype)
+        self.array = array if array is not None else attribute
+        self.missing = missing
+        self.step_suffix = step_suffix
+        self.get_value = attrgetter(attribute)
+        self.codes = {category: code for code, category in enumerate(categories)} if categories else None
+
+    def encode(self, value):
+        """Return the code of a categorical value"""
+        code = self.codes.get(value)
+        if code is None:
+            # Installed measures carry the step of adaptation as suffix, e.g. 'Drains_12'
+            code = self.codes[value.rsplit('_', 1)[0]]
+        return code
+
+    def read(self, model, agents):
+        """Return the values of all households as an array"""
+        households = getattr(model, 'households', None)
+        if households is not None and hasattr(households, self.array):
+            # The vectorized engine already stores the attribute as an array, with the same categorical codes
+            return getattr(households, self.array)
+        values = [self.get_value(agent) for agent in agents]
+        if self.missing is not None:
+            values = [self.missing if value is None else value for value in values]
+        if self.codes is not None:
+            values = [self.encode(value) for value in values]
+        if self.dtype == object:
+            column = np.empty(len(values), dtype=object)
+            column[:] = values
+            return column
+        return np.array(values, dtype=self.dtype)
+
+    def decode(self, values, steps=None):
+        """Return the original values of a column (part), with the step suffix applied"""
+        if self.codes is None:
+            return values
+        decoded = np.array(self.categories, dtype=object)[values]
+        if steps is not None:
+            adapted = steps >= 0
+            decoded[adapted] = [f'{value}_{step}' for value, step in zip(decoded[adapted], steps[adapted])]
+        return decoded
+
+
+class _AgentRecords:
+    """Read-only mapping {step: [(step, agent id, *values), ...]}, built on demand like mesa's _agent_records"""
+
+    def __init__(self, collector):
+        self.collector = collector
+
+    def get(self, step, default=None):
+        row = self.collector.row_of_step(step)
+        if row is None:
+            return default
+        columns = self.collector.decoded_agent_columns(row, row + 1)
+        agent_ids = self.collector.agent_ids.tolist()
+        rows = [column[0].tolist() for column in columns.values()]
+        return [(step, agent_id, *values) for agent_id, *values in zip(agent_ids, *rows)]
+
+    def __getitem__(self, step):
+        records = self.get(step)
+        if records is None:
+            raise KeyError(step)
+        return records
+
+    def __contains__(self, step):
+        return self.collector.row_of_step(step) is not None
+
+    def keys(self):
+        return self.collector.steps[:self.collector.number_of_rows].tolist()
+
+    def values(self):
+        return [self[step] for step in self.keys()]
+
+
+class ColumnarDataCollector:
+    """
+    Collects model and agent reporters into preallocated typed NumPy arrays, one row per collected step.
+
+    Parameters
+    ----------
+    model_reporters: dictionary {name: reporter}, with as reporter a method of the model, a function that takes the
+        model, a list [function, [arguments]] or the name of a model attribute
+    agent_reporters: dictionary {name: AgentColumn}
+    number_of_steps: expected number of collected steps, the arrays grow when more steps are collected
+    """
+
+    def __init__(self, model_reporters=None, agent_reporters=None, number_of_steps=100):
+        self.model_reporters = dict(model_reporters or {})
+        self.agent_reporters = dict(agent_reporters or {})
+        self.capacity = max(int(number_of_steps), 1)
+        self.number_of_rows = 0
+        self.steps = np.zeros(self.capacity, dtype=np.int64)
+        self.model_columns = {}
+        self.agent_columns = {}
+        self.agent_ids = None
+
+    def report_model(self, model, reporter):
+        """Call a model reporter the way mesa's DataCollector does"""
+        if isinstance(reporter, str):
+            return getattr(model, reporter, None)
+        if isinstance(reporter, list):
+            # A function with its arguments: [function, [arguments]]
+            return reporter[0](*reporter[1])
+        if inspect.ismethod(reporter):
+            return reporter()
+        return reporter(model)
+
+    def grow(self):
+        """Double the number of rows of every array"""
+        self.capacity *= 2
+        self.steps = np.resize(self.steps, self.capacity)
+        for columns in (self.model_columns, self.agent_columns):
+            for name, column in columns.items():
+                grown = np.empty((self.capacity,) + column.shape[1:], dtype=column.dtype)
+                grown[:len(column)] = column
+                columns[name] = grown
+
+    def store_model_value(self, name, row, value):
+        """Store a model value, widening the dtype of the column when the value does not fit in it"""
+        column = self.model_columns.get(name)
+        dtype = value_dtype(value)
+        if column is None:
+            column = self.model_columns[name] = np.empty(self.capacity, dtype=dtype)
+        elif column.dtype != np.result_type(column.dtype, dtype):
+            column = self.model_columns[name] = column.astype(np.result_type(column.dtype, dtype))
+        column[row] = value
+
+    def collect(self, model):
+        """Collect all reporters for the current step of the model"""
+        row = self.number_of_rows
+        if row == self.capacity:
+            self.grow()
+        self.steps[row] = model.schedule.steps
+        # With a profiled model, every reporter is profiled as the phase 'collect/<name>' (see profiling.py)
+        profiler = getattr(model, 'profiler', None)
+
+        for name, reporter in self.model_reporters.items():
+            if profiler is None:
+                self.store_model_value(name, row, self.report_model(model, reporter))
+            else:
+                started = profiler.start()
+                self.store_model_value(name, row, self.report_model(model, reporter))
+                profiler.stop('collect/' + name, started)
+
+        if self.agent_reporters:
+            agents = model.schedule.agents
+            if self.agent_ids is None:
+                self.agent_ids = np.array([agent.unique_id for agent in agents], dtype=np.int64)
+            for name, reporter in self.agent_reporters.items():
+                if profiler is None:
+                    values = reporter.read(model, agents)
+                else:
+                    started = profiler.start()
+                    values = reporter.read(model, agents)
+                    profiler.stop('collect/' + name, started)
+                column = self.agent_columns.get(name)
+                if column is None:
+                    column = self.agent_columns[name] = np.empty((self.capacity, len(values)), dtype=reporter.dtype)
+                column[row] = values
+        self.number_of_rows += 1
+
+    def repeat_last_row(self, steps):
+        """Store the last collected row again for each of the given steps, for steps in which nothing changed"""
+        for step in steps:
+            row = self.number_of_rows
+            if row == self.capacity:
+                self.grow()
+            self.steps[row] = step
+            for columns in (self.model_columns, self.agent_columns):
+                for column in columns.values():
+                    column[row] = column[row - 1]
+            self.number_of_rows += 1
+
+    def restore(self, steps, model_columns, agent_ids=None, agent_columns=None):
+        """
+        Continue collecting after rows that were collected before, e.g. by the model of a checkpoint.
+
+        Parameters
+        ----------
+        steps: the collected steps
+        model_columns: dictionary {reporter: array with a value per collected step}
+        agent_ids: ids of the households, None when no agent data was collected yet
+        agent_columns: dictionary {reporter: array of shape (collected steps, households)} with the encoded values
+        """
+        self.number_of_rows = len(steps)
+        self.capacity = max(self.capacity, self.number_of_rows)
+        self.steps = np.zeros(self.capacity, dtype=np.int64)
+        self.steps[:self.number_of_rows] = steps
+        self.model_columns = {}
+        self.agent_columns = {}
+        for columns, restored_columns in ((self.model_columns, model_columns), (self.agent_columns, agent_columns)):
+            for name, restored in (restored_columns or {}).items():
+                column = columns[name] = np.empty((self.capacity,) + restored.shape[1:], dtype=restored.dtype)
+                column[:self.number_of_rows] = restored
+        self.agent_ids = agent_ids
+
+    def row_of_step(self, step):
+        """Return the row of the data collected at a step, or None"""
+        rows = np.flatnonzero(self.steps[:self.number_of_rows] == step)
+        return rows[-1] if len(rows) else None
+
+    @property
+    def model_vars(self):
+        """{name: values per collected step}, like mesa's DataCollector"""
+        return {name: column[:self.number_of_rows] for name, column in self.model_columns.items()}
+
+    @property
+    def _agent_records(self):
+        return _AgentRecords(self)
+
+    def get_agent_vars_arrays(self):
+        """Return the collected steps, agent ids and the raw (encoded) agent columns, e.g. to store them compactly"""
+        n = self.number_of_rows
+        return self.steps[:n], self.agent_ids, {name: column[:n] for name, column in self.agent_columns.items()}
+
+    def decoded_agent_columns(self, start, stop):
+        """Return the agent columns of rows start to stop with the categorical values decoded"""
+        decoded = {}
+        for name, reporter in self.agent_reporters.items():
+            values = self.agent_columns[name][start:stop]
+            steps = self.agent_columns[reporter.step_suffix][start:stop] if reporter.step_suffix else None
+            decoded[name] = reporter.decode(values, steps)
+        return decoded
+
+    def get_model_vars_dataframe(self):
+        """DataFrame with one column per model reporter and one row per collected step"""
+        return pd.DataFrame(self.model_vars)
+
+    def get_agent_vars_dataframe(self):
+        """DataFrame with one column per agent reporter and a (Step, AgentID) index, like mesa's DataCollector"""
+        n = self.number_of_rows
+        number_of_agents = 0 if self.agent_ids is None else len(self.agent_ids)
+        index = pd.MultiIndex.from_arrays([np.repeat(self.steps[:n], number_of_agents),
+                                           np.tile(self.agent_ids if number_of_agents else [], n)],
+                                          names=['Step', 'AgentID'])
+        columns = {name: values.reshape(-1) for name, values in self.decoded_agent_columns(0, n).items()}
+        return pd.DataFrame(columns, index=index)
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+"""
+Depth-damage functions, which give the flood damage of a household from the flood depth at its location.
+
+The model uses the logarithmic regression of calculate_basic_flood_damage by default. Other damage curves, such as the
+JRC data points in input_data/flood_depth-damage_function.xlsx that the regression was fitted on, are tabulated once on
+a regular grid of depths. Looking up a depth in the table is a multiplication and an index (optionally with linear
+interpolation between the two nearest depths), so a custom curve costs the same as the default one, however the curve
+itself is computed.
+
+Every depth-damage function has the same two methods:
+- damage(flood_depths, housesizes) for arrays of households, used by the vectorized engine.
+- scalar_damage(flood_depth, housesize) for a single household, used by the Households agents.
+
+The model chooses the function with the depth_damage_function parameter, see load_depth_damage_function. The functions
+are loaded once per process and shared by all models. Reading Excel files needs openpyxl.
+"""
+import math
+
+import numpy as np
+
+from functions import calculate_basic_flood_damage, calculate_basic_flood_damage_array
+
+# Average price of a house in euro's per m2, which the damage factor (between 0 and 1) is multiplied with
+PRICE_PER_M2 = 788
+
+# Named depth-damage functions, the tabulated curves are given by the path of their data points
+DEPTH_DAMAGE_FUNCTIONS = {
+    'logarithmic': None,
+    'jrc': r'../input_data/flood_depth-damage_function.xlsx',
+}
+
+# Depth-damage functions loaded in this process, by choice and interpolation
+_loaded_depth_damage_functions = {}
+
+
+class LogarithmicDepthDamage:
+    """
+    The logarithmic regression over the JRC data points of de Moel, Huizinga (2017), see calculate_basic_flood_damage.
+    It is evaluated exactly, so the results of the model do not change.
+    """
+
+    def damage(self, flood_depths, housesizes):
+        return calculate_basic_flood_damage_array(flood_depths, housesizes)
+
+    def scalar_damage(self, flood_depth, housesize):
+        return calculate_basic_flood_damage(flood_depth, housesize)
+
+
+class TabulatedDepthDamage:
+    """
+    Depth-damage function that looks up the damage factor in a table of damage factors at regular depths.
+    Depths below zero give the damage factor at depth zero, depths beyond the table the factor at its last depth.
+
+    Parameters
+    ----------
+    damage_factors: array of damage factors (between 0 and 1) at the depths 0, resolution, 2 * resolution, ...
+    resolution: distance in meters between the depths of the table
+    interpolate: whether to interpolate linearly between the two nearest depths of the table, or to take the
+        damage factor of the nearest depth
+    """
+
+    def __init__(self, damage_factors, resolution=0.001, interpolate=True):
+        self.damage_factors = np.asarray(damage_factors, dtype=float)
+        if len(self.damage_factors) < 2:
+            raise ValueError("A depth-damage table needs the damage factors of at least two depths")
+        self.resolution = resolution
+        self.interpolate = interpolate
+        self.last_index = len(self.damage_factors) - 1
+        # Lookups multiply by the inverse of the resolution, and interpolate with the slope to the next depth
+        self.inverse_resolution = 1 / resolution
+        self.slopes = np.append(np.diff(self.damage_factors), 0)
+        # The scalar lookups index lists, which is faster than indexing the arrays for a single element
+        self.damage_factor_list = self.damage_factors.tolist()
+        self.slope_list = self.slopes.tolist()
+
+    @classmethod
+    def from_points(cls, depths, damage_factors, maximum_depth=None, resolution=0.001, interpolate=True):
+        """
+        Tabulate the curve that connects data points of flood depth and damage factor by straight lines. Depths
+        below the first point give no damage, depths beyond the last point its damage factor.
+
+        Parameters
+        ----------
+        depths: flood depths in meters of the data points, in increasing order
+        damage_factors: damage factors of the data points
+        maximum_depth: largest depth of the table, the depth of the last point by default
+        resolution, interpolate: see TabulatedDepthDamage
+        """
+        depths = np.asarray(depths, dtype=float)
+        if len(depths) == 0 or np.any(np.diff(depths) <= 0):
+            raise ValueError("The depths of a depth-damage curve must be given in increasing order")
+        table_depths = np.arange(int(math.ceil((maximum_depth or depths[-1]) / resolution)) + 1) * resolution
+        return cls(np.interp(table_depths, depths, damage_factors, left=0), resolution, interpolate)
+
+    @classmethod
+    def from_function(cls, damage_factor, maximum_depth=6, resolution=0.001, interpolate=True):
+        """
+        Tabulate a function that returns the damage factors of an array of flood depths.
+
+        Parameters
+        ----------
+        damage_factor: function of an array of flood depths in meters
+        maximum_depth: largest depth of the table, deeper floods give the damage factor at this depth
+        resolution, interpolate: see TabulatedDepthDamage
+        """
+        table_depths = np.arange(int(math.ceil(maximum_depth / resolution)) + 1) * resolution
+        return cls(damage_factor(table_depths), resolution, interpolate)
+
+    @classmethod
+    def from_excel(cls, path, **kwargs):
+        """
+        Tabulate the data points of an Excel file with the layout of input_data/flood_depth-damage_function.xlsx:
+        the water depth in meters in the first column and the damage factor in the second column. Rows without two
+        numbers (headers, notes) are skipped.
+        """
+        import pandas as pd
+        table = pd.read_excel(path, header=None, usecols=[0, 1])
+        points = table.apply(pd.to_numeric, errors='coerce').dropna()
+        return cls.from_points(points[0].to_numpy(), points[1].to_numpy(), **kwargs)
+
+    def damage_factor(self, flood_depths):
+        """Damage factors of an array of flood depths"""
+        positions = np.asarray(flood_depths, dtype=float) * self.inverse_resolution
+        np.clip(positions, 0, self.last_index, out=positions)
+        if not self.interpolate:
+            return self.damage_factors[(positions + 0.5).astype(np.int64)]
+        lower = positions.astype(np.int64)
+        positions -= lower
+        return self.damage_factors[lower] + self.slopes[lower] * positions
+
+    def damage(self, flood_depths, housesizes):
+        return self.damage_factor(flood_depths) * PRICE_PER_M2 * np.asarray(housesizes, dtype=float)
+
+    def scalar_damage(self, flood_depth, housesize):
+        position = flood_depth * self.inverse_resolution
+        if position <= 0:
+            damage_factor = self.damage_factor_list[0]
+        elif position >= self.last_index:
+            damage_factor = self.damage_factor_list[-1]
+        elif self.interpolate:
+            lower = int(position)
+            damage_factor = self.damage_factor_list[lower] + self.slope_list[lower] * (position - lower)
+        else:
+            damage_factor = self.damage_factor_list[int(position + 0.5)]
+        return damage_factor * PRICE_PER_M2 * housesize
+
+
+def load_depth_damage_function(choice, interpolate=True):
+    """
+    Return the depth-damage function of a model, loaded once per process.
+
+    Parameters
+    ----------
+    choice: name in DEPTH_DAMAGE_FUNCTIONS, or the path of an Excel file with data points (see
+        TabulatedDepthDamage.from_excel)
+    interpolate: whether tabulated curves interpolate between the depths of their table
+
+    Returns
+    -------
+    depth_damage: LogarithmicDepthDamage or TabulatedDepthDamage
+    """
+    key = (choice, interpolate)
+    if key not in _loaded_depth_damage_functions:
+        if choice == 'logarithmic':
+            depth_damage = LogarithmicDepthDamage()
+        elif choice in DEPTH_DAMAGE_FUNCTIONS:
+            depth_damage = TabulatedDepthDamage.from_excel(DEPTH_DAMAGE_FUNCTIONS[choice], interpolate=interpolate)
+        elif str(choice).endswith(('.xlsx', '.xls')):
+            depth_damage = TabulatedDepthDamage.from_excel(choice, interpolate=interpolate)
+        else:
+            raise ValueError(f"Unknown depth-damage function: '{choice}'. "
+                             f"Currently implemented functions are: {list(DEPTH_DAMAGE_FUNCTIONS.keys())}, "
+                             f"or the path of an Excel file with data points")
+        _loaded_depth_damage_functions[key] = depth_damage
+    return _loaded_depth_damage_functions[key]
@@ -0,0 +1,403 @@
+# -*- coding: utf-8 -*-
+"""
+Parallel experiment runner for the Flood Adaptation Model.
+
+mesa's batch_run starts every worker from scratch and sends back a dictionary per agent and step. This runner is made
+for AdaptationModel sweeps:
+- The flood maps and geometries are loaded once in the parent process. The flood maps are memory-mapped from their
+  cache files (see flood_map_cache.py), so all workers share the same pages of memory, and the geometries are handed
+  to every worker once as WKB when it starts, so no worker reads or projects the shapefiles.
+- The runs are sent to a process pool in chunks of chunk_size runs.
+- Every run sends back its collected data as typed NumPy arrays (RunResult), not as a list of dictionaries.
+- The throughput is reported in runs per second.
+- With a cache (see result_cache.py), runs that have been run before with the same parameters, seed and code are
+  read from the cache instead of being run again, so an interrupted or extended sweep only runs the missing runs.
+- With common random numbers, the runs of an iteration in a chunk share their population (see snapshot.py).
+- With write_experiments, every run is written to a partitioned Parquet dataset as soon as it is finished (see
+  result_store.py), so memory use does not grow with the number of runs.
+- With profile=True, every run is profiled per phase (see profiling.py) and sends its profile back with its data.
+
+Example:
+    results = run_experiments({"number_of_households": 1000, "subsidies_package": [0, 1, 2, 3]},
+                              iterations=100, number_processes=32)
+    print(results.runs_per_second)
+    df = results.model_vars_dataframe()
+"""
+import hashlib
+import inspect
+import itertools
+import json
+import math
+import os
+import time
+from functools import partial
+from multiprocessing import Pool
+
+import numpy as np
+import pandas as pd
+from tqdm.auto import tqdm
+
+from model import AdaptationModel, FLOOD_MAP_PATHS, flood_map_geometry, model_reporter_names
+from functions import geometry
+from flood_map_cache import load_flood_map
+from result_store import ParquetResultWriter
+from result_cache import ResultCache, canonical
+from snapshot import PopulationSnapshot, POPULATION_PARAMETERS
+from profiling import PROFILE_COLUMNS
+
+# Number of population snapshots a worker keeps, see create_model
+MAXIMUM_POPULATIONS = 8
+
+
+def is_swept(values):
+    """
+    Whether a parameter is swept, as batch_run decides it: iterables (e.g. lists) of values are swept, other values
+    are used in every run. Strings and dictionaries (e.g. a single income_distribution) are single values.
+    """
+    return not isinstance(values, (str, dict)) and hasattr(values, '__iter__')
+
+
+def parameter_combinations(parameters):
+    """All combinations of the parameter values, see is_swept"""
+    parameter_list = [[(name, value) for value in (values if is_swept(values) else [values])]
+                      for name, values in parameters.items()]
+    return [dict(combination) for combination in itertools.product(*parameter_list)]
+
+
+def make_runs(parameters, iterations=1, seed=None):
+    """
+    Make the list of runs of an experiment.
+
+    Parameters
+    ----------
+    parameters: dictionary {parameter name: value or list of values}
+    iterations: number of runs of every combination of parameter values
+    seed: if given, and seed is not one of the parameters, every run gets its own seed derived from it, so the whole
+        experiment can be repeated. The seed of a run only depends on this seed, the iteration and the parameters of
+        the run, so runs keep their seed (and their place in a ResultCache) when values are added to a sweep
+
+    Returns
+    -------
+    runs: list of (run id, iteration, model parameters), in the same order as batch_run
+    """
+    runs = []
+    for iteration in range(iterations):
+        for kwargs in parameter_combinations(parameters):
+            runs.append((len(runs), iteration, kwargs))
+    if seed is not None and 'seed' not in parameters:
+        runs = [(run_id, iteration, dict(kwargs, seed=run_seed(seed, iteration, kwargs)))
+                for run_id, iteration, kwargs in runs]
+    return runs
+
+
+def run_seed(seed, iteration, parameters):
+    """
+    Seed of a run, derived from the seed of the experiment, the iteration and the parameters of the run. With common
+    random numbers, all runs of an iteration get the same seed, so they share their population and flood.
+    """
+    if parameters.get('common_random_numbers'):
+        parameters = {}
+    text = json.dumps(parameters, sort_keys=True, default=canonical)
+    parameters_hash = int.from_bytes(hashlib.sha256(text.encode()).digest()[:8], 'little')
+    return int(np.random.SeedSequence([seed, iteration, parameters_hash]).generate_state(1)[0])
+
+
+def collected_rows(number_of_rows, data_collection_period):
+    """Rows of the collector that are kept, as batch_run selects them: every period-th step and the last step"""
+    last = number_of_rows - 1
+    rows = list(range(0, number_of_rows, data_collection_period)) if data_collection_period > 0 else []
+    if not rows or rows[-1] != last:
+        rows.append(last)
+    return np.array(rows, dtype=np.int64)
+
+
+class RunResult:
+    """
+    The collected data of a single run as typed arrays.
+
+    Attributes
+    ----------
+    run_id, iteration, parameters: the run, as given by make_runs
+    steps: the collected steps
+    model_columns: dictionary {reporter: array with a value per collected step}
+    agent_ids: ids of the households, None when the agent data is not collected
+    agent_columns: dictionary {reporter: array of shape (collected steps, households)} with the encoded values
+    agent_reporters: dictionary {reporter: AgentColumn}, to decode the agent columns
+    profile: dictionary {column: array} with the profile of the run (see PhaseProfiler.columns), None when the run
+        was not profiled
+    """
+
+    def __init__(self, run_id, iteration, parameters, steps, model_columns, agent_ids=None, agent_columns=None,
+                 agent_reporters=None, profile=None):
+        self.run_id = run_id
+        self.iteration = iteration
+        self.parameters = parameters
+        self.steps = steps
+        self.model_columns = model_columns
+        self.agent_ids = agent_ids
+        self.agent_columns = agent_columns
+        self.agent_reporters = agent_reporters
+        self.profile = profile
+
+
+def create_model(kwargs, populations=None):
+    """
+    Create the model of a run. With common random numbers, the runs of an iteration have the same population, so the
+    first of them is created as usual and the others are forked from its PopulationSnapshot (see snapshot.py), which
+    gives the same model without drawing the population and generating the network again.
+
+    Parameters
+    ----------
+    kwargs: model parameters
+    populations: dictionary in which the snapshots of the last populations are kept, None to create every model as usual
+    """
+    if populations is None or not kwargs.get('common_random_numbers') or kwargs.get('seed') is None:
+        return AdaptationModel(**kwargs)
+    defaults = inspect.signature(AdaptationModel).parameters
+    key = json.dumps({name: kwargs.get(name, defaults[name].default) for name in POPULATION_PARAMETERS},
+                     sort_keys=True, default=canonical)
+    if key in populations:
+        return populations[key].fork(**{name: value for name, value in kwargs.items()
+                                        if name not in POPULATION_PARAMETERS})
+    # The runs are ordered by iteration, so only the populations of the last few runs are kept
+    if len(populations) >= MAXIMUM_POPULATIONS:
+        del populations[next(iter(populations))]
+    model = AdaptationModel(**kwargs)
+    populations[key] = PopulationSnapshot.from_model(model)
+    return model
+
+
+def run_model(run, max_steps=None, data_collection_period=-1, collect_agents=False, populations=None, profile=False,
+              profile_memory=False):
+    """
+    Run a single model until it stops or reaches max_steps (by default its number_of_steps), like batch_run does.
+    populations is passed to create_model. With profile (and profile_memory), the model is profiled per phase, see
+    profiling.py; these are not parameters of the run, so the run keeps its seed.
+
+    Returns
+    -------
+    result: RunResult with the data of the collected steps
+    """
+    run_id, iteration, kwargs = run
+    if profile or profile_memory:
+        model = create_model(dict(kwargs, profile=True, profile_memory=profile_memory), populations)
+    else:
+        model = create_model(kwargs, populations)
+    if max_steps is None:
+        max_steps = model.number_of_steps
+    while model.running and model.schedule.steps <= max_steps:
+        model.step()
+    if model.profiler is not None:
+        model.profiler.close()
+
+    collector = model.datacollector
+    rows = collected_rows(collector.number_of_rows, data_collection_period)
+    steps, agent_ids, agent_columns = collector.get_agent_vars_arrays()
+    model_columns = {name: column[rows] for name, column in collector.model_vars.items()}
+    profile = model.profiler.columns() if model.profiler is not None else None
+    if not collect_agents:
+        return RunResult(run_id, iteration, kwargs, steps[rows], model_columns, profile=profile)
+    agent_columns = {name: column[rows] for name, column in agent_columns.items()}
+    return RunResult(run_id, iteration, kwargs, steps[rows], model_columns, agent_ids, agent_columns,
+                     collector.agent_reporters, profile)
+
+
+def run_chunk(chunk, **run_options):
+    """Run a chunk of runs in a worker process, the runs of an iteration share their population (see create_model)"""
+    populations = {}
+    return [run_model(run, populations=populations, **run_options) for run in chunk]
+
+
+def initialize_worker(geometries):
+    """Start a worker process with the geometries of the parent, given as WKB"""
+    geometry.import_wkb(geometries)
+
+
+def preload_inputs(runs):
+    """Load the flood maps used by the runs, building their caches if needed, and the geometries"""
+    default_choice = inspect.signature(AdaptationModel).parameters['flood_map_choice'].default
+    for choice in {kwargs.get('flood_map_choice', default_choice) for _, _, kwargs in runs}:
+        if choice in FLOOD_MAP_PATHS:
+            load_flood_map(FLOOD_MAP_PATHS[choice])
+            # The model domain and floodplain of the flood map, which are all exported to the workers
+            choice_geometry = flood_map_geometry(choice)
+            choice_geometry.map_domain_polygon, choice_geometry.floodplain_multipolygon
+    return geometry.export_wkb()
+
+
+def iter_experiments(runs, number_processes=1, chunk_size=None, display_progress=True, cache=None, **run_options):
+    """
+    Run the given runs and yield their RunResult as soon as they are finished, so not in the order of the runs.
+
+    Parameters
+    ----------
+    runs: list of runs, see make_runs
+    number_processes: number of worker processes, None to use all CPUs, 1 to run in this process
+    chunk_size: number of runs sent to a worker at once, by default the runs are divided in about four chunks per
+        worker
+    display_progress: show a progress bar with the number of runs per second
+    cache: optional ResultCache, or the directory of one. Runs that are in the cache are not run again, and every
+        finished run is added to it
+    run_options: max_steps, data_collection_period, collect_agents, profile and profile_memory, see run_model. The
+        profile of a cached run is the profile of the run that was cached
+    """
+    if isinstance(cache, (str, os.PathLike)):
+        cache = ResultCache(cache)
+    cached = []
+    if cache is not None:
+        # Every run is hashed once, to find out whether it is in the cache
+        missing = []
+        for run in runs:
+            (cached if cache.contains(run[2], run_options) else missing).append(run)
+        runs = missing
+    geometries = preload_inputs(runs)
+    if number_processes is None:
+        number_processes = os.cpu_count()
+    if chunk_size is None:
+        chunk_size = max(1, math.ceil(len(runs) / (4 * number_processes)))
+    chunks = [runs[start:start + chunk_size] for start in range(0, len(runs), chunk_size)]
+
+    for run in cached:
+        yield cache.get(run, run_options)
+    with tqdm(total=len(runs), unit='run', disable=not display_progress) as progress:
+        for result in run_chunks(chunks, number_processes, geometries, run_options):
+            if cache is not None:
+                cache.put(result, run_options)
+            progress.update()
+            yield result
+
+
+def run_chunks(chunks, number_processes, geometries, run_options):
+    """Run chunks of runs, in this process or on a pool of worker processes, and yield their results"""
+    if number_processes == 1:
+        for chunk in chunks:
+            yield from run_chunk(chunk, **run_options)
+    else:
+        with Pool(number_processes, initializer=initialize_worker, initargs=(geometries,)) as pool:
+            for results in pool.imap_unordered(partial(run_chunk, **run_options), chunks):
+                yield from results
+
+
+def run_experiments(parameters, iterations=1, number_processes=1, chunk_size=None, data_collection_period=-1,
+                    max_steps=None, collect_agents=False, seed=None, display_progress=True, cache=None,
+                    profile=False, profile_memory=False):
+    """
+    Run every combination of the parameter values for a number of iterations, in parallel. The parameters have the
+    same meaning as for mesa's batch_run, see make_runs, run_model and iter_experiments.
+
+    Returns
+    -------
+    results: ExperimentResults
+    """
+    runs = make_runs(parameters, iterations, seed)
+    start = time.perf_counter()
+    results = list(iter_experiments(runs, number_processes, chunk_size, display_progress, cache,
+                                    max_steps=max_steps, data_collection_period=data_collection_period,
+                                    collect_agents=collect_agents, profile=profile, profile_memory=profile_memory))
+    return ExperimentResults(results, time.perf_counter() - start, parameters=parameters)
+
+
+def write_experiments(parameters, output_dir, iterations=1, number_processes=1, chunk_size=None,
+                      data_collection_period=-1, max_steps=None, collect_agents=False, seed=None,
+                      display_progress=True, cache=None, profile=False, profile_memory=False, overwrite=False):
+    """
+    Run an experiment like run_experiments, but write every run to a Parquet dataset in output_dir as soon as it is
+    finished instead of keeping the results in memory (see result_store.py). Read them with read_results, and the
+    profiles of profiled runs with read_results(output_dir, 'profile'). The results of an earlier experiment in
+    output_dir are only replaced with overwrite=True.
+
+    Returns
+    -------
+    results: ExperimentResults with the throughput, without the results themselves
+    """
+    swept = {name: list(values) for name, values in parameters.items() if is_swept(values)}
+    fixed = {name: values for name, values in parameters.items() if not is_swept(values)}
+    writer = ParquetResultWriter(output_dir, swept, fixed, overwrite)
+    runs = make_runs(parameters, iterations, seed)
+    start = time.perf_counter()
+    for result in iter_experiments(runs, number_processes, chunk_size, display_progress, cache,
+                                   max_steps=max_steps, data_collection_period=data_collection_period,
+                                   collect_agents=collect_agents, profile=profile, profile_memory=profile_memory):
+        writer.write(result)
+    return ExperimentResults([], time.perf_counter() - start, writer.number_of_runs)
+
+
+class ExperimentResults:
+    """
+    The results of all runs of an experiment, ordered by run id.
+
+    Attributes
+    ----------
+    results: list of RunResult, empty when the results were written to disk by write_experiments
+    parameters: the parameters of the experiment, which give the columns of the DataFrames when there are no results
+    number_of_runs: number of finished runs
+    elapsed: wall time of the experiment in seconds
+    runs_per_second: throughput of the experiment
+    """
+
+    def __init__(self, results, elapsed, number_of_runs=None, parameters=None):
+        self.results = sorted(results, key=lambda result: result.run_id)
+        self.parameters = {} if parameters is None else parameters
+        self.elapsed = elapsed
+        self.number_of_runs = len(results) if number_of_runs is None else number_of_runs
+        self.runs_per_second = self.number_of_runs / elapsed if elapsed > 0 else math.inf
+
+    def run_columns(self, lengths, results=None):
+        """RunId, iteration and parameter columns, with every run (by default of all results) repeated for its
+        number of rows"""
+        results = self.results if results is None else results
+        columns = {'RunId': np.repeat([result.run_id for result in results], lengths),
+                   'iteration': np.repeat([result.iteration for result in results], lengths)}
+        names = dict.fromkeys(name for result in results for name in result.parameters)
+        for name in names:
+            values = np.empty(len(results), dtype=object)
+            values[:] = [result.parameters.get(name) for result in results]
+            columns[name] = np.repeat(values, lengths)
+        return columns
+
+    def model_vars_dataframe(self):
+        """DataFrame with a row per run and collected step: RunId, iteration, Step, the parameters and the reporters"""
+        if not self.results:
+            return pd.DataFrame(columns=['RunId', 'iteration', *self.parameters, 'Step', *self.reporter_names()])
+        lengths = [len(result.steps) for result in self.results]
+        columns = self.run_columns(lengths)
+        columns['Step'] = np.concatenate([result.steps for result in self.results])
+        for name in self.results[0].model_columns:
+            columns[name] = np.concatenate([result.model_columns[name] for result in self.results])
+        return pd.DataFrame(columns).infer_objects()
+
+    def reporter_names(self):
+        """The names of the model reporters of the runs of the parameters, for every swept schema and flood events"""
+        defaults = inspect.signature(AdaptationModel).parameters
+        options = {name: self.parameters.get(name, defaults[name].default)
+                   for name in ('reporter_schema', 'flood_events')}
+        names = {}
+        for combination in parameter_combinations(options):
+            names.update(dict.fromkeys(model_reporter_names(**combination)))
+        return list(names)
+
+    def agent_vars_dataframe(self):
+        """DataFrame with a row per run, collected step and household, only when the agent data was collected"""
+        lengths = [result.agent_columns[next(iter(result.agent_columns))].size for result in self.results]
+        columns = self.run_columns(lengths)
+        columns['Step'] = np.concatenate([np.repeat(result.steps, len(result.agent_ids)) for result in self.results])
+        columns['AgentID'] = np.concatenate([np.tile(result.agent_ids, len(result.steps)) for result in self.results])
+        for name, reporter in self.results[0].agent_reporters.items():
+            decoded = []
+            for result in self.results:
+                suffix = result.agent_columns[reporter.step_suffix] if reporter.step_suffix else None
+                decoded.append(reporter.decode(result.agent_columns[name], suffix).reshape(-1))
+            columns[name] = np.concatenate(decoded)
+        return pd.DataFrame(columns).infer_objects()
+
+    def profile_dataframe(self):
+        """
+        DataFrame with a row per profiled run, step and phase: RunId, iteration, the parameters and the profile columns
+        (see profiling.py), only when the runs were profiled. Aggregate it with profiling.summarize.
+        """
+        profiled = [result for result in self.results if result.profile is not None]
+        lengths = [len(result.profile['Step']) for result in profiled]
+        columns = self.run_columns(lengths, profiled)
+        for name in PROFILE_COLUMNS:
+            columns[name] = np.concatenate([result.profile[name] for result in profiled])
+        return pd.DataFrame(columns).infer_objects()
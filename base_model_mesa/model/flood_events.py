@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+"""
+Ensembles of recurring flood events for the Flood Adaptation Model.
+
+By default the model has a single flood at flood_step, after which it stops. With AdaptationModel(flood_events={...}),
+floods recur during the whole run instead, so a run covers decades of flood risk:
+- Every step, a flood event happens with probability rate. The time to the next event is drawn after every event.
+- The depths of an event are taken from a flood map: the estimated flood depths of the households (the flood map of
+  the model, minus their adaptation), or, with maps, one of the flood maps drawn with the given weights, at the
+  locations of the households minus their adaptation depth.
+- The depths are multiplied by the intensity of the event, uniform in intensity_range (as the single flood), and by
+  a spatially correlated lognormal field with mean 1 and standard deviation variability of its logarithm, whose
+  correlation decreases as exp(-d^2 / (2 * correlation_length^2)) with distance d in meters. The field is a sum of
+  random cosines (random Fourier features, as many as features), so drawing it takes the same random numbers however
+  many households there are.
+- Every event is applied to all households at once with the depth-damage function of the model. The households keep
+  the depth and damage of the last event as flood_depth_actual and flood_damage_actual, and the FloodHistory holds the
+  depth and damage of every household in every event as float32 arrays.
+
+The events are drawn from the 'flood' random stream while the model runs, so models with common random numbers have
+the same events whatever their policy. The households continue to step after an event.
+
+Example:
+    model = AdaptationModel(number_of_steps=160, flood_events={'rate': 0.02, 'maps': {'100yr': 4, '500yr': 1}})
+    model.model_run()
+    model.flood_ensemble.history.events()
+"""
+import numpy as np
+import pandas as pd
+
+# The parameters of an ensemble with their default values
+FLOOD_EVENT_PARAMETERS = {
+    'rate': 0.01,
+    'maps': None,
+    'intensity_range': (0.5, 1.2),
+    'variability': 0.3,
+    'correlation_length': 5000,
+    'features': 64,
+}
+
+# Number of features of the intensity field that are evaluated at once, to bound the memory of the evaluation
+FEATURE_CHUNK = 16
+
+
+class FloodHistory:
+    """
+    The flood events of a run and the depth and damage of every household in every event.
+
+    Parameters
+    ----------
+    number_of_households: number of households of the model
+
+    Attributes
+    ----------
+    steps: step of every event
+    maps: flood map choice of every event, None when the estimated depths were used
+    intensities: intensity of every event
+    depths, damages: lists with an array of the depths and damages of all households per event (float32)
+    """
+
+    def __init__(self, number_of_households):
+        self.number_of_households = number_of_households
+        self.steps = []
+        self.maps = []
+        self.intensities = []
+        self.depths = []
+        self.damages = []
+
+    def __len__(self):
+        return len(self.steps)
+
+    def record(self, step, flood_map, intensity, depths, damages):
+        self.steps.append(step)
+        self.maps.append(flood_map)
+        self.intensities.append(intensity)
+        self.depths.append(np.asarray(depths, dtype=np.float32))
+        self.damages.append(np.asarray(damages, dtype=np.float32))
+
+    def depth_matrix(self):
+        """The depths as an array of shape (events, households)"""
+        return np.array(self.depths, dtype=np.float32).reshape(len(self), self.number_of_households)
+
+    def damage_matrix(self):
+        """The damages as an array of shape (events, households)"""
+        return np.array(self.damages, dtype=np.float32).reshape(len(self), self.number_of_households)
+
+    def cumulative_damage(self):
+        """Total damage of every household over all events"""
+        return self.damage_matrix().sum(axis=0, dtype=np.float64)
+
+    def total_damage(self):
+        return float(sum(damages.sum(dtype=np.float64) for damages in self.damages))
+
+    def events(self):
+        """DataFrame with a row per event: Step, Map, Intensity, FloodedHouseholds, TotalDamage and MaxDepth"""
+        return pd.DataFrame({
+            'Step': np.array(self.steps, dtype=np.int64),
+            'Map': self.maps,
+            'Intensity': self.intensities,
+            'FloodedHouseholds': [int(np.count_nonzero(damages > 0)) for damages in self.damages],
+            'TotalDamage': [damages.sum(dtype=np.float64) for damages in self.damages],
+            'MaxDepth': [depths.max() if len(depths) else np.nan for depths in self.depths],
+        })
+
+    def dataframe(self, agent_ids=None):
+        """DataFrame with a row per event and household: Step, AgentID, FloodDepth and FloodDamage"""
+        if agent_ids is None:
+            agent_ids = np.arange(self.number_of_households)
+        return pd.DataFrame({'Step': np.repeat(np.array(self.steps, dtype=np.int64), self.number_of_households),
+                             'AgentID': np.tile(agent_ids, len(self)),
+                             'FloodDepth': self.depth_matrix().reshape(-1),
+                             'FloodDamage': self.damage_matrix().reshape(-1)})
+
+    def arrays(self):
+        """The history as arrays, e.g. for a checkpoint"""
+        return {'steps': np.array(self.steps, dtype=np.int64),
+                'maps': np.array(['' if flood_map is None else flood_map for flood_map in self.maps], dtype=str),
+                'intensities': np.array(self.intensities, dtype=np.float64),
+                'depths': self.depth_matrix(), 'damages': self.damage_matrix()}
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        history = cls(arrays['depths'].shape[1])
+        history.steps = arrays['steps'].tolist()
+        history.maps = [flood_map or None for flood_map in arrays['maps'].tolist()]
+        history.intensities = arrays['intensities'].tolist()
+        history.depths = list(arrays['depths'])
+        history.damages = list(arrays['damages'])
+        return history
+
+
+class FloodEnsemble:
+    """
+    Draws the recurring flood events of a model, see the module description.
+
+    Parameters
+    ----------
+    flood_events: dictionary with the FLOOD_EVENT_PARAMETERS that differ from their defaults
+    flood_map_paths: dictionary {flood map choice: path}, to check the maps of the events
+    number_of_households: number of households of the model
+
+    Attributes
+    ----------
+    next_event: the step of the next event, None until it is drawn in the first step
+    history: FloodHistory
+    """
+
+    def __init__(self, flood_events, flood_map_paths, number_of_households):
+        unknown = [name for name in flood_events if name not in FLOOD_EVENT_PARAMETERS]
+        if unknown:
+            raise ValueError(f"Unknown flood event parameters: {unknown}. "
+                             f"The parameters are: {list(FLOOD_EVENT_PARAMETERS.keys())}")
+        parameters = dict(FLOOD_EVENT_PARAMETERS, **flood_events)
+        if not 0 < parameters['rate'] <= 1:
+            raise ValueError(f"The rate of flood events is a probability per step, not {parameters['rate']}")
+        self.rate = parameters['rate']
+        self.intensity_range = tuple(parameters['intensity_range'])
+        self.variability = parameters['variability']
+        self.correlation_length = parameters['correlation_length']
+        self.features = parameters['features']
+        self.maps = None
+        if parameters['maps'] is not None:
+            for choice in parameters['maps']:
+                if choice not in flood_map_paths:
+                    raise ValueError(f"Unknown flood map choice: '{choice}'. "
+                                     f"Currently implemented choices are: {list(flood_map_paths.keys())}")
+            weights = np.array(list(parameters['maps'].values()), dtype=float)
+            self.maps = list(parameters['maps'])
+            self.map_probabilities = weights / weights.sum()
+        self.flood_map_paths = flood_map_paths
+        # Depths of every flood map at the locations of the households, which do not move
+        self.map_depths = {}
+        self.next_event = None
+        self.history = FloodHistory(number_of_households)
+
+    def draw_next_event(self, step, rng):
+        """Draw the step of the next event after step"""
+        self.next_event = step + int(rng.geometric(self.rate))
+        return self.next_event
+
+    def intensity_field(self, x, y, rng):
+        """
+        A lognormal field with mean 1 at the locations x, y, see the module description. All random numbers are drawn
+        before the field is evaluated, in chunks of features.
+        """
+        frequencies = rng.normal(0, 1 / self.correlation_length, size=(self.features, 2))
+        phases = rng.uniform(0, 2 * np.pi, size=self.features)
+        if self.variability == 0:
+            return 1
+        # The coordinates are centred, so the phases stay small
+        x = x - x.mean()
+        y = y - y.mean()
+        field = np.zeros(len(x))
+        for start in range(0, self.features, FEATURE_CHUNK):
+            chunk = slice(start, start + FEATURE_CHUNK)
+            field += np.cos(np.multiply.outer(x, frequencies[chunk, 0]) + np.multiply.outer(y, frequencies[chunk, 1])
+                            + phases[chunk]).sum(axis=1)
+        field *= np.sqrt(2 / self.features)
+        return np.exp(self.variability * field - self.variability ** 2 / 2)
+
+    def map_depth(self, choice, x, y):
+        """The depths of a flood map at the locations of the households"""
+        if choice not in self.map_depths:
+            from flood_map_cache import load_flood_map
+            from functions import get_flood_depths, get_flood_map_data
+            flood_map = load_flood_map(self.flood_map_paths[choice])
+            self.map_depths[choice] = get_flood_depths(flood_map, x, y, get_flood_map_data(flood_map)[0])
+        return self.map_depths[choice]
+
+    def draw_event(self, rng, x, y, flood_depth_estimated, adaptation_depth):
+        """
+        Draw an event and return the depth of every household
+
+        Returns
+        -------
+        flood_map: the flood map choice of the event, None for the estimated depths
+        intensity: the intensity of the event
+        depths: array with the flood depth of every household
+        """
+        flood_map = None
+        if self.maps is not None:
+            flood_map = self.maps[rng.choice(len(self.maps), p=self.map_probabilities)]
+        intensity = rng.uniform(*self.intensity_range)
+        field = self.intensity_field(x, y, rng)
+        if flood_map is None:
+            depths = flood_depth_estimated
+        else:
+            depths = np.maximum(self.map_depth(flood_map, x, y) - adaptation_depth, 0)
+        return flood_map, intensity, intensity * field * depths
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+"""
+Persistent cache of the flood maps.
+
+Decoding a flood map GeoTIFF for every model instance is slow and gives every batch_run worker its own copy of the band.
+The first time a flood map is loaded, its band is written to a raw .npy file with a .json sidecar holding the affine
+transform, bounds and nodata value. Later loads, in any process, memory-map the .npy file read-only, so all workers
+share one copy in the page cache of the operating system.
+The cache is rebuilt when the modification time and size of the source file have changed and its SHA-256 hash no longer
+matches the hash stored in the sidecar.
+"""
+import hashlib
+import json
+import math
+import os
+from collections import namedtuple
+
+import numpy as np
+from affine import Affine
+
+# Increase when the layout of the cache files changes, so old cache files are rebuilt
+CACHE_VERSION = 1
+
+Bounds = namedtuple('Bounds', ['left', 'bottom', 'right', 'top'])
+
+# Flood maps loaded in this process, by path of the source file
+_loaded_flood_maps = {}
+
+
+class FloodMap:
+    """
+    Read-only flood map backed by the cache. It offers the parts of a rasterio dataset that the model uses
+    (read, bounds, index, transform, nodata), so it can be passed to get_flood_map_data and get_flood_depth.
+    """
+
+    def __init__(self, band, transform, nodata=None, crs=None, name=None):
+        self.band = band
+        self.transform = transform
+        self.nodata = nodata
+        self.crs = crs
+        self.name = name
+        self.height, self.width = band.shape
+        left, top = transform @ (0, 0)
+        right, bottom = transform @ (self.width, self.height)
+        self.bounds = Bounds(min(left, right), min(bottom, top), max(left, right), max(bottom, top))
+
+    def read(self, band_number=1):
+        """Return the band, like rasterio's read. The flood maps have a single band"""
+        if band_number != 1:
+            raise ValueError(f"The flood maps have a single band, band {band_number} does not exist")
+        return self.band
+
+    def index(self, x, y):
+        """Return the (row, col) of the pixel containing (x, y), like rasterio's index"""
+        col, row = ~self.transform @ (x, y)
+        return math.floor(row), math.floor(col)
+
+    def close(self):
+        """Nothing to close, the band stays mapped as long as it is referenced"""
+
+
+def file_hash(path):
+    """Return the SHA-256 hash of a file"""
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def cache_paths(path, cache_dir=None):
+    """Return the paths of the cached band and its sidecar for a flood map"""
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(path), 'cache')
+    name = os.path.splitext(os.path.basename(path))[0]
+    return os.path.join(cache_dir, name + '.npy'), os.path.join(cache_dir, name + '.json')
+
+
+def write_atomic(path, write):
+    """Write a file through a temporary file, so other processes never see a half written file"""
+    temporary_path = f'{path}.{os.getpid()}.tmp'
+    with open(temporary_path, 'wb') as file:
+        write(file)
+    os.replace(temporary_path, path)
+
+
+def build_cache(path, band_path, sidecar_path, source_hash=None):
+    """Decode the flood map once and write its band and sidecar to the cache"""
+    # rasterio is only imported when the cache has to be built
+    import rasterio as rs
+    with rs.open(path) as flood_map:
+        band = flood_map.read(1)
+        stat = os.stat(path)
+        sidecar = {
+            'version': CACHE_VERSION,
+            'source_mtime_ns': stat.st_mtime_ns,
+            'source_size': stat.st_size,
+            'source_sha256': source_hash or file_hash(path),
+            'transform': list(flood_map.transform)[:6],
+            'nodata': flood_map.nodata,
+            'crs': flood_map.crs.to_wkt() if flood_map.crs else None,
+            'shape': list(band.shape),
+            'dtype': str(band.dtype),
+        }
+    os.makedirs(os.path.dirname(band_path), exist_ok=True)
+    write_atomic(band_path, lambda file: np.save(file, band))
+    # The sidecar is written last, a cache entry is only valid once its sidecar exists
+    write_atomic(sidecar_path, lambda file: file.write(json.dumps(sidecar, indent=1).encode()))
+    return sidecar
+
+
+def read_valid_sidecar(path, band_path, sidecar_path):
+    """Return the sidecar of the cached flood map if it is still valid for the source file, otherwise None"""
+    if not (os.path.exists(sidecar_path) and os.path.exists(band_path)):
+        return None
+    with open(sidecar_path) as file:
+        sidecar = json.load(file)
+    if sidecar.get('version') != CACHE_VERSION:
+        return None
+    stat = os.stat(path)
+    if sidecar['source_mtime_ns'] == stat.st_mtime_ns and sidecar['source_size'] == stat.st_size:
+        return sidecar
+    # The file was touched or copied: only rebuild when the content has changed as well
+    source_hash = file_hash(path)
+    if sidecar['source_sha256'] != source_hash:
+        return None
+    sidecar['source_mtime_ns'], sidecar['source_size'] = stat.st_mtime_ns, stat.st_size
+    write_atomic(sidecar_path, lambda file: file.write(json.dumps(sidecar, indent=1).encode()))
+    return sidecar
+
+
+def load_flood_map(path, cache_dir=None):
+    """
+    Load a flood map through the cache.
+
+    Parameters
+    ----------
+    path: path of the flood map in tif format
+    cache_dir: directory of the cache files, by default a 'cache' directory next to the flood map
+
+    Returns
+    -------
+    flood_map: FloodMap with a read-only memory-mapped band
+    """
+    stat = os.stat(path)
+    loaded = _loaded_flood_maps.get(path)
+    if loaded is not None and loaded[0] == (stat.st_mtime_ns, stat.st_size):
+        return loaded[1]
+
+    band_path, sidecar_path = cache_paths(path, cache_dir)
+    sidecar = read_valid_sidecar(path, band_path, sidecar_path)
+    if sidecar is None:
+        sidecar = build_cache(path, band_path, sidecar_path)
+
+    band = np.load(band_path, mmap_mode='r')
+    flood_map = FloodMap(band, Affine(*sidecar['transform']), nodata=sidecar['nodata'], crs=sidecar['crs'],
+                         name=path)
+    _loaded_flood_maps[path] = ((sidecar['source_mtime_ns'], sidecar['source_size']), flood_map)
+    return flood_map
@@ -9,10 +9,10 @@ import random
 import numpy as np
 import math
 from shapely import contains_xy
-from shapely import prepare
-import geopandas as gpd
 import os
 
+from geometry import GeometryRegistry
+
 
 def set_initial_values(input_data, parameter, seed):
     """
@@ -73,40 +73,84 @@ def get_flood_map_data(flood_map):
 shapefile_path = r'../input_data/model_domain/houston_model/houston_model.shp'
 floodplain_path = r'../input_data/floodplain/floodplain_area.shp'
 
-# Model area setup
-map_domain_gdf = gpd.GeoDataFrame.from_file(shapefile_path)
-map_domain_gdf = map_domain_gdf.to_crs(epsg=26915)
-map_domain_geoseries = map_domain_gdf['geometry']
-map_minx, map_miny, map_maxx, map_maxy = map_domain_geoseries.total_bounds
-map_domain_polygon = map_domain_geoseries[0]  # The geoseries contains only one polygon
-prepare(map_domain_polygon)
+# Model area and floodplain setup, the shapefiles are only read when the geometries are first used
+geometry = GeometryRegistry(shapefile_path, floodplain_path, epsg=26915)
+
+# The geometries used to be created when this file was imported, they are still available under their old names
+_legacy_geometry_names = {
+    'map_domain_gdf': lambda: geometry.map_domain_gdf,
+    'map_domain_polygon': lambda: geometry.map_domain_polygon,
+    'map_minx': lambda: geometry.map_bounds[0],
+    'map_miny': lambda: geometry.map_bounds[1],
+    'map_maxx': lambda: geometry.map_bounds[2],
+    'map_maxy': lambda: geometry.map_bounds[3],
+    'floodplain_gdf': lambda: geometry.floodplain_gdf,
+    'floodplain_multipolygon': lambda: geometry.floodplain_multipolygon,
+}
+
 
-# Floodplain setup
-floodplain_gdf = gpd.GeoDataFrame.from_file(floodplain_path)
-floodplain_gdf = floodplain_gdf.to_crs(epsg=26915)
-floodplain_geoseries = floodplain_gdf['geometry']
-floodplain_multipolygon = floodplain_geoseries[0]  # The geoseries contains only one multipolygon
-prepare(floodplain_multipolygon)
+def __getattr__(name):
+    if name in _legacy_geometry_names:
+        return _legacy_geometry_names[name]()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 def generate_random_location_within_map_domain(model):
     """
-    Generate random location coordinates within the map domain polygon.
+    Generate random location coordinates within the map domain polygon of the model (model.geometry).
 
     Returns
     -------
     x, y: lists of location coordinates, longitude and latitude
     """
 
+    map_minx, map_miny, map_maxx, map_maxy = model.geometry.map_bounds
     while True:
         # generate random location coordinates within square area of map domain
-        x = model.random.uniform(map_minx, map_maxx)
-        y = model.random.uniform(map_miny, map_maxy)
+        x = model.random_stream('placement').uniform(map_minx, map_maxx)
+        y = model.random_stream('placement').uniform(map_miny, map_maxy)
         # check if the point is within the polygon, if so, return the coordinates
-        if contains_xy(map_domain_polygon, x, y):
+        if contains_xy(model.geometry.map_domain_polygon, x, y):
             return x, y
 
 
+def generate_random_locations_within_map_domain(model, number_of_locations):
+    """
+    Generate many random locations within the map domain polygon of the model (model.geometry) at once.
+    Candidate locations are drawn in batches within the square area of the map domain and tested with one contains_xy
+    call per batch, until enough locations are accepted. The draws come from the numpy random generator of the model
+    for the placement, so the locations are the same for the same model seed.
+
+    Parameters
+    ----------
+    model: the model, whose numpy_stream('placement') is used for the draws and whose geometry is used
+    number_of_locations: number of locations to generate
+
+    Returns
+    -------
+    x, y: arrays of location coordinates
+    in_floodplain: array telling for every location whether it lies within the floodplain
+    """
+    map_domain_polygon = model.geometry.map_domain_polygon
+    map_minx, map_miny, map_maxx, map_maxy = model.geometry.map_bounds
+    # Share of the square area that lies within the polygon, to estimate how many candidates are needed
+    rng = model.numpy_stream('placement')
+    acceptance = map_domain_polygon.area / ((map_maxx - map_minx) * (map_maxy - map_miny))
+    x_batches, y_batches = [], []
+    remaining = number_of_locations
+    while remaining > 0:
+        batch_size = int(remaining / acceptance * 1.1) + 16
+        x = rng.uniform(map_minx, map_maxx, batch_size)
+        y = rng.uniform(map_miny, map_maxy, batch_size)
+        inside = contains_xy(map_domain_polygon, x, y)
+        x_batches.append(x[inside][:remaining])
+        y_batches.append(y[inside][:remaining])
+        remaining -= len(x_batches[-1])
+    x = np.concatenate(x_batches) if x_batches else np.zeros(0)
+    y = np.concatenate(y_batches) if y_batches else np.zeros(0)
+    return x, y, contains_xy(model.geometry.floodplain_multipolygon, x, y)
+
+
 def get_flood_depth(corresponding_map, location, band):
     """ 
     To get the flood depth of a specific location within the model domain.
@@ -126,6 +170,38 @@ def get_flood_depth(corresponding_map, location, band):
     depth = band[row - 1, col - 1]
     return depth
 
+def get_flood_depths(corresponding_map, x, y, band, fill_value=0):
+    """
+    To get the flood depths of many locations at once, with one affine inverse and one fancy index into the band.
+    The same pixel is used as in get_flood_depth.
+
+    Parameters
+    ----------
+    corresponding_map: flood map used, with the affine transform of the band
+    x, y: arrays of location coordinates on the map
+    band: band from the flood map
+    fill_value: depth given to locations outside the flood map and to pixels with the nodata value of the map
+
+    Returns
+    -------
+    depths: array of flood depths at the given locations
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    inverse = ~corresponding_map.transform
+    col = np.floor(inverse.a * x + inverse.b * y + inverse.c).astype(np.int64) - 1
+    row = np.floor(inverse.d * x + inverse.e * y + inverse.f).astype(np.int64) - 1
+
+    depths = np.full(x.shape, fill_value, dtype=float)
+    # Locations outside the band are not looked up, instead of wrapping around to the other side of the band
+    inside = (row >= 0) & (row < band.shape[0]) & (col >= 0) & (col < band.shape[1])
+    depths[inside] = band[row[inside], col[inside]]
+    nodata = corresponding_map.nodata
+    if nodata is not None:
+        is_nodata = np.isnan(depths) if np.isnan(nodata) else depths == nodata
+        depths[inside & is_nodata] = fill_value
+    return depths
+
 def get_position_flood(bound_l, bound_r, bound_t, bound_b, img, seed):
     """ 
     To generater the position on flood map for a household.
@@ -172,6 +248,29 @@ def calculate_basic_flood_damage(flood_depth, housesize):
         flood_damage = (0.1746 * math.log(flood_depth) + 0.6483) * 788 * housesize
     return flood_damage
 
+def calculate_basic_flood_damage_array(flood_depths, housesizes):
+    """
+    Array version of calculate_basic_flood_damage, used by the vectorized household engine.
+    Gives the same damage as the scalar function for every element.
+
+    Parameters
+    ----------
+    flood_depths : array of flood depths
+    housesizes : array of house sizes in m2 (broadcast against flood_depths)
+
+    Returns
+    -------
+    flood_damages : array of flood damages
+    """
+    flood_depths, housesizes = np.broadcast_arrays(np.asarray(flood_depths, dtype=float),
+                                                   np.asarray(housesizes, dtype=float))
+    damage_factor = np.zeros(flood_depths.shape)
+    damage_factor[flood_depths >= 6] = 1
+    # The logarithm is only taken on the part of the curve where it is used
+    on_curve = (flood_depths >= 0.025) & (flood_depths < 6)
+    damage_factor[on_curve] = 0.1746 * np.log(flood_depths[on_curve]) + 0.6483
+    return damage_factor * 788 * housesizes
+
 def calculate_subsidies_received(optimal_measure, cost_of_adaptation, housesize):
     standard_adaptation_measures = {'Sandbags': [0.2, 5], 'Drains': [0.7, 30], 'Heightening': [2.5, 585]}
     actual_cost_of_adaptation = standard_adaptation_measures[optimal_measure][1]*housesize
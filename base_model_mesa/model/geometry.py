@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""
+Lazily loaded geometries of the model domain and the floodplain.
+
+Reading the shapefiles with geopandas and reprojecting them takes a while, so it is no longer done when functions.py
+is imported. The geometries are loaded on first use, and the projected geometries are stored as WKB in a 'cache'
+directory next to each shapefile. Later loads, also in other batch_run workers, read the WKB file and do not need
+geopandas at all. A cached geometry is rebuilt when one of the files of its shapefile changes.
+"""
+import json
+import os
+
+from shapely import from_wkb, prepare, to_wkb
+
+from flood_map_cache import write_atomic
+
+# Increase when the layout of the cache files changes, so old cache files are rebuilt
+CACHE_VERSION = 1
+
+# Files that together make up a shapefile, a change in any of them invalidates the cached geometry
+SHAPEFILE_EXTENSIONS = ('.shp', '.shx', '.dbf', '.prj')
+
+
+def shapefile_state(path):
+    """Return the modification time and size of every file of a shapefile"""
+    stem = os.path.splitext(path)[0]
+    state = {}
+    for extension in SHAPEFILE_EXTENSIONS:
+        if os.path.exists(stem + extension):
+            stat = os.stat(stem + extension)
+            state[extension] = [stat.st_mtime_ns, stat.st_size]
+    return state
+
+
+def load_geometry(path, epsg, cache_dir=None):
+    """
+    Load the first geometry of a shapefile, projected to the given EPSG code, through the WKB cache.
+
+    Parameters
+    ----------
+    path: path of the shapefile
+    epsg: EPSG code of the projection used in the model
+    cache_dir: directory of the cache files, by default a 'cache' directory next to the shapefile
+
+    Returns
+    -------
+    geometry: shapely geometry (not yet prepared)
+    """
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(path), 'cache')
+    name = os.path.splitext(os.path.basename(path))[0]
+    wkb_path = os.path.join(cache_dir, f'{name}_{epsg}.wkb')
+    sidecar_path = os.path.join(cache_dir, f'{name}_{epsg}.json')
+    state = shapefile_state(path)
+
+    if os.path.exists(wkb_path) and os.path.exists(sidecar_path):
+        with open(sidecar_path) as file:
+            sidecar = json.load(file)
+        if sidecar.get('version') == CACHE_VERSION and sidecar.get('source_state') == state:
+            with open(wkb_path, 'rb') as file:
+                return from_wkb(file.read())
+
+    # geopandas is only imported when the cache has to be built
+    import geopandas as gpd
+    gdf = gpd.GeoDataFrame.from_file(path).to_crs(epsg=epsg)
+    geometry = gdf['geometry'][0]  # The shapefiles of the model contain a single (multi)polygon
+
+    os.makedirs(cache_dir, exist_ok=True)
+    write_atomic(wkb_path, lambda file: file.write(to_wkb(geometry)))
+    # The sidecar is written last, a cache entry is only valid once its sidecar exists
+    sidecar = {'version': CACHE_VERSION, 'source_state': state}
+    write_atomic(sidecar_path, lambda file: file.write(json.dumps(sidecar, indent=1).encode()))
+    return geometry
+
+
+class GeometryRegistry:
+    """
+    The geometries of a model domain and floodplain, each loaded and prepared the first time it is used.
+    """
+
+    def __init__(self, shapefile_path, floodplain_path, epsg=26915, cache_dir=None):
+        self.paths = {'map_domain': shapefile_path, 'floodplain': floodplain_path}
+        self.epsg = epsg
+        self.cache_dir = cache_dir
+        # Loaded geometries by the absolute path of their shapefile, shared with the registries of with_paths
+        self._geometries = {}
+
+    def with_paths(self, shapefile_path, floodplain_path):
+        """
+        A registry of other shapefiles, e.g. the synthetic inputs of benchmark.py, that shares the loaded geometries
+        with this registry. This registry keeps its own shapefiles.
+        """
+        registry = GeometryRegistry(shapefile_path, floodplain_path, self.epsg, self.cache_dir)
+        registry._geometries = self._geometries
+        return registry
+
+    def geometry(self, name):
+        """Return a prepared geometry, loading it on first use"""
+        path = os.path.abspath(self.paths[name])
+        if path not in self._geometries:
+            geometry = load_geometry(path, self.epsg, self.cache_dir)
+            prepare(geometry)
+            self._geometries[path] = geometry
+        return self._geometries[path]
+
+    def geodataframe(self, name):
+        """Return a geometry as a GeoDataFrame, which is only needed for plotting"""
+        import geopandas as gpd
+        return gpd.GeoDataFrame(geometry=[self.geometry(name)], crs=f'EPSG:{self.epsg}')
+
+    def export_wkb(self):
+        """Return all loaded geometries as WKB {path: WKB}, e.g. to hand them to worker processes once"""
+        return {path: to_wkb(geometry) for path, geometry in self._geometries.items()}
+
+    def import_wkb(self, geometries):
+        """Use geometries that were exported with export_wkb, instead of loading them again"""
+        for path, wkb in geometries.items():
+            geometry = from_wkb(wkb)
+            prepare(geometry)
+            self._geometries[path] = geometry
+
+    @property
+    def map_domain_polygon(self):
+        return self.geometry('map_domain')
+
+    @property
+    def floodplain_multipolygon(self):
+        return self.geometry('floodplain')
+
+    @property
+    def map_bounds(self):
+        """(minx, miny, maxx, maxy) of the map domain"""
+        return self.map_domain_polygon.bounds
+
+    @property
+    def map_domain_gdf(self):
+        return self.geodataframe('map_domain')
+
+    @property
+    def floodplain_gdf(self):
+        return self.geodataframe('floodplain')
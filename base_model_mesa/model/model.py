@@ -3,17 +3,74 @@ import networkx as nx
 from mesa import Model, Agent
 from mesa.time import RandomActivation, BaseScheduler
 from mesa.space import NetworkGrid
-from mesa.datacollection import DataCollector
-import rasterio as rs
-import matplotlib.pyplot as plt
-import random
+import numpy as np
 
 # Import the agent class(es) from agents.py
 from agents import Households
+from vectorized import HouseholdArrays, HouseholdView, INCOME_LABELS, MEASURES
+from neighbour_index import NeighbourIndex, graph_edges
+from network_generation import network_edges
 
 # Import functions from functions.py
-from functions import get_flood_map_data, calculate_basic_flood_damage
-from functions import map_domain_gdf, floodplain_gdf
+from functions import get_flood_map_data
+from functions import generate_random_locations_within_map_domain, get_flood_depths
+from functions import geometry
+from flood_map_cache import load_flood_map
+from depth_damage import load_depth_damage_function
+from data_collection import ColumnarDataCollector, AgentColumn
+from aggregation import IncomeLabelTotals, COLUMN_LABELS, COLUMNS
+from random_streams import RandomStreams
+from snapshot import set_random_states
+from profiling import PhaseProfiler, NO_PHASE
+from flood_events import FloodEnsemble
+
+# Define paths to flood maps
+FLOOD_MAP_PATHS = {
+    'harvey': r'../input_data/floodmaps/Harvey_depth_meters.tif',
+    '100yr': r'../input_data/floodmaps/100yr_storm_depth_meters.tif',
+    '500yr': r'../input_data/floodmaps/500yr_storm_depth_meters.tif',  # Example path for 500yr flood map
+    # Small synthetic flood map that belongs to the synthetic model domain and floodplain, see benchmark.py
+    'synthetic': r'../input_data/synthetic/synthetic_depth_meters.tif',
+}
+# The model domain and floodplain of the flood maps that do not cover the Houston domain of functions.py
+FLOOD_MAP_GEOMETRIES = {
+    'synthetic': (r'../input_data/synthetic/synthetic_domain.shp', r'../input_data/synthetic/synthetic_floodplain.shp'),
+}
+
+
+# The model reporters, with the method of the model that reports them
+MODEL_REPORTERS = {
+    "TotalAdaptedHouseholds": "total_adapted_households",
+    "TotalActualDamage": "total_actual_damage",
+    "TotalExpectedDamage": "total_expected_damage",
+    "TotalAdaptationCosts": "total_adaptation_costs",
+    "TotalCostsOfSubsidies": "total_subsidies_costs",
+    "AverageDamagePerIncomeLabel": "calculate_damage_per_agent_per_income_label",
+    "EstimatedAverageDamagePerIncomeLabel": "calculate_estimated_damage_per_agent_per_income_label",
+    "AverageIncomeToDamageRatio": "calculate_average_income_to_damage_ratio",
+    "EstimatedAverageIncomeToDamageRatio": "calculate_estimated_average_income_to_damage_ratio",
+    # ... other reporters ...
+}
+# The model reporters that are added with recurring floods, TotalActualDamage is then the damage of the last event
+FLOOD_EVENT_REPORTERS = {
+    "NumberOfFloodEvents": "number_of_flood_events",
+    "CumulativeActualDamage": "cumulative_actual_damage",
+}
+
+
+def model_reporter_names(reporter_schema='nested', flood_events=None):
+    """The names of the model reporters of a model with the given reporter schema and flood events"""
+    names = list(COLUMNS) if reporter_schema == 'flat' else list(MODEL_REPORTERS)
+    if flood_events is not None:
+        names += list(FLOOD_EVENT_REPORTERS)
+    return names
+
+
+def flood_map_geometry(flood_map_choice):
+    """The GeometryRegistry of the model domain and floodplain that belong to a flood map choice"""
+    if flood_map_choice in FLOOD_MAP_GEOMETRIES:
+        return geometry.with_paths(*FLOOD_MAP_GEOMETRIES[flood_map_choice])
+    return geometry
 
 
 # Define the AdaptationModel class
@@ -33,20 +90,66 @@ class AdaptationModel(Model):
                  #Standard distribution that decides housesize for agents with random normal. Income_label:[mean, std_dv]
                  average_household_surfaces={'Poor': [100, 30], 'Middle-Class': [201.6, 50], 'Rich': [500, 200]},
                  # Simplified argument for choosing flood map. Can currently be "harvey", "100yr", or "500yr".
+                 # "synthetic" is a small generated flood map for benchmarks, see benchmark.py
                  flood_map_choice='harvey',
+                 # Depth-damage function, "logarithmic" (the regression of calculate_basic_flood_damage), "jrc" (the data
+                 # points of input_data/flood_depth-damage_function.xlsx), or the path of an Excel file with data
+                 # points (see depth_damage.py)
+                 depth_damage_function='logarithmic',
+                 # Interpolate linearly in the table of a tabulated depth-damage function, or take the nearest depth
+                 depth_damage_interpolation=True,
                  # ### network related parameters ###
                  # The social network structure that is used.
-                 # Can currently be "erdos_renyi", "barabasi_albert", "watts_strogatz", or "no_network"
+                 # Can currently be "erdos_renyi", "barabasi_albert", "watts_strogatz", "spatial", or "no_network"
                  network = 'watts_strogatz',
                  # likeliness of edge being created between two nodes
                  probability_of_network_connection = 0.4,
                  # number of edges for BA network
                  number_of_edges = 3,
-                 # number of nearest neighbours for WS social network
+                 # number of nearest neighbours for WS social network, and for the spatial network without a radius
                  number_of_nearest_neighbours = 5,
+                 # distance on the map within which households are friends in the spatial network; None connects every
+                 # household to its number_of_nearest_neighbours nearest households instead. As in the WS network, every
+                 # edge is rewired to a random household with probability_of_network_connection (long-range ties)
+                 spatial_radius = None,
+                 # "networkx" generates the network with networkx, "native" generates it as an array of edges, which
+                 # scales to millions of households; the networkx graph is then only built when it is used
+                 # (see network_generation.py)
+                 network_backend = 'networkx',
+                 # households within this number of steps through the network are friends of each other
+                 network_radius = 1,
+                 # Household engine: "agents" steps every Households object, "vectorized" steps all households
+                 # at once on numpy arrays (see vectorized.py)
+                 engine = 'agents',
+                 # Also collect the agent reporters that return Python objects (Location, AdaptationMeasures, Network)
+                 collect_object_reporters = False,
+                 # "nested" collects the per-income-label reporters as dictionaries, "flat" as one numeric column per
+                 # income label and metric (e.g. "AverageDamagePerPoorHousehold"), with NaN for empty income labels
+                 reporter_schema = 'nested',
+                 # Jump straight to the flood step once no household can change state anymore (see skip_to_flood)
+                 skip_ahead = False,
+                 # Draw the random numbers of every part of the model (flood, network, placement, income, perception)
+                 # from its own substream, so runs with the same seed share them across policies (see random_streams.py)
+                 common_random_numbers = False,
+                 # PopulationSnapshot whose households, network and random state are used instead of creating them,
+                 # see snapshot.py. Use PopulationSnapshot.fork to create a model with the parameters of a snapshot
+                 population = None,
+                 # Recurring flood events during the whole run instead of the single flood at flood_step, given as a
+                 # dictionary of flood event parameters, e.g. {'rate': 0.02, 'maps': {'100yr': 4, '500yr': 1}}
+                 # (see flood_events.py). The model then does not stop at a flood
+                 flood_events = None,
+                 # Record the wall time and number of calls of every phase of the initialization and the steps in
+                 # self.profiler, and with profile_memory also their memory allocations (see profiling.py)
+                 profile = False,
+                 profile_memory = False,
                  ):
         
         super().__init__(seed = seed)
+
+        #Profiler of the phases of the model, None when the model is not profiled
+        self.profile = profile
+        self.profile_memory = profile_memory
+        self.profiler = PhaseProfiler(memory=profile_memory) if profile or profile_memory else None
         
         # defining the variables and setting the values
         self.number_of_steps = number_of_steps
@@ -57,91 +160,201 @@ class AdaptationModel(Model):
         self.income_distribution_label = None #Used to store which income_label is used in a model for sensitivity analysis
         self.average_household_surfaces = average_household_surfaces #Can vary based on model parameter input
 
+        #Named random substreams for common random numbers, otherwise everything is drawn from self.random
+        self.common_random_numbers = common_random_numbers
+        self.streams = RandomStreams(seed) if common_random_numbers else None
+
         #This variable randomly decides when the flood occurs between the parameters given
-        self.flood_step = self.random.randint(1, number_of_steps)
+        if population is not None:
+            self.flood_step = population.flood_step
+        else:
+            self.flood_step = self.random_stream('flood').randint(1, number_of_steps)
+        #Numpy random generator for array operations, derived from the seed without drawing from self.random, so the
+        #agents engine draws the same population for a seed as the model always has
+        self.np_random = np.random.default_rng(np.random.SeedSequence(seed))
+
+        self.skip_ahead = skip_ahead
+        #Becomes True with skip_ahead once a step did not change any flood perception, see step_saving_households
+        self.perceptions_settled = False
+
+        if engine not in ('agents', 'vectorized'):
+            raise ValueError(f"Unknown engine: '{engine}'. Currently implemented engines are: 'agents' and 'vectorized'")
+        self.engine = engine
 
         # network
         self.network = network # Type of network to be created
         self.probability_of_network_connection = probability_of_network_connection
         self.number_of_edges = number_of_edges
         self.number_of_nearest_neighbours = number_of_nearest_neighbours
-
-        # generating the graph according to the network used and the network parameters specified
-        self.G = self.initialize_network()
-        # create grid out of network graph
-        self.grid = NetworkGrid(self.G)
+        self.spatial_radius = spatial_radius
+        self.network_radius = network_radius
+        if network_backend not in ('networkx', 'native'):
+            raise ValueError(f"Unknown network backend: '{network_backend}'. "
+                             f"Currently implemented backends are: 'networkx' and 'native'")
+        self.network_backend = network_backend
+        self.flood_map_choice = flood_map_choice
+        if population is not None:
+            population.check_parameters(self)
+        # The flood events are drawn while the model runs, the ensemble keeps the next event and their history
+        self.flood_events = flood_events
+        self.flood_ensemble = None
+        if flood_events is not None:
+            self.flood_ensemble = FloodEnsemble(flood_events, FLOOD_MAP_PATHS, number_of_households)
+            # The flood maps of the events are read at the locations of the households, so they cover the same domain
+            for choice in self.flood_ensemble.maps or []:
+                if FLOOD_MAP_GEOMETRIES.get(choice) != FLOOD_MAP_GEOMETRIES.get(flood_map_choice):
+                    raise ValueError(f"The flood map '{choice}' of the flood events does not belong to the model "
+                                     f"domain of the flood map choice '{flood_map_choice}'")
 
         # Initialize maps
-        self.initialize_maps(flood_map_choice)
+        self.depth_damage_function = depth_damage_function
+        self.depth_damage_interpolation = depth_damage_interpolation
+        with self.phase('maps'):
+            self.initialize_maps(flood_map_choice)
+            self.depth_damage = load_depth_damage_function(depth_damage_function, depth_damage_interpolation)
+
+        # The spatial network connects households that live close to each other, so their locations are drawn before
+        # the network is generated, and used when the households are created
+        started = self.start_phase()
+        self.household_locations = None
+        if network == 'spatial' and population is None:
+            self.household_locations = self.draw_household_locations()
+
+        # generating the graph according to the network used and the network parameters specified
+        # The edges are kept as an array of (node, node) pairs, the networkx graph and the grid are built on demand
+        # with the native backend
+        self._G = None
+        self._grid = None
+        if population is not None:
+            self.edges = population.edges
+        elif network_backend == 'native':
+            self.edges = self.initialize_network_edges()
+        else:
+            self._G = self.initialize_network()
+            # in the order of the neighbours in the graph, which the friends of every household keep
+            self.edges = graph_edges(self._G)
+        if network_backend == 'networkx':
+            # create grid out of network graph
+            self._grid = NetworkGrid(self.G)
+        # the network does not change during the run, so the friends of every household are looked up once
+        if population is not None:
+            self.neighbour_index = population.neighbour_index(self.network_radius)
+        else:
+            self.neighbour_index = NeighbourIndex.from_edges(number_of_households, self.edges,
+                                                             radius=self.network_radius)
+        self.stop_phase('network', started)
 
         # set schedule for agents
+        started = self.start_phase()
         self.schedule = BaseScheduler(self)  # Schedule for activating agents
 
         # create households through initiating a household on each node of the network graph
-        for i, node in enumerate(self.G.nodes()):
-            household = Households(unique_id=i, model=self)
+        # With the vectorized engine, the household state is created at once and the agents are views on it
+        # A population snapshot gives the drawn attributes of the households, only their adaptation measures are new
+        if self.engine == 'vectorized':
+            self.households = HouseholdArrays(self, population.household_arrays() if population is not None else None)
+        elif population is not None:
+            households_kwargs = population.households_kwargs()
+        else:
+            # The locations are drawn first, so the flood depths of all households are sampled from the map at once
+            x, y, in_floodplain = self.draw_household_locations()
+            flood_depths = get_flood_depths(self.flood_map, x, y, self.band_flood_img)
+        for i, node in enumerate(self.G.nodes() if self._grid is not None else range(number_of_households)):
+            if self.engine == 'vectorized':
+                household = HouseholdView(unique_id=i, model=self, index=i)
+            elif population is not None:
+                household = Households(unique_id=i, model=self, **next(households_kwargs))
+            else:
+                household = Households(unique_id=i, model=self, location=(x[i], y[i]),
+                                       in_floodplain=in_floodplain[i], flood_depth_estimated=flood_depths[i].item())
             self.schedule.add(household)
-            self.grid.place_agent(agent=household, node_id=node)
+            if self._grid is not None:
+                self._grid.place_agent(agent=household, node_id=node)
+            else:
+                household.pos = node
+        # Continue from the random state after the population of the snapshot was created
+        if population is not None:
+            set_random_states(self, population.random_states)
 
         # The next line creates the all_households variable, which is used to calculate the network_flood_perception
         self.all_households = self.schedule.agents
+        # Sums and counts per income label for the model reporters, updated by the households when they change
+        self.income_label_totals = IncomeLabelTotals.from_model(self)
+        self.stop_phase('households', started)
 
 
+        if reporter_schema not in ('nested', 'flat'):
+            raise ValueError(f"Unknown reporter schema: '{reporter_schema}'. "
+                             f"Currently implemented schemas are: 'nested' and 'flat'")
+        self.reporter_schema = reporter_schema
+        self.collect_object_reporters = collect_object_reporters
+
         # Data collection setup to collect data
-        model_metrics = {
-                        "TotalAdaptedHouseholds": self.total_adapted_households,
-                        "TotalActualDamage": self.total_actual_damage,
-                        "TotalExpectedDamage": self.total_expected_damage,
-                        "TotalAdaptationCosts":self.total_adaptation_costs,
-                        "TotalCostsOfSubsidies":self.total_subsidies_costs,
-                        "AverageDamagePerIncomeLabel":self.calculate_damage_per_agent_per_income_label,
-                        "EstimatedAverageDamagePerIncomeLabel": self.calculate_estimated_damage_per_agent_per_income_label,
-                        "AverageIncomeToDamageRatio":self.calculate_average_income_to_damage_ratio,
-                        "EstimatedAverageIncomeToDamageRatio":self.calculate_estimated_average_income_to_damage_ratio
-                        # ... other reporters ...
-                        }
+        model_metrics = {name: getattr(self, method) for name, method in MODEL_REPORTERS.items()}
+        #In the flat schema every column is a number, so batch results do not have to be unpacked with json_normalize
+        if reporter_schema == 'flat':
+            model_metrics = {name: [self.flat_reporter, [name]] for name in COLUMNS}
+        if flood_events is not None:
+            model_metrics.update({name: getattr(self, method) for name, method in FLOOD_EVENT_REPORTERS.items()})
         
+        #Typed agent reporters, categorical values are stored as small integer codes
         agent_metrics = {
-                        "FloodDepthEstimated": "flood_depth_estimated",
-                        "FloodDamageEstimated" : "flood_damage_estimated",
-                        "HouseSize":"housesize",
-                        "Location":"location",
-                        "FloodDepthActual": "flood_depth_actual",
-                        "FloodDamageActual" : "flood_damage_actual",
-                        "OptimalMeasure": "optimal_measure",
-                        "AdaptationMeasures":"adaptation_measures",
-                        "GoingToAdapt":"going_to_adapt",
-                        "IsAdapted": "is_adapted",
-                        "CostOfAdaptation": "cost_of_adaptation",
-                        "IncomeLabel": "income_label",
-                        "Income":"income",
-                        "Savings":"savings",
-                        "OwnFloodPerception":"own_flood_perception",
-                        "NetworkPerception":"network_flood_perception",
-                        "Network":"network"
+                        "FloodDepthEstimated": AgentColumn("flood_depth_estimated"),
+                        "FloodDamageEstimated" : AgentColumn("flood_damage_estimated"),
+                        "HouseSize": AgentColumn("housesize", np.int32),
+                        "LocationX": AgentColumn("x"),
+                        "LocationY": AgentColumn("y"),
+                        "FloodDepthActual": AgentColumn("flood_depth_actual"),
+                        "FloodDamageActual" : AgentColumn("flood_damage_actual"),
+                        "OptimalMeasure": AgentColumn("optimal_measure", categories=MEASURES, step_suffix="AdaptationStep"),
+                        "AdaptationStep": AgentColumn("adaptation_step", np.int32),
+                        "GoingToAdapt": AgentColumn("going_to_adapt", bool),
+                        "IsAdapted": AgentColumn("is_adapted", bool),
+                        "CostOfAdaptation": AgentColumn("cost_of_adaptation"),
+                        "IncomeLabel": AgentColumn("income_label", categories=INCOME_LABELS),
+                        "Income": AgentColumn("income", np.int64),
+                        "Savings": AgentColumn("savings"),
+                        "OwnFloodPerception": AgentColumn("own_flood_perception", np.int8),
+                        #-1 when the household has no friends
+                        "NetworkPerception": AgentColumn("network_flood_perception", np.int8, missing=-1),
                         # ... other reporters ...
                         }
-        #set up the data collector 
-        self.datacollector = DataCollector(model_reporters=model_metrics, agent_reporters=agent_metrics)
-            
+        #The reporters that return Python objects are expensive to store, so they are only collected on request
+        if collect_object_reporters:
+            agent_metrics.update({
+                        "Location": AgentColumn("location", object),
+                        "AdaptationMeasures": AgentColumn("adaptation_measures", object),
+                        "Network": AgentColumn("network", object),
+                        })
+        #set up the data collector, with room for every step of the run
+        self.datacollector = ColumnarDataCollector(model_reporters=model_metrics, agent_reporters=agent_metrics,
+                                                   number_of_steps=number_of_steps + 1)
+
 
     def initialize_network(self):
         """
         Initialize and return the social network graph based on the provided network type using pattern matching.
         """
+        seed = self.streams.seed('network') if self.streams is not None else self.seed
         if self.network == 'erdos_renyi':
             return nx.erdos_renyi_graph(n=self.number_of_households,
                                         p=self.number_of_nearest_neighbours / self.number_of_households,
-                                        seed=self.seed)
+                                        seed=seed)
         elif self.network == 'barabasi_albert':
             return nx.barabasi_albert_graph(n=self.number_of_households,
                                             m=self.number_of_edges,
-                                            seed=self.seed)
+                                            seed=seed)
         elif self.network == 'watts_strogatz':
             return nx.watts_strogatz_graph(n=self.number_of_households,
                                         k=self.number_of_nearest_neighbours,
                                         p=self.probability_of_network_connection,
-                                        seed=self.seed)
+                                        seed=seed)
+        elif self.network == 'spatial':
+            # networkx has no spatial network generator, the graph is built from the native edges
+            G = nx.Graph()
+            G.add_nodes_from(range(self.number_of_households))
+            G.add_edges_from(self.initialize_network_edges().tolist())
+            return G
         elif self.network == 'no_network':
             G = nx.Graph()
             G.add_nodes_from(range(self.number_of_households))
@@ -149,239 +362,164 @@ class AdaptationModel(Model):
         else:
             raise ValueError(f"Unknown network type: '{self.network}'. "
                             f"Currently implemented network types are: "
-                            f"'erdos_renyi', 'barabasi_albert', 'watts_strogatz', and 'no_network'")
+                            f"'erdos_renyi', 'barabasi_albert', 'watts_strogatz', 'spatial', and 'no_network'")
+
 
+    def initialize_network_edges(self):
+        """
+        Generate the social network with the native generators of network_generation.py, as an array of edges.
+        """
+        seed = self.streams.seed('network') if self.streams is not None else self.seed
+        locations = self.household_locations[:2] if self.household_locations is not None else None
+        return network_edges(self.network, self.number_of_households, np.random.default_rng(seed),
+                             self.probability_of_network_connection, self.number_of_edges,
+                             self.number_of_nearest_neighbours, locations=locations,
+                             spatial_radius=self.spatial_radius)
+
+    def draw_household_locations(self):
+        """
+        Return the locations of all households (x, y, in_floodplain), drawn within the map domain, or the locations
+        that were drawn before the spatial network was generated.
+        """
+        if self.household_locations is not None:
+            return self.household_locations
+        return generate_random_locations_within_map_domain(self, self.number_of_households)
+
+    @property
+    def G(self):
+        """The social network as a networkx graph. With the native network backend it is built from the edges the
+        first time it is used, e.g. for plotting"""
+        if self._G is None:
+            self._G = nx.Graph()
+            self._G.add_nodes_from(range(self.number_of_households))
+            self._G.add_edges_from(self.edges.tolist())
+        return self._G
+
+    @property
+    def grid(self):
+        """The NetworkGrid of the households on the social network, built on demand with the native network backend"""
+        if self._grid is None:
+            self._grid = NetworkGrid(self.G)
+            for household in self.schedule.agents:
+                self._grid.place_agent(agent=household, node_id=household.pos)
+        return self._grid
 
     def initialize_maps(self, flood_map_choice):
         """
         Initialize and set up the flood map related data based on the provided flood map choice.
         """
-        # Define paths to flood maps
-        flood_map_paths = {
-            'harvey': r'../input_data/floodmaps/Harvey_depth_meters.tif',
-            '100yr': r'../input_data/floodmaps/100yr_storm_depth_meters.tif',
-            '500yr': r'../input_data/floodmaps/500yr_storm_depth_meters.tif'  # Example path for 500yr flood map
-        }
-
         # Throw a ValueError if the flood map choice is not in the dictionary
-        if flood_map_choice not in flood_map_paths.keys():
+        if flood_map_choice not in FLOOD_MAP_PATHS.keys():
             raise ValueError(f"Unknown flood map choice: '{flood_map_choice}'. "
-                             f"Currently implemented choices are: {list(flood_map_paths.keys())}")
+                             f"Currently implemented choices are: {list(FLOOD_MAP_PATHS.keys())}")
 
         # Choose the appropriate flood map based on the input choice
-        flood_map_path = flood_map_paths[flood_map_choice]
+        flood_map_path = FLOOD_MAP_PATHS[flood_map_choice]
+        # The households are placed in the model domain and floodplain that belong to the flood map
+        self.geometry = flood_map_geometry(flood_map_choice)
 
-        # Loading and setting up the flood map
-        self.flood_map = rs.open(flood_map_path)
+        # Loading and setting up the flood map, through the cache that is shared by all runs and worker processes
+        self.flood_map = load_flood_map(flood_map_path)
         self.band_flood_img, self.bound_left, self.bound_right, self.bound_top, self.bound_bottom = get_flood_map_data(
             self.flood_map)
 
+    def random_stream(self, name):
+        """Return the Python random generator for a part of the model, see random_streams.STREAMS"""
+        return self.streams.python(name) if self.streams is not None else self.random
+
+    def numpy_stream(self, name):
+        """Return the numpy random generator for a part of the model, see random_streams.STREAMS"""
+        return self.streams.numpy(name) if self.streams is not None else self.np_random
+
+    def phase(self, name):
+        """Context manager that profiles the code in it as a phase of the current step, see profiling.py"""
+        return self.profiler.phase(name) if self.profiler is not None else NO_PHASE
+
+    def start_phase(self):
+        """Start profiling a phase that is ended with stop_phase, for phases that span a long block of code"""
+        return self.profiler.start() if self.profiler is not None else None
+
+    def stop_phase(self, name, started):
+        if self.profiler is not None:
+            self.profiler.stop(name, started)
+
     def total_adapted_households(self):
         """Return the total number of households that have adapted."""
-        #BE CAREFUL THAT YOU MAY HAVE DIFFERENT AGENT TYPES SO YOU NEED TO FIRST CHECK IF THE AGENT IS ACTUALLY A HOUSEHOLD AGENT USING "ISINSTANCE"
-        adapted_count = sum([1 for agent in self.schedule.agents if isinstance(agent, Households) and agent.is_adapted])
-        return adapted_count
+        return int(round(self.income_label_totals.total('adapted')))
 
     def total_actual_damage(self):
         """"Return the total damaged experienced after a flood occured by all agents"""
-        total_actual_damage = sum(agent.flood_damage_actual for agent in self.schedule.agents)
-        return total_actual_damage
+        return self.income_label_totals.total('damage_actual')
+
+    def number_of_flood_events(self):
+        """Return the number of flood events so far, with flood_events"""
+        return len(self.flood_ensemble.history)
+
+    def cumulative_actual_damage(self):
+        """Return the total damage of all flood events so far, with flood_events"""
+        return self.flood_ensemble.history.total_damage()
 
     def total_expected_damage(self):
         """"Return the total expected damage summed for all agents"""
-        total_expected_damage = sum(agent.flood_damage_estimated for agent in self.schedule.agents)
-        return total_expected_damage
+        return self.income_label_totals.total('damage_estimated')
 
     def total_adaptation_costs(self):
         """"Return the total adaptation costs summed for all agents"""
-        total_adaptation_costs = sum(agent.cost_of_adaptation for agent in self.schedule.agents)
-        return total_adaptation_costs
+        return self.income_label_totals.total('cost_of_adaptation')
 
     def total_subsidies_costs(self):
         """"Return the total cost of subsidies spent by all agents"""
-        total_cost_of_subsidies = sum(agent.subsidies_received for agent in self.schedule.agents)
-        return total_cost_of_subsidies
+        return self.income_label_totals.total('subsidies_received')
 
-    def calculate_damage_per_agent_per_income_label(self):
+    def income_label_reporter(self, name):
         """
-        Function to calculate the average damage per income label for the agents
+        Function to return the values of a per-income-label reporter as a dictionary, e.g. for name
+        'AverageDamagePer{}Household' the keys are 'AverageDamagePerPoorHousehold', 'AverageDamagePerMiddleClassHousehold'
+        and 'AverageDamagePerRichHousehold'. The values are read from the running totals of the households.
         """
-        #Dictionary with the three labels and their respective average damage per agent in that label
-        damage_per_agent_per_income_label = {}
-
-        #Create subsets of all the agents within the model based on income_label
-        poor_agents = [agent for agent in self.schedule.agents if agent.income_label == 'Poor']
-        middle_class_agents = [agent for agent in self.schedule.agents if agent.income_label == 'Middle-Class']
-        rich_agents = [agent for agent in self.schedule.agents if agent.income_label == 'Rich']
-
-        #Calculate the total damage per income label for all agents
-        total_damage_poor_agents = sum(agent.flood_damage_actual for agent in self.schedule.agents if agent.income_label == 'Poor')
-        total_damage_middle_class_agents = sum(agent.flood_damage_actual for agent in self.schedule.agents if agent.income_label == 'Middle-Class')
-        total_damage_rich_agents = sum(agent.flood_damage_actual for agent in self.schedule.agents if agent.income_label == 'Rich')
-
-        #Calculate the average damage per agent of income class by dividing it with the number of agents of that income class in the model
-        average_damage_per_poor_agent = total_damage_poor_agents/len(poor_agents)
-        average_damage_per_middle_class_agent = total_damage_middle_class_agents/len(middle_class_agents)
-        if len(rich_agents) > 0:
-            average_damage_per_rich_agent = total_damage_rich_agents/len(rich_agents)
-        else:
+        if self.income_label_totals.number_of_households('Rich') == 0:
             return 'No Rich Agents in the model'
-
-        #Append the values into the empty dictionary created at the beginning
-        damage_per_agent_per_income_label['AverageDamagePerPoorHousehold'] = average_damage_per_poor_agent
-        damage_per_agent_per_income_label['AverageDamagePerMiddleClassHousehold'] = average_damage_per_middle_class_agent
-        damage_per_agent_per_income_label['AverageDamagePerRichHousehold'] = average_damage_per_rich_agent
-
         #The values are returned as a dictionary which will later be unpacked after the model has been run
         #This dictionary is unpacked into three seperate columns for each income label
-        return damage_per_agent_per_income_label
+        return {name.format(label): self.income_label_totals.column(name.format(label)) for label in COLUMN_LABELS}
 
-    def calculate_estimated_damage_per_agent_per_income_label(self):
+    def flat_reporter(self, name):
+        """Return the value of a single column of the flat reporter schema, NaN for income labels without households"""
+        return self.income_label_totals.column(name)
+
+    def calculate_damage_per_agent_per_income_label(self):
         """
         Function to calculate the average damage per income label for the agents
         """
-        #Dictionary with the three labels and their respective average damage per agent in that label
-        damage_per_agent_per_income_label = {}
-
-        #Create subsets of all the agents within the model based on income_label
-        poor_agents = [agent for agent in self.schedule.agents if agent.income_label == 'Poor']
-        middle_class_agents = [agent for agent in self.schedule.agents if agent.income_label == 'Middle-Class']
-        rich_agents = [agent for agent in self.schedule.agents if agent.income_label == 'Rich']
-
-        #Calculate the total damage per income label for all agents
-        total_damage_poor_agents = sum(agent.flood_damage_estimated for agent in self.schedule.agents if agent.income_label == 'Poor')
-        total_damage_middle_class_agents = sum(agent.flood_damage_estimated for agent in self.schedule.agents if agent.income_label == 'Middle-Class')
-        total_damage_rich_agents = sum(agent.flood_damage_estimated for agent in self.schedule.agents if agent.income_label == 'Rich')
-
-        #Calculate the average damage per agent of income class by dividing it with the number of agents of that income class in the model
-        average_damage_per_poor_agent = total_damage_poor_agents/len(poor_agents)
-        average_damage_per_middle_class_agent = total_damage_middle_class_agents/len(middle_class_agents)
-        if len(rich_agents) > 0:
-            average_damage_per_rich_agent = total_damage_rich_agents/len(rich_agents)
-        else:
-            return 'No Rich Agents in the model'
+        return self.income_label_reporter('AverageDamagePer{}Household')
 
-        #Append the values into the empty dictionary created at the beginning
-        damage_per_agent_per_income_label['EstimatedAverageDamagePerPoorHousehold'] = average_damage_per_poor_agent
-        damage_per_agent_per_income_label['EstimatedAverageDamagePerMiddleClassHousehold'] = average_damage_per_middle_class_agent
-        damage_per_agent_per_income_label['EstimatedAverageDamagePerRichHousehold'] = average_damage_per_rich_agent
-
-        #The values are returned as a dictionary which will later be unpacked after the model has been run
-        #This dictionary is unpacked into three seperate columns for each income label
-        return damage_per_agent_per_income_label
+    def calculate_estimated_damage_per_agent_per_income_label(self):
+        """
+        Function to calculate the average estimated damage per income label for the agents
+        """
+        return self.income_label_reporter('EstimatedAverageDamagePer{}Household')
 
     def calculate_average_income_to_damage_ratio(self):
-        # Dictionary with the three labels and their respective average damage per agent in that label
-        AverageIncomeToDamageRatio = {}
-
-        # Create subsets of all the agents within the model based on income_label
-        poor_agents = [agent for agent in self.schedule.agents if agent.income_label == 'Poor']
-        middle_class_agents = [agent for agent in self.schedule.agents if agent.income_label == 'Middle-Class']
-        rich_agents = [agent for agent in self.schedule.agents if agent.income_label == 'Rich']
-
-        #Calculate the total damage per income label for all agents
-        total_damage_poor_agents = sum(
-            agent.flood_damage_actual for agent in self.schedule.agents if agent.income_label == 'Poor')
-        total_damage_middle_class_agents = sum(
-            agent.flood_damage_actual for agent in self.schedule.agents if agent.income_label == 'Middle-Class')
-        total_damage_rich_agents = sum(
-            agent.flood_damage_actual for agent in self.schedule.agents if agent.income_label == 'Rich')
-
-        #Calculate the total income per income label for all agents of that income label
-        total_income_poor_agents = sum(
-            agent.income for agent in self.schedule.agents if agent.income_label == 'Poor')
-        total_income_middle_class_agents = sum(
-            agent.income for agent in self.schedule.agents if agent.income_label == 'Middle-Class')
-        total_income_rich_agents = sum(
-            agent.income for agent in self.schedule.agents if agent.income_label == 'Rich')
-
-        #Calulcate the average damage per income label by dividing the total damage per income label by the number of agents with that income label
-        average_damage_per_poor_agent = total_damage_poor_agents / len(poor_agents)
-        average_damage_per_middle_class_agent = total_damage_middle_class_agents / len(middle_class_agents)
-        if len(rich_agents) > 0:
-            average_damage_per_rich_agent = total_damage_rich_agents / len(rich_agents)
-        else:
-            return 'No Rich Agents in the model'
-
-        #Calulcate the average damage per income label by dividing the total damage per income label by the number of agents with that income label
-        average_income_per_poor_agent = total_income_poor_agents / len(poor_agents)
-        average_income_per_middle_class_agent = total_income_middle_class_agents / len(middle_class_agents)
-        if len(rich_agents) > 0:
-            average_income_per_rich_agent = total_income_rich_agents / len(rich_agents)
-        else:
-            return 'No Rich Agents in the model'
-
-        #Calculate the average income to damage ratio by dividing average damage per agent / income class with the income
-        #This shows the damage in relation to income, which is a way to calculate inequality
-        #The higher
-        AverageIncomeToDamageRatio[
-            'AverageIncomeToDamagePoorHousehold'] = average_damage_per_poor_agent/average_income_per_poor_agent
-        AverageIncomeToDamageRatio[
-            'AverageIncomeToDamageMiddleClassHousehold'] = average_damage_per_middle_class_agent/average_income_per_middle_class_agent
-        AverageIncomeToDamageRatio[
-            'AverageIncomeToDamageRichHousehold'] = average_damage_per_rich_agent/average_income_per_rich_agent
-
-        return AverageIncomeToDamageRatio
+        """
+        Function to calculate the average damage in relation to the average income per income label, which is a way to
+        calculate inequality
+        """
+        return self.income_label_reporter('AverageIncomeToDamage{}Household')
 
     def calculate_estimated_average_income_to_damage_ratio(self):
-        # Dictionary with the three labels and their respective average damage per agent in that label
-        AverageIncomeToDamageRatio = {}
-
-        # Create subsets of all the agents within the model based on income_label
-        poor_agents = [agent for agent in self.schedule.agents if agent.income_label == 'Poor']
-        middle_class_agents = [agent for agent in self.schedule.agents if agent.income_label == 'Middle-Class']
-        rich_agents = [agent for agent in self.schedule.agents if agent.income_label == 'Rich']
-
-        #Calculate the total damage per income label for all agents
-        total_damage_poor_agents = sum(
-            agent.flood_damage_estimated for agent in self.schedule.agents if agent.income_label == 'Poor')
-        total_damage_middle_class_agents = sum(
-            agent.flood_damage_estimated for agent in self.schedule.agents if agent.income_label == 'Middle-Class')
-        total_damage_rich_agents = sum(
-            agent.flood_damage_estimated for agent in self.schedule.agents if agent.income_label == 'Rich')
-
-        #Calculate the total income per income label for all agents of that income label
-        total_income_poor_agents = sum(
-            agent.income for agent in self.schedule.agents if agent.income_label == 'Poor')
-        total_income_middle_class_agents = sum(
-            agent.income for agent in self.schedule.agents if agent.income_label == 'Middle-Class')
-        total_income_rich_agents = sum(
-            agent.income for agent in self.schedule.agents if agent.income_label == 'Rich')
-
-        #Calulcate the average damage per income label by dividing the total damage per income label by the number of agents with that income label
-        average_damage_per_poor_agent = total_damage_poor_agents / len(poor_agents)
-        average_damage_per_middle_class_agent = total_damage_middle_class_agents / len(middle_class_agents)
-        if len(rich_agents) > 0:
-            average_damage_per_rich_agent = total_damage_rich_agents / len(rich_agents)
-        else:
-            return 'No Rich Agents in the model'
-
-        #Calulcate the average damage per income label by dividing the total damage per income label by the number of agents with that income label
-        average_income_per_poor_agent = total_income_poor_agents / len(poor_agents)
-        average_income_per_middle_class_agent = total_income_middle_class_agents / len(middle_class_agents)
-        if len(rich_agents) > 0:
-            average_income_per_rich_agent = total_income_rich_agents / len(rich_agents)
-        else:
-            return 'No Rich Agents in the model'
-
-        #Calculate the average income to damage ratio by dividing average damage per agent / income class with the income
-        #This shows the damage in relation to income, which is a way to calculate inequality
-        #The higher
-        AverageIncomeToDamageRatio[
-            'EstimatedAverageIncomeToDamagePoorHousehold'] = average_damage_per_poor_agent/average_income_per_poor_agent
-        AverageIncomeToDamageRatio[
-            'EstimatedAverageIncomeToDamageMiddleClassHousehold'] = average_damage_per_middle_class_agent/average_income_per_middle_class_agent
-        AverageIncomeToDamageRatio[
-            'EstimatedAverageIncomeToDamageRichHousehold'] = average_damage_per_rich_agent/average_income_per_rich_agent
-
-        return AverageIncomeToDamageRatio
+        """
+        Function to calculate the average estimated damage in relation to the average income per income label
+        """
+        return self.income_label_reporter('EstimatedAverageIncomeToDamage{}Household')
 
     def plot_model_domain_with_agents(self):
+        # matplotlib is only imported when plotting, so batch runs do not pay for it
+        import matplotlib.pyplot as plt
         fig, ax = plt.subplots()
         # Plot the model domain
-        map_domain_gdf.plot(ax=ax, color='lightgrey')
+        self.geometry.map_domain_gdf.plot(ax=ax, color='lightgrey')
         # Plot the floodplain
-        floodplain_gdf.plot(ax=ax, color='lightblue', edgecolor='k', alpha=0.5)
+        self.geometry.floodplain_gdf.plot(ax=ax, color='lightblue', edgecolor='k', alpha=0.5)
 
         # Collect agent locations and statuses
         for agent in self.schedule.agents:
@@ -408,32 +546,187 @@ class AdaptationModel(Model):
         with a more sound procedure (e.g., you can divide the flood map into zones and
         assume local flooding instead of global flooding). The actual flood depth can be 
         estimated differently
-        """
-        if self.schedule.steps == self.flood_step:
-            for agent in self.schedule.agents:
-                # Calculate the actual flood depth as a random number between 0.5 and 1.2 times the estimated flood depth
-                agent.flood_depth_actual = random.uniform(0.5, 1.2) * agent.flood_depth_estimated
-                # calculate the actual flood damage given the actual flood depth
-                agent.flood_damage_actual = calculate_basic_flood_damage(agent.flood_depth_actual, agent.housesize)
 
-                self.running = False
+        The flood happens at flood_step, which is drawn when the model is created. The model stops at the flood:
+        running is set to False and the households do not take another step. With skip_ahead, the model jumps straight
+        to the flood step as soon as the households can no longer change state.
+
+        With flood_events, floods recur during the whole run instead (see step_flood_events) and the model does not stop
+        at a flood; skip_ahead then jumps to the next event.
+        """
+        if self.profiler is not None:
+            self.profiler.step = self.schedule.steps
+        if self.flood_ensemble is not None:
+            self.step_flood_events()
+        flood = self.flood_ensemble is None and self.schedule.steps == self.flood_step
+        if flood:
+            with self.phase('flood'):
+                self.apply_flood()
+            self.running = False
 
-        #Save model variables before collecting in the datacollector
-        self.total_adapted_households()
-        self.total_actual_damage()
-        self.total_expected_damage()
         # Collect data and advance the model by one step
         self.datacollector.collect(self)
-        self.schedule.step()
+        if flood:
+            # The model stops at the flood, the households do not take another step after it
+            self.advance_clock()
+            return
 
-    def model_run(self):
-        for step in range(self.number_of_steps):
-            self.step()
-
-            # The model stops when the flood has taken place.
-            # The set of rules for agents and their behavior flowing from this set is only relevant before a flood
-            if step == self.flood_step:
-                #self.plot_model_domain_with_agents()
-                break
+        if self.perceptions_settled:
+            self.step_saving_households()
+        else:
+            if self.skip_ahead:
+                perceptions_before = self.own_flood_perceptions()
+            if self.engine == 'vectorized':
+                #All households are stepped at once, so only the clock of the schedule has to be advanced
+                self.households.step()
+                self.advance_clock()
+            elif self.profiler is not None:
+                self.profiled_households_step()
+            else:
+                self.schedule.step()
+            if self.skip_ahead:
+                self.perceptions_settled = np.array_equal(perceptions_before, self.own_flood_perceptions())
+        if (self.perceptions_settled and self.schedule.steps < self.next_flood_step()
+                and not self.any_household_saving()):
+            self.skip_to_flood()
+
+    def profiled_households_step(self):
+        """
+        The step of all Households agents, as schedule.step does it, with every phase of Households.step profiled per
+        household
+        """
+        profiler = self.profiler
+        start, stop = profiler.start, profiler.stop
+        for agent in self.schedule.agents:
+            started = start()
+            agent.calculate_network_flood_perception(self.all_households)
+            stop('network_perception', started)
+            started = start()
+            agent.change_own_flood_perception()
+            stop('own_perception', started)
+            started = start()
+            agent.decide_on_optimal_adaptation()
+            stop('decision', started)
+            started = start()
+            agent.save_income()
+            stop('saving', started)
+            started = start()
+            agent.execute_adaptation()
+            stop('adaptation', started)
+        self.advance_clock()
+
+    def step_flood_events(self):
+        """Apply the flood event of this step, if there is one, and draw the step of the next event"""
+        rng = self.numpy_stream('flood')
+        if self.flood_ensemble.next_event is None:
+            self.flood_ensemble.draw_next_event(0, rng)
+        if self.schedule.steps == self.flood_ensemble.next_event:
+            with self.phase('flood_event'):
+                self.apply_flood_event(rng)
+            self.flood_ensemble.draw_next_event(self.schedule.steps, rng)
+
+    def apply_flood_event(self, rng):
+        """
+        A flood event of the ensemble (see flood_events.py), applied to all households at once
+        """
+        if self.engine == 'vectorized':
+            households = self.households
+            x, y, adaptation_depth = households.x, households.y, households.adaptation_depth
+            flood_depth_estimated = households.flood_depth_estimated
+        else:
+            agents = self.schedule.agents
+            x = np.array([agent.x for agent in agents])
+            y = np.array([agent.y for agent in agents])
+            adaptation_depth = np.array([agent.adaptation_depth for agent in agents], dtype=float)
+            flood_depth_estimated = np.array([agent.flood_depth_estimated for agent in agents], dtype=float)
+        flood_map, intensity, depths = self.flood_ensemble.draw_event(rng, x, y, flood_depth_estimated,
+                                                                      adaptation_depth)
+        if self.engine == 'vectorized':
+            damages = self.households.apply_flood_depths(depths)
+        else:
+            housesizes = np.array([agent.housesize for agent in agents], dtype=float)
+            damages = self.depth_damage.damage(depths, housesizes)
+            # The households add the change of their damage to the totals of the model
+            for agent, depth, damage in zip(agents, depths.tolist(), damages.tolist()):
+                agent.flood_depth_actual = depth
+                agent.flood_damage_actual = damage
+        self.flood_ensemble.history.record(self.schedule.steps, flood_map, intensity, depths, damages)
+
+    def next_flood_step(self):
+        """The step of the next flood: the flood step, or with flood events the next event (at most number_of_steps,
+        where model_run ends)"""
+        if self.flood_ensemble is not None:
+            return min(self.flood_ensemble.next_event, self.number_of_steps)
+        return self.flood_step
+
+    def apply_flood(self):
+        """
+        The flood: the actual flood depth of every household is a random number between 0.5 and 1.2 times the
+        estimated flood depth
+        """
+        if self.engine == 'vectorized':
+            self.households.flood(self.numpy_stream('flood').uniform(0.5, 1.2, size=self.number_of_households))
+            return
+        rng = self.random_stream('flood')
+        for agent in self.schedule.agents:
+            # Calculate the actual flood depth as a random number between 0.5 and 1.2 times the estimated flood depth
+            agent.flood_depth_actual = rng.uniform(0.5, 1.2) * agent.flood_depth_estimated
+            # calculate the actual flood damage given the actual flood depth, which the household adds to the totals
+            agent.flood_damage_actual = self.depth_damage.scalar_damage(agent.flood_depth_actual, agent.housesize)
+
+    def advance_clock(self):
+        """Advance the clock of the schedule by one step without stepping the households"""
+        self.schedule.steps += 1
+        self.schedule.time += 1
+
+    def own_flood_perceptions(self):
+        """Return the own flood perception of every household as an array"""
+        if self.engine == 'vectorized':
+            return self.households.own_flood_perception.copy()
+        return np.array([agent.own_flood_perception for agent in self.schedule.agents])
+
+    def any_household_saving(self):
+        """Return whether any household is still saving for an adaptation measure"""
+        if self.engine == 'vectorized':
+            return np.any(self.households.going_to_adapt & ~self.households.is_adapted)
+        return any(agent.going_to_adapt and not agent.is_adapted for agent in self.schedule.agents)
+
+    def step_saving_households(self):
+        """
+        One step once the flood perceptions have settled. No perception changed in a whole step, so the network
+        perceptions and therefore the perceptions and decisions of all households stay the same until the flood. Only
+        the households that are going to adapt still change: they save and adapt, the other households are skipped.
+        """
+        started = self.start_phase()
+        if self.engine == 'vectorized':
+            self.households.step_saving_households()
+        else:
+            for agent in self.schedule.agents:
+                if agent.going_to_adapt and not agent.is_adapted:
+                    agent.save_income()
+                    agent.execute_adaptation()
+        self.stop_phase('saving_households', started)
+        self.advance_clock()
 
+    def skip_to_flood(self):
+        """
+        Jump straight to the flood step once the households can no longer change state: the perceptions have settled
+        and every household has either adapted or is not going to adapt (e.g. because its perception is 1). The steps
+        in between would not change anything, so their data is the data of the current step, collected once and
+        then repeated.
+        """
+        flood_step = self.next_flood_step()
+        self.datacollector.collect(self)
+        with self.phase('skip_to_flood'):
+            self.datacollector.repeat_last_row(range(self.schedule.steps + 1, flood_step))
+        self.schedule.steps = flood_step
+        self.schedule.time = flood_step
 
+    def model_run(self):
+        # Runs the steps 0 ... number_of_steps - 1, as the model always has. The model stops earlier when the flood has
+        # taken place, see step(). The set of rules for agents and their behavior flowing from this set is only
+        # relevant before a flood. (batch_run and experiments.run_model also run step number_of_steps.)
+        while self.running and self.schedule.steps < self.number_of_steps:
+            self.step()
+        if self.profiler is not None:
+            self.profiler.close()
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+"""
+Precomputed neighbour index of the social network.
+
+The network does not change after AdaptationModel.initialize_network, so the friends of every household are stored
+once in compressed sparse row (CSR) form: the friends of household i are indices[indptr[i]:indptr[i + 1]]. This
+replaces the calls to NetworkGrid.get_neighborhood in every step, and keeps its order of the friends: the order of the
+edges of the household in the edge array (the order of G.neighbors for a networkx graph, see graph_edges), and sorted
+by index for friends of friends. The most common perception among the friends breaks ties by this order, as
+Counter.most_common does.
+"""
+import numpy as np
+
+
+def gather_rows(indptr, indices, rows):
+    """
+    Gather several rows of a CSR index at once.
+
+    Parameters
+    ----------
+    indptr, indices: CSR arrays
+    rows: indices of the rows to gather
+
+    Returns
+    -------
+    position, values: for every gathered entry the position of its row within rows, and its value
+    """
+    starts = indptr[rows]
+    lengths = indptr[rows + 1] - starts
+    position = np.repeat(np.arange(len(rows)), lengths)
+    offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    return position, indices[np.repeat(starts, lengths) + offsets]
+
+
+def graph_edges(G):
+    """
+    The edges of a networkx graph whose nodes are 0 to n - 1, in an order in which every node meets its neighbours in
+    the order of G.neighbors. Such an order exists because networkx appends a neighbour when an edge is added, so
+    the edges are put in the order in which they were added, as far as the neighbours of the nodes tell it.
+
+    Returns
+    -------
+    edges: array of shape (number of edges, 2)
+    """
+    adjacency = [[neighbour for neighbour in G.adj[node] if neighbour != node] for node in range(G.number_of_nodes())]
+    position = [0] * len(adjacency)
+    edges = []
+    # An edge is added as soon as it is the next neighbour of both its nodes
+    waiting = list(range(len(adjacency)))
+    while waiting:
+        node = waiting.pop()
+        while position[node] < len(adjacency[node]):
+            neighbour = adjacency[node][position[node]]
+            if adjacency[neighbour][position[neighbour]] != node:
+                break
+            edges.append((node, neighbour))
+            position[node] += 1
+            position[neighbour] += 1
+            waiting.append(neighbour)
+    return np.array(edges, dtype=np.int64).reshape(-1, 2)
+
+
+class NeighbourIndex:
+    """
+    CSR adjacency of the social network, optionally including friends of friends up to a given radius.
+    """
+
+    def __init__(self, indptr, indices, radius=1):
+        self.indptr = indptr
+        self.indices = indices
+        self.radius = radius
+        self.number_of_households = len(indptr) - 1
+
+    @classmethod
+    def from_edges(cls, number_of_households, edges, radius=1):
+        """
+        Build the index from an array of undirected edges.
+
+        Parameters
+        ----------
+        number_of_households: number of nodes in the network
+        edges: array of shape (number of edges, 2) with the node pairs
+        radius: number of steps through the network within which households are friends
+
+        Returns
+        -------
+        neighbour_index: NeighbourIndex
+        """
+        if radius < 1:
+            raise ValueError(f"The network radius must be at least 1, got {radius}")
+        edges = np.asarray(edges, dtype=np.int64).reshape(-1, 2)
+        # Both directions of every edge, in the order of the edges
+        indptr, indices = cls.compress(number_of_households, edges.reshape(-1), edges[:, ::-1].reshape(-1),
+                                       keep_order=True)
+
+        # Friends of friends are found by taking one more step through the network from every pair reached so far
+        reach_indptr, reach_indices = indptr, indices
+        for _ in range(radius - 1):
+            reach_source = np.repeat(np.arange(number_of_households), np.diff(reach_indptr))
+            position, next_target = gather_rows(indptr, indices, reach_indices)
+            reach_indptr, reach_indices = cls.compress(number_of_households,
+                                                       np.concatenate([reach_source, reach_source[position]]),
+                                                       np.concatenate([reach_indices, next_target]))
+        return cls(reach_indptr, reach_indices, radius)
+
+    @classmethod
+    def from_graph(cls, G, radius=1):
+        """Build the index from a networkx graph whose nodes are 0 to n - 1"""
+        return cls.from_edges(G.number_of_nodes(), graph_edges(G), radius)
+
+    @staticmethod
+    def compress(number_of_households, source, target, keep_order=False):
+        """
+        Return CSR arrays of the (source, target) pairs, without duplicates and without self-loops. The targets of a
+        source are sorted, or with keep_order in the order of their first pair.
+        """
+        keys = source * number_of_households + target
+        if keep_order:
+            first = np.unique(keys, return_index=True)[1]
+            first.sort()
+            keys = keys[first]
+            keys = keys[np.argsort(keys // number_of_households, kind='stable')]
+        else:
+            keys = np.unique(keys)
+        source, target = np.divmod(keys, number_of_households)
+        keep = source != target
+        source, target = source[keep], target[keep]
+        indptr = np.zeros(number_of_households + 1, dtype=np.int64)
+        np.cumsum(np.bincount(source, minlength=number_of_households), out=indptr[1:])
+        return indptr, target
+
+    def friends(self, index):
+        """Return the indices of the friends of a single household"""
+        return self.indices[self.indptr[index]:self.indptr[index + 1]]
+
+    def sources(self):
+        """Return the household every entry of indices belongs to"""
+        return np.repeat(np.arange(self.number_of_households), np.diff(self.indptr))
+
+    def greedy_colouring(self):
+        """
+        Greedy colouring of the network: households with the same colour are never friends of each other.
+
+        Returns
+        -------
+        colour: array with the colour of every household, starting at 0
+        """
+        colour = [-1] * self.number_of_households
+        indptr, indices = self.indptr.tolist(), self.indices.tolist()
+        for household in range(self.number_of_households):
+            taken = {colour[friend] for friend in indices[indptr[household]:indptr[household + 1]]}
+            c = 0
+            while c in taken:
+                c += 1
+            colour[household] = c
+        return np.array(colour, dtype=np.int64)
+
+    def most_common_perception(self, perceptions, households=None):
+        """
+        Most common perception among the friends of every household, in one batched bincount.
+
+        Parameters
+        ----------
+        perceptions: array with the own flood perception (1 to 4) of every household
+        households: optional indices of the households to calculate it for, by default all households
+
+        Returns
+        -------
+        network_perception: array with the most common perception, -1 for households without friends. Ties go to
+        the perception that comes first among the friends, as with Counter.most_common in the agents engine.
+        """
+        if households is None:
+            households = np.arange(self.number_of_households)
+        n = len(households)
+        position, friend = gather_rows(self.indptr, self.indices, households)
+
+        # Count per household how many friends have each perception (columns 0 to 4)
+        key = position * 5 + perceptions[friend]
+        counts = np.bincount(key, minlength=n * 5).reshape(n, 5)
+        # The entries of every household are gathered in the order of its friends
+        first_entry = np.full(n * 5, len(friend), dtype=np.int64)
+        np.minimum.at(first_entry, key, np.arange(len(friend)))
+        score = counts * (len(friend) + 1) - first_entry.reshape(n, 5)
+        network_perception = np.argmax(score, axis=1)
+        network_perception[counts.sum(axis=1) == 0] = -1
+        return network_perception
@@ -0,0 +1,291 @@
+# -*- coding: utf-8 -*-
+"""
+Native generators of the social networks, for very large numbers of households.
+
+The networkx generators build a graph of Python dictionaries, and erdos_renyi_graph checks every pair of nodes, which
+takes O(n^2) time. The generators below produce the same network families directly as arrays of edges with numpy, in
+O(n + m) time and memory for n households and m edges. The model uses them with network_backend='native'; the
+neighbour index (see neighbour_index.py) is built from the edges, and the networkx graph is only built when it is
+used, e.g. for plotting (AdaptationModel.G).
+
+The networks have the same distribution as those of networkx, but not the same edges for the same seed:
+- watts_strogatz_edges rewires all edges of the ring lattice at once, instead of one after the other.
+- barabasi_albert_edges draws the targets of all new nodes at once from the (not yet known) list of edge endpoints,
+  and resolves them afterwards.
+- erdos_renyi_edges draws the number of edges and then the edges themselves, instead of considering every pair.
+
+spatial_edges has no networkx counterpart: it connects households that live close to each other on the map, using a
+KD-tree of their locations, and is used by both network backends.
+
+All generators return an array of shape (edges, 2) with every undirected edge once, as (smaller node, larger node).
+"""
+import numpy as np
+
+# Number of times a rewired edge of watts_strogatz_edges is drawn again before it keeps its lattice edge
+MAXIMUM_REWIRING_ROUNDS = 100
+
+
+def pair_keys(edges, number_of_nodes):
+    """A single integer per undirected edge, the same for (u, v) and (v, u)"""
+    return np.minimum(edges[:, 0], edges[:, 1]) * number_of_nodes + np.maximum(edges[:, 0], edges[:, 1])
+
+
+def ordered_edges(source, target):
+    """Edges as (smaller node, larger node)"""
+    return np.stack([np.minimum(source, target), np.maximum(source, target)], axis=1).astype(np.int64)
+
+
+def complete_edges(number_of_nodes):
+    """All edges between number_of_nodes nodes"""
+    source, target = np.triu_indices(number_of_nodes, k=1)
+    return ordered_edges(source, target)
+
+
+def watts_strogatz_edges(number_of_nodes, k, p, rng):
+    """
+    Watts-Strogatz small-world network: a ring lattice in which every node is connected to its k // 2 nearest
+    neighbours on both sides, after which every edge is rewired to a random node with probability p. Rewired edges
+    that would give a self-loop or a duplicate edge are drawn again.
+
+    Parameters
+    ----------
+    number_of_nodes: number of nodes
+    k: number of nearest neighbours in the ring lattice
+    p: probability of rewiring an edge
+    rng: numpy random generator
+    """
+    n = number_of_nodes
+    if k > n:
+        raise ValueError(f"The number of nearest neighbours ({k}) cannot be larger than the number of nodes ({n})")
+    if 2 * (k // 2) >= n - 1:
+        # The ring lattice already connects every pair of nodes, so no edge can be rewired
+        return complete_edges(n)
+    source = np.tile(np.arange(n), k // 2)
+    lattice_target = (source + np.repeat(np.arange(1, k // 2 + 1), n)) % n
+    return ordered_edges(source, rewire_targets(source, lattice_target, n, p, rng))
+
+
+def rewire_targets(source, target, number_of_nodes, p, rng):
+    """
+    Rewire every edge (source, target) to a random target node with probability p. Rewired edges that would give a
+    self-loop or a duplicate edge are drawn again, up to MAXIMUM_REWIRING_ROUNDS times.
+
+    Parameters
+    ----------
+    source, target: arrays with the nodes of the edges, every undirected edge once
+    number_of_nodes: number of nodes
+    p: probability of rewiring an edge
+    rng: numpy random generator
+
+    Returns
+    -------
+    target: array with the new target of every edge
+    """
+    original_target = target
+    target = target.copy()
+    rewired = rng.random(len(source)) < p
+    redraw = rewired.copy()
+    rounds = 0
+    while redraw.any():
+        rounds += 1
+        if rounds > MAXIMUM_REWIRING_ROUNDS:
+            # In almost complete networks the last edges may have no free node left, they keep their original edge
+            rewired &= ~redraw
+            target[redraw] = original_target[redraw]
+        else:
+            target[redraw] = rng.integers(0, number_of_nodes, size=int(redraw.sum()))
+        # Of the edges that connect the same nodes, the first original edge (or the first rewired edge) stays
+        keys = pair_keys(np.stack([source, target], axis=1), number_of_nodes)
+        order = np.lexsort((np.arange(len(keys)), rewired, keys))
+        duplicate = np.zeros(len(keys), dtype=bool)
+        duplicate[order[1:]] = keys[order[1:]] == keys[order[:-1]]
+        redraw = rewired & (duplicate | (source == target))
+    return target
+
+
+def follow_references(positions, reference, is_target_slot, flags):
+    """
+    Follow the positions of the targets of barabasi_albert_edges back to a position with a known node.
+
+    Parameters
+    ----------
+    positions: position in the endpoint list that every target was drawn from
+    reference: for every position of a target, the position it was drawn from
+    is_target_slot: whether a position is a target, whose node has to be looked up further
+    flags: boolean per position
+
+    Returns
+    -------
+    known: for every target, the position of the known node it refers to
+    flagged: for every target, whether a flagged position was passed on the way
+    """
+    known = positions.copy()
+    flagged = np.zeros(len(positions), dtype=bool)
+    following = np.arange(len(positions))
+    while len(following):
+        pointer = known[following]
+        flagged[following] |= flags[pointer]
+        following = following[is_target_slot[pointer]]
+        known[following] = reference[known[following]]
+    return known, flagged
+
+
+def barabasi_albert_edges(number_of_nodes, m, rng):
+    """
+    Barabasi-Albert preferential attachment network: starting from a star of m + 1 nodes, every new node connects to
+    m different existing nodes, chosen with a probability proportional to their degree.
+
+    As in networkx, the targets are drawn from the list of all edge endpoints so far, in which every node occurs as
+    often as its degree. The length of this list before every new node is known beforehand, so the positions in the
+    list are drawn for all nodes at once. A position refers either to a known node (the initial star or a new node
+    itself) or to a target of an earlier node, which is resolved by following the references back to a known node.
+    A node that drew the same target twice draws again, as in networkx, but only once the targets of all nodes it
+    refers to are final, so the network has the same distribution as when the nodes are added one after the other.
+
+    Parameters
+    ----------
+    number_of_nodes: number of nodes
+    m: number of edges of every new node
+    rng: numpy random generator
+    """
+    n = number_of_nodes
+    if m < 1 or m >= n:
+        raise ValueError(f"The number of edges of a new node must be at least 1 and smaller than the number of nodes "
+                         f"({n}), got {m}")
+    new_nodes = np.arange(m + 1, n)
+    # The endpoint list: the initial star (centre 0 m times, then the leaves), then for every new node its m targets
+    # followed by m times the node itself
+    endpoints = np.empty(2 * m + 2 * m * len(new_nodes), dtype=np.int64)
+    endpoints[:m] = 0
+    endpoints[m:2 * m] = np.arange(1, m + 1)
+    block_starts = 2 * m + 2 * m * np.arange(len(new_nodes))
+    target_slots = (block_starts[:, None] + np.arange(m)).reshape(-1)
+    own_slots = (block_starts[:, None] + m + np.arange(m)).reshape(-1)
+    endpoints[own_slots] = np.repeat(new_nodes, m)
+    is_target_slot = np.zeros(len(endpoints), dtype=bool)
+    is_target_slot[target_slots] = True
+    # Every target is drawn from the part of the list before the block of its node
+    list_lengths = np.repeat(block_starts, m)
+    no_flags = np.zeros(len(endpoints), dtype=bool)
+
+    positions = np.zeros(len(target_slots), dtype=np.int64)
+    reference = np.zeros(len(endpoints), dtype=np.int64)
+    redraw = np.ones(len(target_slots), dtype=bool)
+    while redraw.any():
+        positions[redraw] = (rng.random(int(redraw.sum())) * list_lengths[redraw]).astype(np.int64)
+        reference[target_slots] = positions
+        known, _ = follow_references(positions, reference, is_target_slot, no_flags)
+        endpoints[target_slots] = endpoints[known]
+
+        # The targets that a node drew before (a node connects to m different nodes)
+        targets = endpoints[target_slots].reshape(-1, m)
+        order = np.argsort(targets, axis=1, kind='stable')
+        sorted_targets = np.take_along_axis(targets, order, axis=1)
+        repeated = np.zeros(targets.shape, dtype=bool)
+        np.put_along_axis(repeated, order[:, 1:], sorted_targets[:, 1:] == sorted_targets[:, :-1], axis=1)
+        drawing_again = repeated.any(axis=1)
+        # Targets of nodes that refer to a node that draws again are not final yet, those nodes wait
+        unsettled = np.zeros(len(endpoints), dtype=bool)
+        unsettled[target_slots] = np.repeat(drawing_again, m)
+        _, refers_to_unsettled = follow_references(positions, reference, is_target_slot, unsettled)
+        waiting = refers_to_unsettled.reshape(-1, m).any(axis=1)
+        redraw = (repeated & (drawing_again & ~waiting)[:, None]).reshape(-1)
+
+    star = ordered_edges(np.zeros(m, dtype=np.int64), np.arange(1, m + 1))
+    return np.concatenate([star, ordered_edges(np.repeat(new_nodes, m), endpoints[target_slots])])
+
+
+def erdos_renyi_edges(number_of_nodes, p, rng):
+    """
+    Erdos-Renyi random network G(n, p), in which every pair of nodes is connected with probability p. The number of
+    edges is drawn from its binomial distribution, and the edges are a sample of that size without replacement of all
+    pairs, numbered as in a lower triangular matrix.
+
+    Parameters
+    ----------
+    number_of_nodes: number of nodes
+    p: probability of an edge between two nodes
+    rng: numpy random generator
+    """
+    n = number_of_nodes
+    if not 0 <= p <= 1:
+        raise ValueError(f"The probability of an edge must be between 0 and 1, got {p}")
+    number_of_pairs = n * (n - 1) // 2
+    number_of_edges = int(rng.binomial(number_of_pairs, p)) if number_of_pairs else 0
+    keys = rng.choice(number_of_pairs, size=number_of_edges, replace=False, shuffle=False) if number_of_edges else \
+        np.zeros(0, dtype=np.int64)
+    keys = np.sort(keys).astype(np.int64)
+    # Pair number k is the pair (i, j) with j < i and k = i (i - 1) / 2 + j
+    larger = np.floor((1 + np.sqrt(1 + 8 * keys.astype(float))) / 2).astype(np.int64)
+    larger[larger * (larger - 1) // 2 > keys] -= 1
+    larger[(larger + 1) * larger // 2 <= keys] += 1
+    return ordered_edges(keys - larger * (larger - 1) // 2, larger)
+
+
+def spatial_edges(x, y, k, radius, p, rng):
+    """
+    Spatial network: every household is connected to the households that live closest to it, either its k nearest
+    neighbours or all households within a distance radius, after which every edge is rewired to a random household
+    with probability p, which gives long-range ties as in the Watts-Strogatz network. The neighbours are looked up in
+    a KD-tree of the locations, which takes O(n log n) time.
+
+    With k nearest neighbours, two households are connected when either of them is among the nearest neighbours of the
+    other, so every household has at least k friends (fewer only when there are fewer other households).
+
+    Parameters
+    ----------
+    x, y: arrays with the coordinates of the households on the map
+    k: number of nearest neighbours, used when radius is None
+    radius: distance in map units within which households are connected, or None to use the k nearest neighbours
+    p: probability of rewiring an edge to a random household
+    rng: numpy random generator, only used for the rewiring
+    """
+    # scipy is only imported for the spatial network
+    from scipy.spatial import cKDTree
+
+    n = len(x)
+    if n < 2:
+        return np.zeros((0, 2), dtype=np.int64)
+    tree = cKDTree(np.column_stack([x, y]))
+    if radius is not None:
+        if radius < 0:
+            raise ValueError(f"The radius of the spatial network cannot be negative, got {radius}")
+        edges = tree.query_pairs(radius, output_type='ndarray').astype(np.int64).reshape(-1, 2)
+        # query_pairs returns the pairs in no particular order
+        edges = edges[np.argsort(pair_keys(edges, n), kind='stable')]
+    else:
+        if k < 1:
+            raise ValueError(f"The number of nearest neighbours of the spatial network must be at least 1, got {k}")
+        k = min(k, n - 1)
+        # The nearest neighbour of every household is itself (or another household at the same location)
+        _, neighbours = tree.query(np.column_stack([x, y]), k=k + 1)
+        source = np.repeat(np.arange(n), k + 1)
+        target = neighbours.reshape(-1).astype(np.int64)
+        edges = np.stack([source, target], axis=1)[source != target]
+        _, first = np.unique(pair_keys(edges, n), return_index=True)
+        edges = edges[first]
+    return ordered_edges(edges[:, 0], rewire_targets(edges[:, 0], edges[:, 1], n, p, rng))
+
+
+def network_edges(network, number_of_nodes, rng, probability_of_network_connection, number_of_edges,
+                  number_of_nearest_neighbours, locations=None, spatial_radius=None):
+    """
+    The edges of a network type of the model, with the same parameters as AdaptationModel.initialize_network. The
+    spatial network also needs the locations (x, y) of the households.
+    """
+    if network == 'erdos_renyi':
+        return erdos_renyi_edges(number_of_nodes, number_of_nearest_neighbours / number_of_nodes, rng)
+    elif network == 'barabasi_albert':
+        return barabasi_albert_edges(number_of_nodes, number_of_edges, rng)
+    elif network == 'watts_strogatz':
+        return watts_strogatz_edges(number_of_nodes, number_of_nearest_neighbours, probability_of_network_connection,
+                                    rng)
+    elif network == 'spatial':
+        x, y = locations
+        return spatial_edges(x, y, number_of_nearest_neighbours, spatial_radius, probability_of_network_connection,
+                             rng)
+    elif network == 'no_network':
+        return np.zeros((0, 2), dtype=np.int64)
+    raise ValueError(f"Unknown network type: '{network}'. "
+                     f"Currently implemented network types are: "
+                     f"'erdos_renyi', 'barabasi_albert', 'watts_strogatz', 'spatial', and 'no_network'")
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+"""
+Per-phase profiling of the Flood Adaptation Model.
+
+With AdaptationModel(profile=True), the model records the wall time and number of calls of every phase of its
+initialization and of every step:
+- initialization (step -1): maps (flood map and depth-damage function), network (locations of a spatial network,
+  network generation, grid and neighbour index) and households (creation and running totals)
+- steps: network_perception, own_perception, decision, saving and adaptation of the households, saving_households
+  (the steps after the perceptions settled, see AdaptationModel.step_saving_households), skip_to_flood and flood
+- data collection: collect/<reporter> for every model and agent reporter
+
+With profile_memory=True, the memory allocated by every phase (the net change) and its peak allocation are measured
+with tracemalloc as well, which makes the model several times slower. model_run stops tracemalloc again at the end of
+the run (PhaseProfiler.close), a model that is stepped by other code should call model.profiler.close() itself.
+
+The phases of the households are timed per household with the agents engine, so the overhead of the timer is
+included in their time; the vectorized engine times every phase once per step. Without profiling, the model has no
+profiler (model.profiler is None) and only checks for it once per phase.
+
+A profile is a DataFrame with a row per step and phase (PhaseProfiler.dataframe). run_experiments(..., profile=True)
+sends the profile of every run back from the worker processes (ExperimentResults.profile_dataframe), and summarize
+aggregates the profiles of any number of runs per phase:
+
+    model = AdaptationModel(number_of_households=1000, profile=True)
+    model.model_run()
+    print_summary(model.profiler.dataframe())
+"""
+import time
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+
+import numpy as np
+import pandas as pd
+
+# Step of the phases of the initialization of the model
+INITIALIZATION_STEP = -1
+
+PROFILE_COLUMNS = ('Step', 'Phase', 'Calls', 'Seconds', 'MemoryAllocated', 'MemoryPeak')
+
+# Context manager of the phases of a model without profiler, which does nothing
+NO_PHASE = nullcontext()
+
+
+class PhaseProfiler:
+    """
+    Records the wall time, number of calls and optionally the memory allocations of the phases of a model.
+
+    Parameters
+    ----------
+    memory: also measure the allocated and peak memory of every phase with tracemalloc, which is started if it is not
+        tracing yet and stopped again by close
+
+    Attributes
+    ----------
+    step: the step the phases are recorded for, set by the model at the start of every step
+    records: dictionary {(step, phase): [calls, seconds, allocated bytes, peak bytes]}
+    """
+
+    def __init__(self, memory=False):
+        self.memory = memory
+        self.step = INITIALIZATION_STEP
+        self.records = {}
+        # Whether this profiler started tracemalloc, which slows down everything that runs in the process after it
+        self.started_tracing = memory and not tracemalloc.is_tracing()
+        if self.started_tracing:
+            tracemalloc.start()
+
+    def close(self):
+        """Stop measuring memory, and stop tracemalloc if this profiler started it. The phases are still timed"""
+        if self.started_tracing:
+            tracemalloc.stop()
+            self.started_tracing = False
+        self.memory = False
+
+    def start(self):
+        """Start timing a phase, returns the token that is passed to stop"""
+        if self.memory:
+            tracemalloc.reset_peak()
+            return time.perf_counter(), tracemalloc.get_traced_memory()[0]
+        return time.perf_counter(), 0
+
+    def stop(self, phase, token, calls=1):
+        """Add the time (and memory) since start to a phase of the current step"""
+        seconds = time.perf_counter() - token[0]
+        record = self.records.get((self.step, phase))
+        if record is None:
+            record = self.records[(self.step, phase)] = [0, 0.0, 0, 0]
+        record[0] += calls
+        record[1] += seconds
+        if self.memory:
+            current, peak = tracemalloc.get_traced_memory()
+            record[2] += current - token[1]
+            record[3] = max(record[3], peak - token[1])
+
+    @contextmanager
+    def phase(self, phase):
+        """Context manager that records the code in it as a phase of the current step"""
+        token = self.start()
+        try:
+            yield
+        finally:
+            self.stop(phase, token)
+
+    def columns(self):
+        """The profile as a dictionary of arrays {column: values}, with the PROFILE_COLUMNS"""
+        keys = list(self.records)
+        values = np.array(list(self.records.values()), dtype=np.float64).reshape(-1, 4)
+        return {'Step': np.array([step for step, _ in keys], dtype=np.int64),
+                'Phase': np.array([phase for _, phase in keys], dtype=object),
+                'Calls': values[:, 0].astype(np.int64),
+                'Seconds': values[:, 1],
+                'MemoryAllocated': values[:, 2].astype(np.int64),
+                'MemoryPeak': values[:, 3].astype(np.int64)}
+
+    def dataframe(self):
+        """DataFrame with a row per step and phase, see PROFILE_COLUMNS. Memory is in bytes, 0 without memory"""
+        return pd.DataFrame(self.columns())
+
+
+def summarize(profile, by='Phase'):
+    """
+    Aggregate profiles, e.g. of all runs of an experiment, per phase.
+
+    Parameters
+    ----------
+    profile: DataFrame with the PROFILE_COLUMNS, and any other columns such as RunId
+    by: column or list of columns to aggregate by, e.g. ['subsidies_package', 'Phase']
+
+    Returns
+    -------
+    summary: DataFrame with per group the number of calls, the total seconds, the share of the total time of its
+        runs, the mean seconds per call, the allocated memory and the largest peak memory, sorted by total seconds
+    """
+    by = [by] if isinstance(by, str) else list(by)
+    summary = profile.groupby(by).agg(Calls=('Calls', 'sum'), Seconds=('Seconds', 'sum'),
+                                      MemoryAllocated=('MemoryAllocated', 'sum'), MemoryPeak=('MemoryPeak', 'max'))
+    groups = [name for name in by if name != 'Phase']
+    totals = summary.groupby(level=groups)['Seconds'].transform('sum') if groups else summary['Seconds'].sum()
+    summary.insert(2, 'Share', summary['Seconds'] / totals)
+    summary.insert(3, 'SecondsPerCall', summary['Seconds'] / summary['Calls'])
+    return summary.sort_values('Seconds', ascending=False)
+
+
+def print_summary(profile, by='Phase', top=None):
+    """Print the summary of profiles (see summarize), optionally only the top phases"""
+    summary = summarize(profile, by)
+    if top is not None:
+        summary = summary.head(top)
+    memory = summary['MemoryPeak'].any()
+    print(f"{'Phase':<44} {'Calls':>9} {'Seconds':>10} {'Share':>7} {'Per call':>10}" +
+          (f" {'Allocated':>11} {'Peak':>11}" if memory else ''))
+    for group, row in summary.iterrows():
+        name = ' / '.join(str(value) for value in group) if isinstance(group, tuple) else str(group)
+        line = (f"{name:<44} {int(row['Calls']):>9} {row['Seconds']:>10.4f} {row['Share']:>7.1%} "
+                f"{row['SecondsPerCall'] * 1e6:>8.1f}us")
+        if memory:
+            line += f" {row['MemoryAllocated'] / 2 ** 20:>9.2f}MB {row['MemoryPeak'] / 2 ** 20:>9.2f}MB"
+        print(line)
@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+"""
+Content-addressed cache of finished experiment runs.
+
+Every run is identified by a key: the SHA-256 hash of its model parameters (including the seed), the run options
+(max_steps, data_collection_period, collect_agents) and the version of the model code, which is the hash of the
+modules of the model directory that a run imports (experiments.py and everything it imports, directly or within
+functions). A finished run is stored under its key, so running a sweep again, e.g. after it was interrupted or with one
+more parameter value, only runs the combinations that are not in the cache yet. Any change to the code of a run gives
+new keys, so results of old code are never used, while changes to other files (e.g. benchmark.py, sensitivity.py or
+the tests) keep the cached runs.
+
+Parameters that have no canonical JSON representation (see canonical) cannot be part of a key.
+
+Only runs with a seed are cached, since a run without a seed cannot be repeated.
+
+The cache is a directory with two files per run: <key>.pkl with the collected data and <key>.json with its size,
+checksum, parameters and the time it was last used. When the cache grows beyond max_size bytes, the least recently
+used runs are evicted. The cache can be managed from the command line:
+
+    python result_cache.py list ../output_data/run_cache
+    python result_cache.py verify ../output_data/run_cache --remove
+    python result_cache.py evict ../output_data/run_cache --max-size 2G
+"""
+import argparse
+import ast
+import glob
+import hashlib
+import json
+import os
+import pickle
+import time
+
+import numpy as np
+
+from flood_map_cache import write_atomic
+
+# Increase when the layout of the cache files changes, which gives all runs new keys
+CACHE_VERSION = 1
+
+SIZE_UNITS = {'': 1, 'K': 2 ** 10, 'M': 2 ** 20, 'G': 2 ** 30, 'T': 2 ** 40}
+
+# The module that runs the runs of an experiment, the code version covers it and the modules it imports
+RUN_MODULE = 'experiments'
+
+_code_version = None
+
+
+def imported_modules(name, directory):
+    """
+    The modules of a directory that a module imports, directly or through other modules of the directory, including
+    the imports within functions.
+
+    Returns
+    -------
+    names: sorted list of module names, including name itself
+    """
+    found = set()
+    pending = [name]
+    while pending:
+        module = pending.pop()
+        path = os.path.join(directory, f'{module}.py')
+        if module in found or not os.path.exists(path):
+            continue
+        found.add(module)
+        with open(path, 'rb') as file:
+            tree = ast.parse(file.read(), path)
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                pending.extend(alias.name.split('.')[0] for alias in node.names)
+            elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+                pending.append(node.module.split('.')[0])
+    return sorted(found)
+
+
+def code_version():
+    """Hash of the source of the modules of the model directory that a run imports"""
+    global _code_version
+    if _code_version is None:
+        directory = os.path.dirname(os.path.abspath(__file__))
+        digest = hashlib.sha256()
+        for module in imported_modules(RUN_MODULE, directory):
+            digest.update(f'{module}.py'.encode())
+            with open(os.path.join(directory, f'{module}.py'), 'rb') as file:
+                digest.update(hashlib.sha256(file.read()).digest())
+        _code_version = digest.hexdigest()
+    return _code_version
+
+
+def canonical(value):
+    """
+    JSON representation of values that json does not know, e.g. numpy numbers. Other values raise a TypeError, as
+    their repr() is not stable (it can contain a memory address), so keys built from it would never be found again.
+    """
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    raise TypeError(f"Object of type {type(value).__name__} has no canonical JSON representation")
+
+
+def parse_size(size):
+    """Parse a size in bytes, optionally with a unit: 500M, 2G"""
+    size = str(size).strip().upper().rstrip('B')
+    unit = size[-1] if size and size[-1] in SIZE_UNITS else ''
+    return int(float(size[:len(size) - len(unit)]) * SIZE_UNITS[unit])
+
+
+class ResultCache:
+    """
+    Cache of RunResults in a directory, see the module description.
+
+    Parameters
+    ----------
+    cache_dir: directory of the cache, created when needed
+    max_size: maximum total size of the cached runs in bytes (or a string like '2G'), None for no limit
+    """
+
+    def __init__(self, cache_dir, max_size=None):
+        self.cache_dir = cache_dir
+        self.max_size = None if max_size is None else parse_size(max_size)
+        self.total_size = None  # Counted on the first put with a max_size
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, parameters, run_options):
+        """The key of a run, or None for runs without a seed"""
+        if parameters.get('seed') is None:
+            return None
+        identity = {'version': CACHE_VERSION, 'code': code_version(), 'parameters': parameters, 'options': run_options}
+        text = json.dumps(identity, sort_keys=True, default=canonical)
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    def paths(self, key):
+        return os.path.join(self.cache_dir, f'{key}.pkl'), os.path.join(self.cache_dir, f'{key}.json')
+
+    def read_entry(self, key):
+        """The sidecar of a cached run, or None when the run is not (completely) cached"""
+        data_path, sidecar_path = self.paths(key)
+        if not (os.path.exists(data_path) and os.path.exists(sidecar_path)):
+            return None
+        with open(sidecar_path) as file:
+            return json.load(file)
+
+    def write_entry(self, key, entry):
+        write_atomic(self.paths(key)[1], lambda file: file.write(json.dumps(entry, default=canonical).encode()))
+
+    def contains(self, parameters, run_options):
+        """Whether the run with these parameters is cached"""
+        key = self.key(parameters, run_options)
+        return key is not None and self.read_entry(key) is not None
+
+    def get(self, run, run_options):
+        """
+        Return the cached result of a run (run id, iteration, parameters), or None when it is not cached. The result
+        gets the run id and iteration of the given run.
+        """
+        run_id, iteration, parameters = run
+        key = self.key(parameters, run_options)
+        entry = None if key is None else self.read_entry(key)
+        if entry is None:
+            return None
+        with open(self.paths(key)[0], 'rb') as file:
+            result = pickle.load(file)
+        result.run_id, result.iteration = run_id, iteration
+        entry['last_used'] = time.time()
+        self.write_entry(key, entry)
+        return result
+
+    def put(self, result, run_options):
+        """Store a finished run, and evict the least recently used runs when the cache is too large"""
+        key = self.key(result.parameters, run_options)
+        if key is None:
+            return
+        data = pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL)
+        # A run that is stored again replaces its old data
+        old_entry = self.read_entry(key)
+        write_atomic(self.paths(key)[0], lambda file: file.write(data))
+        # The sidecar is written last, a run is only cached once its sidecar exists
+        self.write_entry(key, {'key': key, 'size': len(data), 'sha256': hashlib.sha256(data).hexdigest(),
+                               'parameters': result.parameters, 'options': run_options,
+                               'created': time.time(), 'last_used': time.time()})
+        if self.max_size is not None:
+            if self.total_size is None:
+                self.total_size = self.size()
+            else:
+                self.total_size += len(data) - (old_entry['size'] if old_entry is not None else 0)
+            if self.total_size > self.max_size:
+                self.evict(self.max_size)
+                self.total_size = self.size()
+
+    def entries(self):
+        """The sidecars of all cached runs, least recently used first"""
+        entries = []
+        for sidecar_path in glob.glob(os.path.join(self.cache_dir, '*.json')):
+            entry = self.read_entry(os.path.splitext(os.path.basename(sidecar_path))[0])
+            if entry is not None:
+                entries.append(entry)
+        return sorted(entries, key=lambda entry: entry['last_used'])
+
+    def size(self):
+        """Total size of the cached runs in bytes"""
+        return sum(entry['size'] for entry in self.entries())
+
+    def remove(self, key):
+        for path in self.paths(key):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def evict(self, max_size=0):
+        """Remove the least recently used runs until the cache is at most max_size bytes, return the removed keys"""
+        entries = self.entries()
+        total = sum(entry['size'] for entry in entries)
+        removed = []
+        for entry in entries:
+            if total <= max_size:
+                break
+            self.remove(entry['key'])
+            total -= entry['size']
+            removed.append(entry['key'])
+        return removed
+
+    def verify(self, remove=False):
+        """Return the keys of the runs whose data does not match their checksum, optionally removing them"""
+        broken = []
+        for entry in self.entries():
+            with open(self.paths(entry['key'])[0], 'rb') as file:
+                if hashlib.sha256(file.read()).hexdigest() != entry['sha256']:
+                    broken.append(entry['key'])
+        if remove:
+            for key in broken:
+                self.remove(key)
+        return broken
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description='Manage the cache of finished experiment runs')
+    parser.add_argument('command', choices=['list', 'verify', 'evict'])
+    parser.add_argument('cache_dir')
+    parser.add_argument('--remove', action='store_true', help='verify: remove the runs that do not match')
+    parser.add_argument('--max-size', default='0', help='evict: size to shrink the cache to, e.g. 2G (default: 0)')
+    arguments = parser.parse_args(arguments)
+    cache = ResultCache(arguments.cache_dir)
+
+    if arguments.command == 'list':
+        for entry in cache.entries():
+            last_used = time.strftime('%Y-%m-%d %H:%M', time.localtime(entry['last_used']))
+            parameters = json.dumps(entry['parameters'], sort_keys=True, default=canonical)
+            print(f"{entry['key'][:16]}  {entry['size']:>12,d}  {last_used}  {parameters}")
+        print(f'{len(cache.entries())} runs, {cache.size():,d} bytes')
+    elif arguments.command == 'verify':
+        broken = cache.verify(remove=arguments.remove)
+        for key in broken:
+            print(f"{key} does not match its checksum{', removed' if arguments.remove else ''}")
+        print(f'{len(broken)} broken runs')
+    else:
+        removed = cache.evict(parse_size(arguments.max_size))
+        print(f'{len(removed)} runs evicted, {cache.size():,d} bytes left')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+"""
+Storage of experiment results as Parquet files, partitioned by parameter combination.
+
+Every finished run is written to its own file as soon as it arrives, so an experiment never holds more than one run in
+memory. The files are laid out as a hive-partitioned dataset, with a directory level per swept parameter:
+
+    output_dir/experiment.json                                         parameters and partitioning of the experiment
+    output_dir/model_vars/subsidies_package=2/run-000042.parquet        model reporters, a row per collected step
+    output_dir/agent_vars/subsidies_package=2/run-000042.parquet        agent reporters (only with collect_agents)
+    output_dir/profile/subsidies_package=2/run-000042.parquet           profile per step and phase (only with profile)
+
+Swept parameters whose values are not scalars (e.g. a list of income distributions) are partitioned by the index of
+the value in the list; experiment.json holds the values. read_results reads only the requested columns and partitions:
+
+    read_results('../output_data/policy', columns=['RunId', 'Step', 'TotalAdaptedHouseholds'],
+                 filters={'subsidies_package': 3})
+
+pyarrow is only imported when results are written or read.
+"""
+import json
+import os
+import shutil
+
+import numpy as np
+
+from flood_map_cache import write_atomic
+
+# Increase when the layout of the stored results changes
+STORE_VERSION = 1
+
+TABLES = ('model_vars', 'agent_vars', 'profile')
+
+
+def is_scalar(value):
+    return value is None or isinstance(value, (str, bool, int, float, np.integer, np.floating))
+
+
+def arrow_column(values):
+    """
+    Convert a column to a pyarrow array. Categorical values (strings) are dictionary encoded, and columns of Python
+    objects that arrow cannot store (e.g. a mix of dictionaries and strings) are stored as JSON strings.
+    """
+    import pyarrow as pa
+    values = np.asarray(values)
+    if values.dtype != object:
+        return pa.array(values)
+    try:
+        column = pa.array(values.tolist())
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        return pa.array([json.dumps(value, default=str) for value in values])
+    if pa.types.is_string(column.type):
+        return column.dictionary_encode()
+    return column
+
+
+class ParquetResultWriter:
+    """
+    Writes the RunResult of every run of an experiment to the partitioned dataset in output_dir.
+
+    Parameters
+    ----------
+    output_dir: directory of the dataset
+    swept: dictionary {parameter name: list of values} of the parameters that are swept, which become the partitions
+    fixed: dictionary {parameter name: value} of the other parameters
+    overwrite: replace the results of an earlier experiment in output_dir. Otherwise output_dir has to be empty or
+        not exist yet, so runs of an earlier sweep never end up in the results of this one
+    """
+
+    def __init__(self, output_dir, swept, fixed, overwrite=False):
+        self.output_dir = output_dir
+        self.swept = swept
+        self.fixed = fixed
+        self.number_of_runs = 0
+        if os.path.isdir(output_dir) and os.listdir(output_dir):
+            if not overwrite:
+                raise ValueError(f"The output directory {output_dir} is not empty. Use overwrite=True to replace the "
+                                 f"results in it")
+            for table in TABLES:
+                shutil.rmtree(os.path.join(output_dir, table), ignore_errors=True)
+        os.makedirs(output_dir, exist_ok=True)
+        self.write_metadata()
+
+    def partition_value(self, name, value):
+        """The value of a parameter as used in the directory name: the value itself, or its index in the sweep"""
+        if is_scalar(self.swept[name][0]):
+            return value
+        return next(index for index, swept_value in enumerate(self.swept[name]) if swept_value == value)
+
+    def partition_type(self, name):
+        """The arrow type of a partition column"""
+        if not is_scalar(self.swept[name][0]):
+            return 'int64'
+        values = np.asarray(self.swept[name])
+        if values.dtype.kind == 'b':
+            return 'bool'
+        if values.dtype.kind in 'iu':
+            return 'int64'
+        if values.dtype.kind == 'f':
+            return 'double'
+        return 'string'
+
+    def write_metadata(self):
+        metadata = {
+            'version': STORE_VERSION,
+            'partitions': {name: self.partition_type(name) for name in self.swept},
+            'swept': self.swept,
+            'fixed': self.fixed,
+        }
+        path = os.path.join(self.output_dir, 'experiment.json')
+        write_atomic(path, lambda file: file.write(json.dumps(metadata, indent=1, default=str).encode()))
+
+    def run_path(self, table, result):
+        """Path of the file of a run, in the directory of its parameter combination"""
+        directories = [f'{name}={self.partition_value(name, result.parameters[name])}' for name in self.swept]
+        return os.path.join(self.output_dir, table, *directories, f'run-{result.run_id:06d}.parquet')
+
+    def run_columns(self, result, length):
+        """RunId, iteration and the scalar parameters that are not partitions, repeated for every row"""
+        columns = {'RunId': np.full(length, result.run_id, dtype=np.int64),
+                   'iteration': np.full(length, result.iteration, dtype=np.int64)}
+        for name, value in result.parameters.items():
+            if name not in self.swept and is_scalar(value):
+                columns[name] = np.full(length, value)
+        return columns
+
+    def write_table(self, path, columns):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        table = pa.table({name: arrow_column(values) for name, values in columns.items()})
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Written atomically, so an interrupted experiment never leaves half a file in the dataset
+        write_atomic(path, lambda file: pq.write_table(table, file))
+
+    def write(self, result):
+        """Write a single run"""
+        columns = self.run_columns(result, len(result.steps))
+        columns['Step'] = result.steps
+        columns.update(result.model_columns)
+        self.write_table(self.run_path('model_vars', result), columns)
+
+        if result.agent_columns is not None:
+            number_of_agents = len(result.agent_ids)
+            columns = self.run_columns(result, len(result.steps) * number_of_agents)
+            columns['Step'] = np.repeat(result.steps, number_of_agents)
+            columns['AgentID'] = np.tile(result.agent_ids, len(result.steps))
+            for name, reporter in result.agent_reporters.items():
+                suffix = result.agent_columns[reporter.step_suffix] if reporter.step_suffix else None
+                columns[name] = reporter.decode(result.agent_columns[name], suffix).reshape(-1)
+            self.write_table(self.run_path('agent_vars', result), columns)
+
+        if result.profile is not None:
+            columns = self.run_columns(result, len(result.profile['Step']))
+            columns.update(result.profile)
+            self.write_table(self.run_path('profile', result), columns)
+        self.number_of_runs += 1
+
+
+def read_metadata(output_dir):
+    with open(os.path.join(output_dir, 'experiment.json')) as file:
+        return json.load(file)
+
+
+def read_results(output_dir, table='model_vars', columns=None, filters=None):
+    """
+    Read (part of) the stored results of an experiment.
+
+    Parameters
+    ----------
+    output_dir: directory of the dataset
+    table: 'model_vars', 'agent_vars' or 'profile'
+    columns: list of the columns to read, by default all columns
+    filters: dictionary {column: value or list of values}, e.g. {'subsidies_package': [0, 3]}. Filters on partition
+        columns only read the files of those partitions.
+
+    Returns
+    -------
+    df: DataFrame sorted by RunId and Step (and AgentID)
+    """
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    if table not in TABLES:
+        raise ValueError(f"Unknown table: '{table}'. The stored tables are: {list(TABLES)}")
+    metadata = read_metadata(output_dir)
+    partitioning = ds.partitioning(pa.schema([(name, pa.type_for_alias(arrow_type))
+                                              for name, arrow_type in metadata['partitions'].items()]),
+                                   flavor='hive')
+    dataset = ds.dataset(os.path.join(output_dir, table), format='parquet', partitioning=partitioning)
+
+    expression = None
+    for name, values in (filters or {}).items():
+        values = values if isinstance(values, (list, tuple)) else [values]
+        condition = ds.field(name).isin(values)
+        expression = condition if expression is None else expression & condition
+
+    sort_columns = [name for name in ('RunId', 'Step', 'AgentID') if name in dataset.schema.names]
+    read_columns = None if columns is None else list(dict.fromkeys(list(columns) + sort_columns))
+    df = dataset.to_table(columns=read_columns, filter=expression).to_pandas()
+    df = df.sort_values(sort_columns).reset_index(drop=True)
+    return df if columns is None else df[list(columns)]
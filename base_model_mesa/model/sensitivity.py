@@ -0,0 +1,389 @@
+# -*- coding: utf-8 -*-
+"""
+Global sensitivity analysis of the Flood Adaptation Model, with adaptive numbers of replicates.
+
+The one-at-a-time sensitivity analyses vary one parameter over a hand-written grid and run every value 100 times. This
+driver samples all factors (FACTORS) together with a space-filling design and runs every design point only as often as
+needed:
+- 'lhs': a Latin hypercube of number_of_points points, which have to be more than factors + 1. Sensitivity measured
+  by standardized regression coefficients.
+- 'sobol': the Saltelli design, number_of_points * (factors + 2) points from a scrambled Sobol sequence
+  (number_of_points should be a power of 2). First order and total Sobol indices (Saltelli 2010, Jansen) with
+  bootstrap confidence.
+- 'morris': number_of_points trajectories of factors + 1 points on a grid of levels. Elementary effects mu, mu_star
+  and sigma, on the unit scale of every factor.
+
+Every design point is run min_replicates times first. After every round, the points whose confidence interval of the
+mean of a target output (a flat reporter at the last step, e.g. 'EstimatedAverageIncomeToDamagePoorHousehold') is
+wider than the tolerance get more replicates, about as many as the interval needs, until max_replicates. Converged
+points are not run again, so most of the compute goes to the noisy parts of the parameter space. Replicate r of every
+design point uses the same seed, so differences between points are not masked by different random draws.
+
+The rounds run on the parallel experiment runner (see experiments.py), optionally with a ResultCache, so an analysis
+with a smaller tolerance only runs the extra replicates:
+
+    results = run_sensitivity_analysis('sobol', number_of_points=64, number_processes=32, seed=1,
+                                       base_parameters={'number_of_households': 1000, 'flood_map_choice': '100yr'})
+    results.indices()
+    print(results.number_of_runs, 'runs instead of', results.fixed_replicate_runs(100))
+"""
+import inspect
+import math
+import time
+import warnings
+
+import numpy as np
+import pandas as pd
+
+from model import AdaptationModel
+from experiments import iter_experiments, run_seed
+
+# The factors of the analysis, with their default range and whether they are integers. income_scale and surface_scale
+# multiply the mean of every income label in income_distribution and average_household_surfaces. The network factors
+# only matter for the networks that use them, e.g. number_of_edges only for the barabasi_albert network
+FACTORS = {
+    'income_scale': (0.7, 1.3, False),
+    'surface_scale': (0.7, 1.3, False),
+    'probability_of_network_connection': (0.0, 1.0, False),
+    'number_of_nearest_neighbours': (2, 10, True),
+    'number_of_edges': (1, 6, True),
+    'subsidies_package': (0, 3, True),
+}
+
+DESIGNS = ('lhs', 'sobol', 'morris')
+
+# Number of levels of the grid of the Morris trajectories
+MORRIS_LEVELS = 4
+
+
+def factor_ranges(factors=None):
+    """
+    The ranges of the factors of an analysis.
+
+    Parameters
+    ----------
+    factors: list of names in FACTORS, or dictionary {name: (lower, upper)} to change their ranges; all FACTORS by
+        default
+
+    Returns
+    -------
+    ranges: dictionary {name: (lower, upper, integer)}
+    """
+    if factors is None:
+        factors = list(FACTORS)
+    if not isinstance(factors, dict):
+        factors = {name: None for name in factors}
+    ranges = {}
+    for name, bounds in factors.items():
+        if name not in FACTORS:
+            raise ValueError(f"Unknown factor: '{name}'. Currently implemented factors are: {list(FACTORS.keys())}")
+        lower, upper, integer = FACTORS[name]
+        if bounds is not None:
+            lower, upper = bounds
+        ranges[name] = (lower, upper, integer)
+    return ranges
+
+
+def scale_values(unit_values, ranges):
+    """Map a design on the unit cube (points x factors) to the values of the factors, integers are uniform"""
+    values = {}
+    for column, (name, (lower, upper, integer)) in enumerate(ranges.items()):
+        if integer:
+            values[name] = np.minimum(lower + np.floor(unit_values[:, column] * (upper - lower + 1)), upper).astype(int)
+        else:
+            values[name] = lower + unit_values[:, column] * (upper - lower)
+    return pd.DataFrame(values)
+
+
+def scaled_means(distribution, scale):
+    """A distribution {label: [mean, standard deviation]} with every mean multiplied by scale"""
+    return {label: [mean * scale, standard_deviation] for label, (mean, standard_deviation) in distribution.items()}
+
+
+def model_parameters(factor_values, base_parameters):
+    """The AdaptationModel parameters of a design point: the base parameters with the values of the factors"""
+    defaults = inspect.signature(AdaptationModel).parameters
+    parameters = dict(base_parameters)
+    for name, value in factor_values.items():
+        value = value.item() if isinstance(value, np.generic) else value
+        if name == 'income_scale':
+            income_distribution = base_parameters.get('income_distribution', defaults['income_distribution'].default)
+            parameters['income_distribution'] = scaled_means(income_distribution, value)
+        elif name == 'surface_scale':
+            surfaces = base_parameters.get('average_household_surfaces',
+                                           defaults['average_household_surfaces'].default)
+            parameters['average_household_surfaces'] = scaled_means(surfaces, value)
+        else:
+            parameters[name] = value
+    return parameters
+
+
+def lhs_design(number_of_factors, number_of_points, rng):
+    """Latin hypercube on the unit cube"""
+    from scipy.stats import qmc
+    return qmc.LatinHypercube(d=number_of_factors, seed=rng).random(number_of_points)
+
+
+def sobol_design(number_of_factors, number_of_points, rng):
+    """
+    The Saltelli design on the unit cube: the matrices A and B of a scrambled Sobol sequence, followed by the
+    matrices AB_i, which are A with column i of B, for every factor i
+    """
+    from scipy.stats import qmc
+    with warnings.catch_warnings():
+        # run_sensitivity_analysis already warns when number_of_points is not a power of 2
+        warnings.simplefilter('ignore', UserWarning)
+        base = qmc.Sobol(d=2 * number_of_factors, scramble=True, seed=rng).random(number_of_points)
+    a, b = base[:, :number_of_factors], base[:, number_of_factors:]
+    blocks = [a, b]
+    for factor in range(number_of_factors):
+        ab = a.copy()
+        ab[:, factor] = b[:, factor]
+        blocks.append(ab)
+    return np.concatenate(blocks)
+
+
+def morris_design(number_of_factors, number_of_trajectories, rng, levels=MORRIS_LEVELS):
+    """
+    Morris trajectories on a grid of levels on the unit cube. Every trajectory starts at a random grid point and
+    changes one factor at a time, in random order, by delta = levels / (2 * (levels - 1)).
+    """
+    delta = levels / (2 * (levels - 1))
+    grid = np.arange(levels) / (levels - 1)
+    points = []
+    for _ in range(number_of_trajectories):
+        point = rng.choice(grid, size=number_of_factors)
+        points.append(point.copy())
+        for factor in rng.permutation(number_of_factors):
+            up = point[factor] + delta <= 1 + 1e-9
+            down = point[factor] - delta >= -1e-9
+            point[factor] += delta if up and (not down or rng.random() < 0.5) else -delta
+            points.append(point.copy())
+    return np.clip(np.array(points), 0, 1)
+
+
+def confidence_half_width(values, confidence):
+    """Half width of the t confidence interval of the mean of values, inf for fewer than two values"""
+    from scipy.stats import t
+    if len(values) < 2:
+        return math.inf
+    return t.ppf(0.5 + confidence / 2, len(values) - 1) * np.std(values, ddof=1) / math.sqrt(len(values))
+
+
+class SensitivityResults:
+    """
+    The results of a sensitivity analysis.
+
+    Attributes
+    ----------
+    design: 'lhs', 'sobol' or 'morris'
+    ranges: dictionary {factor: (lower, upper, integer)}
+    unit_design: the design on the unit cube, an array of shape (points, factors)
+    points: DataFrame with the values of the factors of every design point
+    values: dictionary {target: list with the outputs of the replicates of every design point}
+    number_of_runs: number of runs of the analysis
+    elapsed: wall time of the analysis in seconds
+    """
+
+    def __init__(self, design, ranges, unit_design, points, targets, values, confidence, number_of_runs, elapsed):
+        self.design = design
+        self.ranges = ranges
+        self.unit_design = unit_design
+        self.points = points
+        self.targets = targets
+        self.values = values
+        self.confidence = confidence
+        self.number_of_runs = number_of_runs
+        self.elapsed = elapsed
+
+    def fixed_replicate_runs(self, replicates):
+        """Number of runs that the design takes with a fixed number of replicates per point"""
+        return len(self.points) * replicates
+
+    def means(self, target=None):
+        """Mean output of every design point, without the replicates whose output is NaN"""
+        target = target or self.targets[0]
+        return np.array([np.mean(values) if values else np.nan for values in self.clean_values(target)])
+
+    def clean_values(self, target):
+        return [[value for value in values if not np.isnan(value)] for values in self.values[target]]
+
+    def outputs(self):
+        """DataFrame with the factor values of every design point and, per target, the mean, the half width of its
+        confidence interval and the number of replicates"""
+        df = self.points.copy()
+        for target in self.targets:
+            values = self.clean_values(target)
+            df[target] = self.means(target)
+            df[f'{target}HalfWidth'] = [confidence_half_width(point_values, self.confidence)
+                                        for point_values in values]
+            df[f'{target}Replicates'] = [len(point_values) for point_values in self.values[target]]
+        return df
+
+    def indices(self, target=None, bootstrap=200, seed=0):
+        """
+        The sensitivity indices of every factor for a target (by default the first one), see the module description
+
+        Returns
+        -------
+        indices: DataFrame with a row per factor
+        """
+        means = self.means(target)
+        if self.design == 'sobol':
+            return self.sobol_indices(means, bootstrap, np.random.default_rng(seed))
+        if self.design == 'morris':
+            return self.morris_indices(means)
+        return self.regression_coefficients(means)
+
+    def sobol_indices(self, means, bootstrap, rng):
+        from scipy.stats import norm
+        number_of_factors = len(self.ranges)
+        blocks = means.reshape(number_of_factors + 2, -1)
+        f_a, f_b, f_ab = blocks[0], blocks[1], blocks[2:]
+
+        def estimate(rows):
+            variance = np.var(np.concatenate([f_a[rows], f_b[rows]]))
+            first = np.mean(f_b[rows] * (f_ab[:, rows] - f_a[rows]), axis=1) / variance
+            total = 0.5 * np.mean((f_a[rows] - f_ab[:, rows]) ** 2, axis=1) / variance
+            return first, total
+
+        first, total = estimate(np.arange(len(f_a)))
+        samples = [estimate(rng.integers(len(f_a), size=len(f_a))) for _ in range(bootstrap)]
+        z = norm.ppf(0.5 + self.confidence / 2)
+        return pd.DataFrame({'S1': first, 'S1Confidence': z * np.std([sample[0] for sample in samples], axis=0),
+                             'ST': total, 'STConfidence': z * np.std([sample[1] for sample in samples], axis=0)},
+                            index=pd.Index(list(self.ranges), name='Factor'))
+
+    def morris_indices(self, means):
+        number_of_factors = len(self.ranges)
+        effects = [[] for _ in range(number_of_factors)]
+        for start in range(0, len(means), number_of_factors + 1):
+            trajectory = self.unit_design[start:start + number_of_factors + 1]
+            outputs = means[start:start + number_of_factors + 1]
+            for step in range(number_of_factors):
+                change = trajectory[step + 1] - trajectory[step]
+                factor = int(np.argmax(np.abs(change)))
+                effects[factor].append((outputs[step + 1] - outputs[step]) / change[factor])
+        effects = [np.array(factor_effects) for factor_effects in effects]
+        return pd.DataFrame({'mu': [np.nanmean(e) for e in effects],
+                             'mu_star': [np.nanmean(np.abs(e)) for e in effects],
+                             'sigma': [np.nanstd(e, ddof=1) for e in effects]},
+                            index=pd.Index(list(self.ranges), name='Factor'))
+
+    def regression_coefficients(self, means):
+        valid = ~np.isnan(means)
+        x = self.points[list(self.ranges)].to_numpy(dtype=float)[valid]
+        y = means[valid]
+        if len(y) <= len(self.ranges) + 1:
+            # With as many points as coefficients the fit is exact and the coefficients mean nothing
+            return pd.DataFrame({'SRC': np.nan, 'R2': np.nan}, index=pd.Index(list(self.ranges), name='Factor'))
+        spread = x.std(axis=0)
+        x = (x - x.mean(axis=0)) / np.where(spread > 0, spread, 1)
+        y = (y - y.mean()) / y.std()
+        coefficients, *_ = np.linalg.lstsq(np.column_stack([np.ones(len(x)), x]), y, rcond=None)
+        residuals = y - np.column_stack([np.ones(len(x)), x]) @ coefficients
+        return pd.DataFrame({'SRC': coefficients[1:], 'R2': 1 - np.mean(residuals ** 2)},
+                            index=pd.Index(list(self.ranges), name='Factor'))
+
+
+def additional_replicates(values, targets, replicates, confidence, tolerance, relative_tolerance, max_replicates):
+    """
+    The number of additional replicates of every design point. A point needs more replicates while the confidence
+    interval of the mean of a target is wider than tolerance, or than relative_tolerance times the mean. It gets about
+    as many as the current interval predicts, but at most as many as it has (the estimate is noisy) and at most
+    max_replicates in total.
+    """
+    from scipy.stats import t
+    additional = {}
+    for point, count in enumerate(replicates):
+        if count >= max_replicates:
+            continue
+        needed = count
+        for target in targets:
+            point_values = [value for value in values[target][point] if not np.isnan(value)]
+            half_width = confidence_half_width(point_values, confidence)
+            allowed = max(tolerance or 0, (relative_tolerance or 0) * abs(np.mean(point_values)) if point_values else 0)
+            if half_width <= allowed:
+                continue
+            if math.isinf(half_width) or allowed == 0:
+                needed = max(needed, 2 * count)
+            else:
+                spread = t.ppf(0.5 + confidence / 2, len(point_values) - 1) * np.std(point_values, ddof=1)
+                needed = max(needed, math.ceil((spread / allowed) ** 2))
+        if needed > count:
+            additional[point] = min(needed - count, count, max_replicates - count)
+    return additional
+
+
+def run_sensitivity_analysis(design='lhs', number_of_points=64, factors=None, base_parameters=None,
+                             target='EstimatedAverageIncomeToDamagePoorHousehold', tolerance=None,
+                             relative_tolerance=0.05, confidence=0.95, min_replicates=5, max_replicates=100,
+                             number_processes=1, seed=None, display_progress=True, cache=None, max_steps=None):
+    """
+    Run a global sensitivity analysis with adaptive numbers of replicates, see the module description.
+
+    Parameters
+    ----------
+    design: 'lhs', 'sobol' or 'morris'
+    number_of_points: number of points of the Latin hypercube, base points of the Saltelli design, or Morris
+        trajectories
+    factors: the factors and their ranges, see factor_ranges
+    base_parameters: the other AdaptationModel parameters, used at every design point. The reporters are always
+        collected with the flat reporter schema
+    target: flat model reporter (or list of reporters) at the last step whose mean has to converge at every point
+    tolerance: largest allowed half width of the confidence interval of the mean of the target
+    relative_tolerance: largest allowed half width relative to the mean of the target; a point has converged when
+        either tolerance is met
+    confidence: level of the confidence intervals
+    min_replicates, max_replicates: the number of replicates of every design point is between these
+    number_processes, display_progress, cache: see experiments.iter_experiments
+    seed: seed of the design and of the replicates, so the analysis can be repeated
+    max_steps: see experiments.run_model
+
+    Returns
+    -------
+    results: SensitivityResults
+    """
+    if design not in DESIGNS:
+        raise ValueError(f"Unknown design: '{design}'. Currently implemented designs are: {list(DESIGNS)}")
+    if tolerance is None and relative_tolerance is None:
+        raise ValueError("A sensitivity analysis needs a tolerance or a relative_tolerance")
+    targets = [target] if isinstance(target, str) else list(target)
+    min_replicates = max(min_replicates, 2)
+    if seed is None:
+        seed = np.random.SeedSequence().entropy
+    rng = np.random.default_rng(seed)
+    ranges = factor_ranges(factors)
+    if design == 'lhs' and number_of_points <= len(ranges) + 1:
+        raise ValueError(f"The regression of an 'lhs' design with {len(ranges)} factors needs more than "
+                         f"{len(ranges) + 1} points, not {number_of_points}")
+    if design == 'sobol' and number_of_points & (number_of_points - 1):
+        warnings.warn(f"The Sobol sequence is only balanced for a power of 2 base points, not {number_of_points}")
+    unit_design = {'lhs': lhs_design, 'sobol': sobol_design, 'morris': morris_design}[design](
+        len(ranges), number_of_points, rng)
+    points = scale_values(unit_design, ranges)
+    base_parameters = dict(base_parameters or {}, reporter_schema='flat')
+    parameters = [model_parameters(row, base_parameters) for row in points.to_dict('records')]
+
+    values = {target: [[] for _ in parameters] for target in targets}
+    replicates = np.zeros(len(parameters), dtype=int)
+    pending = {point: min_replicates for point in range(len(parameters))}
+    number_of_runs = 0
+    start = time.perf_counter()
+    while pending:
+        runs, run_points = [], {}
+        for point, count in pending.items():
+            for replicate in range(replicates[point], replicates[point] + count):
+                # Replicate r of every point has the same seed, see the module description
+                run_points[len(runs)] = point
+                runs.append((len(runs), replicate, dict(parameters[point], seed=run_seed(seed, replicate, {}))))
+            replicates[point] += count
+        for result in iter_experiments(runs, number_processes, display_progress=display_progress, cache=cache,
+                                       max_steps=max_steps):
+            for target in targets:
+                values[target][run_points[result.run_id]].append(float(result.model_columns[target][-1]))
+        number_of_runs += len(runs)
+        pending = additional_replicates(values, targets, replicates, confidence, tolerance, relative_tolerance,
+                                        max_replicates)
+    return SensitivityResults(design, ranges, unit_design, points, targets, values, confidence, number_of_runs,
+                              time.perf_counter() - start)
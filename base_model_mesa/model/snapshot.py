@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+"""
+Snapshots of the initialized population of a model, to run many policies on the same population.
+
+Creating an AdaptationModel draws the households (income label, income, house size, flood perception), places them on
+the map, looks up their flood depths and generates the network. None of this depends on the policy (the subsidies
+package), so a policy comparison can create the population once and fork a model per policy from it:
+
+    snapshot = PopulationSnapshot.from_model(AdaptationModel(seed=1, number_of_households=10000))
+    models = [snapshot.fork(subsidies_package=package) for package in range(4)]
+
+A forked model only assigns the adaptation measures of its policy. It also continues from the random state of the
+snapshot, so it runs exactly like a model that is created with the same parameters. A snapshot is compact (the
+network is stored as an array of edges) and can be saved to and loaded from a .npz file:
+
+    snapshot.save('../output_data/population.npz')
+    snapshot = PopulationSnapshot.load('../output_data/population.npz')
+
+The parameters that shape the population (POPULATION_PARAMETERS) are stored in the snapshot and cannot be changed
+when forking, the other parameters (subsidies_package, network_radius, reporter_schema, ...) can.
+"""
+import json
+
+import numpy as np
+
+from neighbour_index import NeighbourIndex
+from result_cache import canonical
+from vectorized import INCOME_LABELS
+
+# Increase when the layout of the snapshot files changes
+SNAPSHOT_VERSION = 3
+
+# The model parameters that the population depends on
+POPULATION_PARAMETERS = ('seed', 'number_of_households', 'number_of_steps', 'income_distribution',
+                         'average_household_surfaces', 'flood_map_choice', 'network',
+                         'probability_of_network_connection', 'number_of_edges', 'number_of_nearest_neighbours',
+                         'spatial_radius', 'network_backend', 'engine', 'common_random_numbers')
+
+# The drawn attributes of the households, with the dtype they are stored with
+POPULATION_ARRAYS = {
+    'income_label': np.int8,  # code in vectorized.INCOME_LABELS
+    'income': np.int64,
+    'housesize': np.int64,
+    'x': float,
+    'y': float,
+    'in_floodplain': bool,
+    'flood_depth_estimated': float,
+    'own_flood_perception': np.int8,
+}
+
+
+def random_states(model):
+    """The states of all random generators of a model, as JSON compatible values"""
+    states = {'random': list(model.random.getstate()), 'np_random': model.np_random.bit_generator.state}
+    if model.streams is not None:
+        states['streams'] = model.streams.get_state()
+    return states
+
+
+def set_random_states(model, states):
+    """Set the random generators of a model to the states given by random_states"""
+    version, internal_state, gauss_next = states['random']
+    model.random.setstate((version, tuple(internal_state), gauss_next))
+    model.np_random.bit_generator.state = states['np_random']
+    if model.streams is not None:
+        model.streams.set_state(states['streams'])
+
+
+class PopulationSnapshot:
+    """
+    The initialized population of a model: its households, network, flood step and random state.
+
+    Parameters
+    ----------
+    parameters: dictionary {parameter name: value} of the POPULATION_PARAMETERS of the model
+    flood_step: step in which the flood occurs
+    edges: array of shape (edges, 2) with the edges of the network between the nodes 0 ... number_of_households - 1
+    households: dictionary {attribute: array} with the POPULATION_ARRAYS of the households, ordered by node
+    random_states: the states of the random generators after the population was created, see random_states
+    """
+
+    def __init__(self, parameters, flood_step, edges, households, random_states):
+        self.parameters = parameters
+        self.flood_step = flood_step
+        self.edges = edges
+        self.households = households
+        self.random_states = random_states
+        # The neighbour indices per network radius, shared by the forked models since they are never changed
+        self.neighbour_indices = {}
+
+    @classmethod
+    def from_model(cls, model):
+        """Take the snapshot of a model that has been created but has not been stepped yet"""
+        if model.schedule.steps != 0:
+            raise ValueError(f"A population snapshot is taken before the first step, the model is at step "
+                             f"{model.schedule.steps}")
+        parameters = {name: getattr(model, name) for name in POPULATION_PARAMETERS}
+        edges = model.edges
+
+        if model.engine == 'vectorized':
+            households = {name: getattr(model.households, name).astype(dtype)
+                          for name, dtype in POPULATION_ARRAYS.items()}
+        else:
+            agents = model.schedule.agents
+            codes = {label: code for code, label in enumerate(INCOME_LABELS)}
+            households = {
+                'income_label': np.array([codes[agent.income_label] for agent in agents], dtype=np.int8),
+            }
+            for name, dtype in POPULATION_ARRAYS.items():
+                if name not in households:
+                    households[name] = np.array([getattr(agent, name) for agent in agents], dtype=dtype)
+        return cls(parameters, model.flood_step, edges, households, random_states(model))
+
+    def neighbour_index(self, radius):
+        """The NeighbourIndex of the network, built once per radius"""
+        if radius not in self.neighbour_indices:
+            self.neighbour_indices[radius] = NeighbourIndex.from_edges(self.parameters['number_of_households'],
+                                                                       self.edges, radius)
+        return self.neighbour_indices[radius]
+
+    def household_arrays(self):
+        """Copies of the household arrays, for a model that changes them"""
+        return {name: values.copy() for name, values in self.households.items()}
+
+    def households_kwargs(self):
+        """The arguments of every Households object of the agent engine, in the order of the nodes"""
+        households = self.households
+        for i in range(self.parameters['number_of_households']):
+            yield {'location': (households['x'][i].item(), households['y'][i].item()),
+                   'in_floodplain': bool(households['in_floodplain'][i]),
+                   'flood_depth_estimated': households['flood_depth_estimated'][i].item(),
+                   'income_label': INCOME_LABELS[households['income_label'][i]],
+                   'income': households['income'][i].item(),
+                   'housesize': households['housesize'][i].item(),
+                   'own_flood_perception': households['own_flood_perception'][i].item()}
+
+    def check_parameters(self, model):
+        """Raise a ValueError when the population parameters of a model differ from those of the snapshot"""
+        different = [name for name in POPULATION_PARAMETERS if getattr(model, name) != self.parameters[name]]
+        if different:
+            raise ValueError(f"The population snapshot was taken with other values of {different}. Use "
+                             f"PopulationSnapshot.fork to create a model with the parameters of the snapshot")
+
+    def fork(self, **parameters):
+        """
+        Create a new AdaptationModel with this population.
+
+        Parameters
+        ----------
+        parameters: the model parameters that are not POPULATION_PARAMETERS, e.g. subsidies_package
+
+        Returns
+        -------
+        model: AdaptationModel at step 0, which runs like a model created with the same parameters
+        """
+        from model import AdaptationModel
+
+        population_parameters = [name for name in parameters if name in POPULATION_PARAMETERS]
+        if population_parameters:
+            raise ValueError(f"The population parameters {population_parameters} are fixed by the snapshot")
+        return AdaptationModel(**self.parameters, **parameters, population=self)
+
+    def save(self, path):
+        """Save the snapshot as a compressed .npz file"""
+        metadata = {'version': SNAPSHOT_VERSION, 'parameters': self.parameters, 'flood_step': self.flood_step,
+                    'random_states': self.random_states}
+        np.savez_compressed(path, metadata=np.array(json.dumps(metadata, default=canonical)), edges=self.edges,
+                            **self.households)
+
+    @classmethod
+    def load(cls, path):
+        """Load a snapshot saved with save"""
+        with np.load(path, allow_pickle=False) as data:
+            metadata = json.loads(str(data['metadata']))
+            if metadata['version'] != SNAPSHOT_VERSION:
+                raise ValueError(f"The population snapshot {path} has version {metadata['version']}, this code reads "
+                                 f"version {SNAPSHOT_VERSION}")
+            households = {name: data[name] for name in POPULATION_ARRAYS}
+            edges = data['edges']
+        return cls(metadata['parameters'], metadata['flood_step'], edges, households, metadata['random_states'])
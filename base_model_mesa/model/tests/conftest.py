@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the Flood Adaptation Model.
+
+The model modules are imported from the model directory and read their inputs with paths relative to it, so the tests
+run there. They use the small synthetic flood map, model domain and floodplain in input_data/synthetic (see
+benchmark.py), so they do not need the real inputs. Run them with: python -m pytest base_model_mesa/model/tests
+"""
+import os
+import sys
+
+import pandas as pd
+import pytest
+
+MODEL_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, MODEL_DIRECTORY)
+
+from model import AdaptationModel  # noqa: E402
+
+# A model that is quick to create and run
+SMALL_MODEL = {'number_of_households': 150, 'number_of_steps': 40, 'flood_map_choice': 'synthetic', 'seed': 7}
+
+ENGINES = ('agents', 'vectorized')
+
+# Recurring flood events that happen often enough to hit a short run several times
+FLOOD_EVENTS = {'rate': 0.1, 'variability': 0.4, 'correlation_length': 3000}
+
+
+@pytest.fixture(scope='session', autouse=True)
+def model_directory():
+    """Run in the model directory, also for the fixtures with a larger scope"""
+    directory = os.getcwd()
+    os.chdir(MODEL_DIRECTORY)
+    yield
+    os.chdir(directory)
+
+
+@pytest.fixture
+def make_model():
+    """Create an AdaptationModel with the parameters of SMALL_MODEL, of which any can be changed"""
+    def make(**parameters):
+        return AdaptationModel(**dict(SMALL_MODEL, **parameters))
+    return make
+
+
+def assert_same_run(model, other):
+    """Assert that two models collected exactly the same data"""
+    pd.testing.assert_frame_equal(model.datacollector.get_model_vars_dataframe(),
+                                  other.datacollector.get_model_vars_dataframe(), check_exact=True)
+    pd.testing.assert_frame_equal(model.datacollector.get_agent_vars_dataframe(),
+                                  other.datacollector.get_agent_vars_dataframe(), check_exact=True)
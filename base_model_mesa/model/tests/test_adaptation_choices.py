@@ -0,0 +1,25 @@
+import numpy as np
+import pytest
+
+from conftest import ENGINES
+
+
+@pytest.mark.parametrize('engine', ENGINES)
+def test_memoized_adaptation_choices_are_up_to_date(make_model, engine):
+    model = make_model(engine=engine)
+    model.model_run()
+    households = model.schedule.agents
+    if engine == 'vectorized':
+        memoized = model.households.measure_by_perception.copy()
+        model.households.update_adaptation_margins()
+        np.testing.assert_array_equal(model.households.measure_by_perception, memoized)
+        return
+    for household in households:
+        memoized = household.adaptation_choices()
+        household._adaptation_choices = None
+        assert household.adaptation_choices() == memoized
+    # Writing an input of the choices clears them
+    household = households[0]
+    household.adaptation_choices()
+    household.housesize = household.housesize + 100
+    assert household._adaptation_choices is None
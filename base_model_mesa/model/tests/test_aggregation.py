@@ -0,0 +1,59 @@
+import math
+
+import numpy as np
+import pytest
+
+from aggregation import IncomeLabelTotals, METRICS, exact_sums
+from conftest import ENGINES, FLOOD_EVENTS
+
+
+def assert_totals_counted(model):
+    """The running totals of the model equal the totals counted again, and the exact sums of the households"""
+    counted = IncomeLabelTotals.from_model(model)
+    assert model.income_label_totals.sums == counted.sums
+    for metric, attribute in METRICS.items():
+        for label, code in counted.codes.items():
+            households = [household for household in model.schedule.agents if household.income_label == label]
+            expected = math.fsum(getattr(household, attribute) for household in households) if attribute \
+                else len(households)
+            assert model.income_label_totals.totals[metric][code] == expected, (metric, label)
+
+
+@pytest.mark.parametrize('engine', ENGINES)
+def test_totals_follow_the_run(make_model, engine):
+    model = make_model(engine=engine, flood_events=FLOOD_EVENTS)
+    model.model_run()
+    assert_totals_counted(model)
+
+
+@pytest.mark.parametrize('engine', ENGINES)
+def test_attribute_writes_update_totals(make_model, engine):
+    model = make_model(engine=engine)
+    for _ in range(3):
+        model.step()
+    for household in model.schedule.agents[:50]:
+        household.flood_damage_estimated = 1000.0
+        household.flood_damage_actual = 3.0
+        household.is_adapted = True
+        household.cost_of_adaptation = 7.0
+        household.subsidies_received = 2.0
+    for household in model.schedule.agents[50:60]:
+        household.income_label = 'Rich'
+        household.income = 12345
+    assert_totals_counted(model)
+    expected_damage = math.fsum(household.flood_damage_estimated for household in model.schedule.agents)
+    assert model.total_expected_damage() == expected_damage
+
+
+def test_replacing_values_does_not_drift():
+    rng = np.random.default_rng(1)
+    labels = rng.integers(0, 3, size=1000)
+    values = rng.lognormal(0, 3, size=1000)
+    totals = IncomeLabelTotals()
+    totals.add_arrays(labels, damage_actual=values)
+    for _ in range(200):
+        new_values = rng.lognormal(0, 3, size=1000)
+        totals.replace_arrays(labels, 'damage_actual', values, new_values)
+        values = new_values
+    assert totals.sums['damage_actual'] == exact_sums(labels, values)
+    assert totals.total('damage_actual') == math.fsum(values)
@@ -0,0 +1,58 @@
+import os
+
+import numpy as np
+import pytest
+
+from checkpoint import load_checkpoint, read_checkpoint_file, read_checkpoint_metadata, run_with_checkpoints
+from checkpoint import save_checkpoint
+from conftest import ENGINES, FLOOD_EVENTS, assert_same_run
+
+
+@pytest.mark.parametrize('flood_events', [None, FLOOD_EVENTS], ids=['single_flood', 'flood_events'])
+@pytest.mark.parametrize('engine', ENGINES)
+def test_restored_model_continues_identically(make_model, tmp_path, engine, flood_events):
+    model = make_model(engine=engine, flood_events=flood_events, number_of_steps=30)
+    # Without flood events the model stops at the flood, the checkpoint is saved before it
+    steps = 8 if flood_events is not None else min(8, model.flood_step - 1)
+    for _ in range(steps):
+        model.step()
+    path = tmp_path / 'checkpoint.npz'
+    save_checkpoint(model, path)
+    model.model_run()
+
+    restored = load_checkpoint(path)
+    restored.model_run()
+    assert restored.schedule.steps == model.schedule.steps
+    assert_same_run(model, restored)
+    if flood_events is not None:
+        assert len(model.flood_ensemble.history) > 0
+        np.testing.assert_array_equal(model.flood_ensemble.history.damage_matrix(),
+                                      restored.flood_ensemble.history.damage_matrix())
+
+
+@pytest.mark.parametrize('engine', ENGINES)
+def test_resumed_checkpoint_directory(make_model, tmp_path, engine):
+    model = make_model(engine=engine, flood_events=FLOOD_EVENTS, number_of_steps=30)
+    model.model_run()
+
+    interrupted = make_model(engine=engine, flood_events=FLOOD_EVENTS, number_of_steps=30)
+    run_with_checkpoints(interrupted, tmp_path, every=4, max_steps=13)
+    resumed = run_with_checkpoints(load_checkpoint(tmp_path), tmp_path, every=4)
+    assert_same_run(model, resumed)
+    assert_same_run(model, load_checkpoint(tmp_path))
+    # Checkpoints at steps 4, 8, 12 and 13, and after resuming at 16, 20, 24, 28 and 30, each with only the new rows
+    segments = read_checkpoint_metadata(tmp_path / 'checkpoint.npz')['segments']
+    assert sorted(name for name in os.listdir(tmp_path) if name.startswith('rows-')) == segments
+    first_rows = [int(segment[len('rows-'):-len('.npz')]) for segment in segments]
+    assert first_rows == [0, 4, 8, 12, 13, 16, 20, 24, 28]
+    rows = [len(read_checkpoint_file(tmp_path / segment)[0]['collector/steps']) for segment in segments]
+    assert np.cumsum(rows).tolist() == first_rows[1:] + [model.datacollector.number_of_rows]
+
+
+def test_checkpoint_directory_of_another_run_is_replaced(make_model, tmp_path):
+    run_with_checkpoints(make_model(number_of_steps=30), tmp_path, every=4)
+    other = run_with_checkpoints(make_model(number_of_steps=30, seed=8), tmp_path, every=4, max_steps=6)
+    segments = read_checkpoint_metadata(tmp_path / 'checkpoint.npz')['segments']
+    assert segments == ['rows-000000.npz', 'rows-000004.npz']
+    assert sorted(name for name in os.listdir(tmp_path) if name.startswith('rows-')) == segments
+    assert_same_run(other, load_checkpoint(tmp_path))
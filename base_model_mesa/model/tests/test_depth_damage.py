@@ -0,0 +1,15 @@
+import numpy as np
+
+from depth_damage import load_depth_damage_function
+from functions import calculate_basic_flood_damage
+
+# Depths around the ends of the logarithmic curve and in between
+DEPTHS = [0, 0.01, 0.0249, 0.025, 0.1, 0.5, 1, 2.345, 5.999, 6, 7.5]
+
+
+def test_default_function_is_unchanged():
+    depth_damage = load_depth_damage_function('logarithmic')
+    for depth in DEPTHS:
+        assert depth_damage.scalar_damage(depth, 150) == calculate_basic_flood_damage(depth, 150)
+    expected = [calculate_basic_flood_damage(depth, 150) for depth in DEPTHS]
+    np.testing.assert_allclose(depth_damage.damage(np.array(DEPTHS), 150), expected, rtol=1e-15)
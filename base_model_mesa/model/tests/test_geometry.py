@@ -0,0 +1,16 @@
+from shapely import contains_xy
+
+from functions import floodplain_path, geometry, shapefile_path
+from model import FLOOD_MAP_GEOMETRIES, flood_map_geometry
+
+
+def test_models_do_not_change_the_shared_geometries(make_model):
+    model = make_model()
+    assert geometry.paths == {'map_domain': shapefile_path, 'floodplain': floodplain_path}
+    assert tuple(model.geometry.paths.values()) == FLOOD_MAP_GEOMETRIES['synthetic']
+    flood_map_geometry('harvey')
+    assert tuple(model.geometry.paths.values()) == FLOOD_MAP_GEOMETRIES['synthetic']
+    # The geometries are loaded once and shared by the models
+    assert make_model().geometry.map_domain_polygon is model.geometry.map_domain_polygon
+    households = model.schedule.agents
+    assert contains_xy(model.geometry.map_domain_polygon, [h.x for h in households], [h.y for h in households]).all()
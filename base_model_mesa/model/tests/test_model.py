@@ -0,0 +1,43 @@
+import pytest
+
+from conftest import ENGINES, FLOOD_EVENTS, SMALL_MODEL, assert_same_run
+from experiments import run_experiments, run_model
+
+
+@pytest.mark.parametrize('engine', ENGINES)
+def test_model_run_runs_number_of_steps(make_model, engine):
+    model = make_model(engine=engine, flood_events=FLOOD_EVENTS, number_of_steps=30)
+    model.model_run()
+    assert model.schedule.steps == 30
+    assert model.datacollector.get_model_vars_dataframe().index.tolist() == list(range(30))
+    assert max(model.flood_ensemble.history.steps) < 30
+
+
+@pytest.mark.parametrize('flood_events', [None, FLOOD_EVENTS], ids=['single_flood', 'flood_events'])
+@pytest.mark.parametrize('engine', ENGINES)
+def test_skip_ahead_gives_the_same_run(make_model, engine, flood_events):
+    models = [make_model(engine=engine, flood_events=flood_events, skip_ahead=skip_ahead, number_of_steps=60)
+              for skip_ahead in (False, True)]
+    for model in models:
+        model.model_run()
+    assert_same_run(*models)
+
+
+@pytest.mark.parametrize('engine', ENGINES)
+def test_skip_ahead_with_batch_run_steps(engine):
+    """run_model runs up to and including step number_of_steps, like batch_run"""
+    parameters = dict(SMALL_MODEL, engine=engine, flood_events=FLOOD_EVENTS, number_of_steps=60, reporter_schema='flat')
+    results = [run_model((0, 0, dict(parameters, skip_ahead=skip_ahead)), data_collection_period=1)
+               for skip_ahead in (False, True)]
+    assert results[0].steps.tolist() == list(range(61))
+    for name, column in results[0].model_columns.items():
+        assert column.tolist() == results[1].model_columns[name].tolist(), name
+
+
+@pytest.mark.parametrize('reporter_schema', ['nested', 'flat'])
+def test_experiment_without_runs_has_the_reporter_columns(reporter_schema):
+    parameters = dict(SMALL_MODEL, reporter_schema=reporter_schema, flood_events=FLOOD_EVENTS, subsidies_package=[])
+    empty = run_experiments(parameters, display_progress=False).model_vars_dataframe()
+    results = run_experiments(dict(parameters, subsidies_package=[1]), display_progress=False).model_vars_dataframe()
+    assert len(empty) == 0
+    assert list(empty.columns) == list(results.columns)
@@ -0,0 +1,25 @@
+from collections import Counter
+
+import numpy as np
+import pytest
+
+NETWORKS = ['watts_strogatz', 'barabasi_albert', 'erdos_renyi', 'spatial']
+
+
+@pytest.mark.parametrize('radius', [1, 2])
+@pytest.mark.parametrize('network', NETWORKS)
+def test_friends_in_the_order_of_the_grid(make_model, network, radius):
+    model = make_model(network=network, network_radius=radius)
+    for household in model.schedule.agents:
+        friends = model.neighbour_index.friends(household.pos).tolist()
+        assert friends == model.grid.get_neighborhood(household.pos, radius=radius)
+
+
+@pytest.mark.parametrize('network_backend', ['networkx', 'native'])
+def test_most_common_perception_breaks_ties_like_counter(make_model, network_backend):
+    model = make_model(network_backend=network_backend)
+    perceptions = np.random.default_rng(1).integers(1, 5, size=model.number_of_households)
+    network_perception = model.neighbour_index.most_common_perception(perceptions)
+    for household in range(model.number_of_households):
+        counts = Counter(perceptions[model.grid.get_neighborhood(household)].tolist())
+        assert network_perception[household] == counts.most_common(1)[0][0]
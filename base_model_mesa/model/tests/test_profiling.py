@@ -0,0 +1,29 @@
+import tracemalloc
+
+import pytest
+
+from conftest import ENGINES
+from experiments import run_model
+
+
+@pytest.mark.parametrize('engine', ENGINES)
+def test_profiling_does_not_change_the_run(make_model, engine):
+    plain, profiled = make_model(engine=engine), make_model(engine=engine, profile=True)
+    plain.model_run()
+    profiled.model_run()
+    assert plain.datacollector.get_model_vars_dataframe().equals(profiled.datacollector.get_model_vars_dataframe())
+    assert profiled.profiler.dataframe()['Calls'].sum() > 0
+
+
+def test_memory_profiling_stops_tracemalloc(make_model):
+    assert not tracemalloc.is_tracing()
+    model = make_model(profile_memory=True)
+    assert tracemalloc.is_tracing()
+    model.model_run()
+    assert not tracemalloc.is_tracing()
+    assert model.profiler.dataframe()['MemoryPeak'].max() > 0
+
+    result = run_model((0, 0, {'number_of_households': 50, 'flood_map_choice': 'synthetic', 'seed': 1}),
+                       profile_memory=True)
+    assert not tracemalloc.is_tracing()
+    assert result.profile['MemoryPeak'].max() > 0
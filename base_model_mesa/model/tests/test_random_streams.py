@@ -0,0 +1,36 @@
+import numpy as np
+import pytest
+
+from conftest import ENGINES, FLOOD_EVENTS
+
+
+def population(model):
+    """The drawn attributes of the households of a model, which do not depend on the policy"""
+    households = model.schedule.agents
+    return {name: np.array([getattr(household, name) for household in households])
+            for name in ('income_label', 'income', 'housesize', 'x', 'y', 'flood_depth_estimated',
+                         'own_flood_perception')}
+
+
+@pytest.mark.parametrize('engine', ENGINES)
+def test_policies_share_the_population(make_model, engine):
+    models = [make_model(engine=engine, common_random_numbers=True, subsidies_package=package,
+                         flood_events=FLOOD_EVENTS) for package in range(4)]
+    first = models[0]
+    for model in models[1:]:
+        assert model.flood_step == first.flood_step
+        np.testing.assert_array_equal(model.edges, first.edges)
+        for name, values in population(first).items():
+            np.testing.assert_array_equal(population(model)[name], values, err_msg=name)
+
+    # The flood events do not depend on the adaptation of the households either
+    for model in models:
+        model.model_run()
+    for model in models[1:]:
+        assert model.flood_ensemble.history.steps == first.flood_ensemble.history.steps
+        assert model.flood_ensemble.history.intensities == first.flood_ensemble.history.intensities
+
+
+def test_other_seeds_draw_other_populations(make_model):
+    first, second = (make_model(common_random_numbers=True, seed=seed) for seed in (1, 2))
+    assert not np.array_equal(population(first)['income'], population(second)['income'])
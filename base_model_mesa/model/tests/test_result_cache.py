@@ -0,0 +1,26 @@
+import pytest
+
+from conftest import SMALL_MODEL
+from experiments import run_model
+from result_cache import ResultCache, canonical, imported_modules, RUN_MODULE
+
+
+def test_code_version_covers_only_the_modules_of_a_run():
+    modules = imported_modules(RUN_MODULE, '.')
+    assert {'model', 'agents', 'vectorized', 'functions', 'flood_events'} <= set(modules)
+    assert not {'benchmark', 'sensitivity'} & set(modules)
+
+
+def test_parameters_without_canonical_representation_raise(tmp_path):
+    with pytest.raises(TypeError):
+        canonical(object())
+    with pytest.raises(TypeError):
+        ResultCache(tmp_path).key(dict(SMALL_MODEL, income_distribution=object()), {})
+
+
+def test_storing_a_run_again_keeps_the_total_size(tmp_path):
+    cache = ResultCache(tmp_path, max_size='1G')
+    result = run_model((0, 0, dict(SMALL_MODEL, number_of_steps=5)))
+    for _ in range(3):
+        cache.put(result, {})
+    assert cache.total_size == cache.size() == cache.entries()[0]['size']
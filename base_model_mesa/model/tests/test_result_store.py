@@ -0,0 +1,24 @@
+import pytest
+
+from experiments import write_experiments
+from result_store import read_results
+
+pytest.importorskip('pyarrow')
+
+PARAMETERS = {'number_of_households': 50, 'flood_map_choice': 'synthetic', 'number_of_steps': 10,
+              'reporter_schema': 'flat'}
+
+
+def test_earlier_results_are_not_mixed_in(tmp_path):
+    write_experiments(dict(PARAMETERS, subsidies_package=[0, 1, 2]), tmp_path, iterations=2, seed=1,
+                      display_progress=False)
+    assert read_results(tmp_path)['RunId'].nunique() == 6
+
+    with pytest.raises(ValueError):
+        write_experiments(dict(PARAMETERS, subsidies_package=[0, 1]), tmp_path, seed=1, display_progress=False)
+
+    write_experiments(dict(PARAMETERS, subsidies_package=[0, 1]), tmp_path, seed=1, display_progress=False,
+                      overwrite=True)
+    results = read_results(tmp_path)
+    assert results['RunId'].nunique() == 2
+    assert sorted(results['subsidies_package'].unique()) == [0, 1]
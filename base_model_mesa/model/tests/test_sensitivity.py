@@ -0,0 +1,27 @@
+import numpy as np
+import pytest
+
+from sensitivity import run_sensitivity_analysis
+
+BASE_PARAMETERS = {'number_of_households': 30, 'number_of_steps': 8, 'flood_map_choice': 'synthetic'}
+
+
+def test_lhs_needs_more_points_than_coefficients():
+    with pytest.raises(ValueError):
+        run_sensitivity_analysis('lhs', number_of_points=4, display_progress=False)
+
+
+def test_lhs_regression():
+    results = run_sensitivity_analysis('lhs', number_of_points=12, factors=['income_scale', 'subsidies_package'],
+                                       base_parameters=BASE_PARAMETERS, min_replicates=2, max_replicates=2, seed=1,
+                                       display_progress=False)
+    indices = results.indices()
+    assert list(indices.index) == ['income_scale', 'subsidies_package']
+    assert np.all(np.isfinite(indices['SRC']))
+    assert 0 <= indices['R2'].iloc[0] < 1
+
+
+def test_sobol_warns_without_power_of_2():
+    with pytest.warns(UserWarning, match='power of 2'):
+        run_sensitivity_analysis('sobol', number_of_points=3, factors=['income_scale'], base_parameters=BASE_PARAMETERS,
+                                 min_replicates=2, max_replicates=2, seed=1, display_progress=False)
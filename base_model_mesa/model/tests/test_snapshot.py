@@ -0,0 +1,26 @@
+import pytest
+
+from conftest import ENGINES, FLOOD_EVENTS, assert_same_run
+from snapshot import PopulationSnapshot
+
+
+@pytest.mark.parametrize('flood_events', [None, FLOOD_EVENTS], ids=['single_flood', 'flood_events'])
+@pytest.mark.parametrize('engine', ENGINES)
+def test_fork_runs_like_a_fresh_model(make_model, tmp_path, engine, flood_events):
+    snapshot = PopulationSnapshot.from_model(make_model(engine=engine, subsidies_package=0))
+    path = tmp_path / 'population.npz'
+    snapshot.save(path)
+    forks = [snapshot.fork(subsidies_package=2, flood_events=flood_events),
+             PopulationSnapshot.load(path).fork(subsidies_package=2, flood_events=flood_events)]
+
+    fresh = make_model(engine=engine, subsidies_package=2, flood_events=flood_events)
+    fresh.model_run()
+    for fork in forks:
+        fork.model_run()
+        assert_same_run(fresh, fork)
+
+
+def test_fork_rejects_population_parameters(make_model):
+    snapshot = PopulationSnapshot.from_model(make_model())
+    with pytest.raises(ValueError):
+        snapshot.fork(number_of_households=10)
@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+
+from conftest import ENGINES, SMALL_MODEL
+from model import AdaptationModel
+
+# Reporters at the end of a run (after the flood) that both engines should give the same mean of
+REPORTERS = ['TotalAdaptedHouseholds', 'TotalExpectedDamage', 'TotalActualDamage', 'TotalAdaptationCosts']
+NUMBER_OF_SEEDS = 30
+
+
+@pytest.fixture(scope='module')
+def engine_runs():
+    """The final reporters and the initial households of NUMBER_OF_SEEDS seeded runs per engine"""
+    runs = {}
+    for engine in ENGINES:
+        reporters, households = [], []
+        for seed in range(NUMBER_OF_SEEDS):
+            model = AdaptationModel(**dict(SMALL_MODEL, seed=seed, engine=engine, reporter_schema='flat'))
+            households.extend((agent.income_label, agent.income, agent.own_flood_perception)
+                              for agent in model.schedule.agents)
+            model.model_run()
+            reporters.append(model.datacollector.get_model_vars_dataframe()[REPORTERS].iloc[-1].to_numpy(float))
+        runs[engine] = np.array(reporters), households
+    return runs
+
+
+def test_engines_give_the_same_statistics(engine_runs):
+    agents, vectorized = engine_runs['agents'][0], engine_runs['vectorized'][0]
+    standard_error = np.sqrt(agents.var(axis=0, ddof=1) / len(agents)
+                             + vectorized.var(axis=0, ddof=1) / len(vectorized))
+    z = (agents.mean(axis=0) - vectorized.mean(axis=0)) / standard_error
+    assert np.all(np.abs(z) < 4), dict(zip(REPORTERS, z))
+
+
+def test_engines_draw_the_same_population(engine_runs):
+    def shares(households, column):
+        values = [household[column] for household in households]
+        return {value: values.count(value) / len(values) for value in set(values)}
+
+    agents, vectorized = engine_runs['agents'][1], engine_runs['vectorized'][1]
+    for column in (0, 2):
+        agent_shares, vectorized_shares = shares(agents, column), shares(vectorized, column)
+        assert agent_shares.keys() == vectorized_shares.keys()
+        for value, share in agent_shares.items():
+            assert vectorized_shares[value] == pytest.approx(share, abs=0.03)
+    mean_income = np.mean([household[1] for household in agents])
+    assert np.mean([household[1] for household in vectorized]) == pytest.approx(mean_income, rel=0.05)
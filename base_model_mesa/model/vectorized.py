@@ -0,0 +1,402 @@
+# -*- coding: utf-8 -*-
+"""
+Vectorized household engine for the Flood Adaptation Model.
+
+Instead of one Households object per agent, the household state is stored in NumPy arrays (one array per attribute,
+one element per household) and every step runs as a handful of array operations for the whole population.
+The model uses this engine when it is created with engine='vectorized'. The Households objects in the schedule are then
+HouseholdView objects, thin views that read and write their own element of the arrays, so notebooks and the
+DataCollector can keep using the familiar attribute names.
+
+Differences with the agent engine, which give the same statistics but not the same individual runs:
+- Random draws come from the numpy generator of the model (model.np_random) instead of model.random.
+- The agent engine updates the flood perceptions one household after the other. Updating all households at once
+  would make neighbouring households swap perceptions back and forth every step, so the network is split into
+  colour classes (groups of households that are not friends of each other) and the classes are updated one after
+  the other. Within a class the update is simultaneous, which gives the same result as a sequential update.
+"""
+import numpy as np
+from mesa import Agent
+from shapely.geometry import Point
+
+from agents import Households, INCOME_LABELS, MEASURES
+from functions import get_flood_depths
+
+# Same distributions as in the Households class
+INCOME_LABEL_PROBABILITIES = np.array([25.68, 63.76, 10.55]) / 99.99
+PERCEPTION_PROBABILITIES_FLOODPLAIN = [0.15, 0.25, 0.3, 0.3]
+
+# Flood depth reduction (m) and cost per m2 of every measure, indexed with the measure codes of agents.MEASURES
+MEASURE_DEPTHS = np.array([0, 0.2, 0.7, 2.5])
+FULL_COSTS = np.array([0, 5, 30, 585])
+REDUCED_COSTS = np.array([0, 3, 20, 300])
+LOW_COSTS = np.array([0, 2, 15, 150])
+# Lowest own flood perception with which a household considers the measure
+MINIMUM_PERCEPTION = np.array([5, 2, 3, 3])
+# Number of own flood perceptions (1 ... 4), which index the measure chosen with a perception directly
+PERCEPTION_LEVELS = 5
+
+
+def draw_rounded_normal(rng, means, standard_deviations, minimum, inclusive=True):
+    """
+    Draw rounded values from a normal distribution per household, redrawing the values below the minimum.
+    This is the array version of the while loops in Households.calculate_income and Households.assign_housesize.
+
+    Parameters
+    ----------
+    rng: numpy random generator
+    means, standard_deviations: arrays with the distribution of every household
+    minimum: lowest accepted value
+    inclusive: whether the minimum itself is accepted
+
+    Returns
+    -------
+    values: array of accepted values
+    """
+    values = np.zeros(len(means), dtype=np.int64)
+    redraw = np.ones(len(means), dtype=bool)
+    while redraw.any():
+        values[redraw] = np.round(rng.normal(means[redraw], standard_deviations[redraw]))
+        redraw = values < minimum if inclusive else values <= minimum
+    return values
+
+
+class HouseholdArrays:
+    """
+    Struct-of-arrays storage of all households in the model, together with the batched versions of the household rules.
+    Element i of every array belongs to the household on node i of the network.
+    """
+
+    def __init__(self, model, population=None):
+        """
+        Parameters
+        ----------
+        model: the AdaptationModel
+        population: optional dictionary {attribute: array} with the drawn attributes of the households (see
+            snapshot.POPULATION_ARRAYS), used instead of drawing them when the model is restored from a snapshot
+        """
+        self.model = model
+        n = model.number_of_households
+        self.number_of_households = n
+
+        if population is None:
+            population = self.draw_population()
+        self.income_label = population['income_label'].astype(np.int8)
+        self.income = population['income'].astype(np.int64)
+        self.housesize = population['housesize'].astype(np.int64)
+        self.savings = np.zeros(n)
+
+        # Location on the map and whether the location is in the floodplain
+        self.x = population['x'].astype(float)
+        self.y = population['y'].astype(float)
+        self.in_floodplain = population['in_floodplain'].astype(bool)
+
+        # Estimated flood depth from the flood map, negative depths are set to 0
+        self.flood_depth_estimated = population['flood_depth_estimated'].astype(float)
+        self.flood_damage_estimated = model.depth_damage.damage(self.flood_depth_estimated, self.housesize)
+        self.flood_depth_actual = np.zeros(n)
+        self.flood_damage_actual = np.zeros(n)
+
+        # Initial flood perception, influenced by whether the household is in the floodplain
+        self.own_flood_perception = population['own_flood_perception'].astype(np.int8)
+        # 0 before the first step, -1 when the household has no friends (None in the agent engine)
+        self.network_flood_perception = np.zeros(n, dtype=np.int8)
+
+        # Adaptation state
+        self.adaptation_costs = self.assign_adaptation_measures()
+        self.is_adapted = np.zeros(n, dtype=bool)
+        self.going_to_adapt = np.zeros(n, dtype=bool)
+        self.optimal_measure = np.zeros(n, dtype=np.int8)
+        self.adaptation_step = np.full(n, -1, dtype=np.int32)
+        self.adaptation_depth = np.zeros(n)
+        self.cost_of_adaptation = np.zeros(n)
+        self.subsidies_received = np.zeros(n)
+
+        # The margin and cost of every measure, and the measure chosen with every own flood perception, which only
+        # change with the estimated flood depth, the house size and the adaptation costs
+        self.adaptation_margins = np.zeros((n, len(MEASURES)))
+        self.measure_costs = np.zeros((n, len(MEASURES)))
+        self.measure_by_perception = np.zeros((n, PERCEPTION_LEVELS), dtype=np.int8)
+        self.update_adaptation_margins()
+
+        # Groups of households that are not friends of each other, updated one after the other
+        colour = model.neighbour_index.greedy_colouring()
+        self.colour_classes = [np.flatnonzero(colour == c) for c in np.unique(colour)]
+
+    def draw_population(self):
+        """Draw the attributes of all households from the same distributions as the Households class"""
+        model = self.model
+        n = self.number_of_households
+        population = {}
+
+        # Income label, income and house size, which label_distribution looks up with self.income_label
+        self.income_label = model.numpy_stream('income_label').choice(
+            len(INCOME_LABELS), size=n, p=INCOME_LABEL_PROBABILITIES).astype(np.int8)
+        population['income_label'] = self.income_label
+        population['income'] = draw_rounded_normal(model.numpy_stream('income'),
+                                                   *self.label_distribution(model.income_distribution), minimum=0,
+                                                   inclusive=False)
+        population['housesize'] = draw_rounded_normal(model.numpy_stream('housesize'),
+                                                      *self.label_distribution(model.average_household_surfaces),
+                                                      minimum=30)
+
+        # Location on the map, whether the location is in the floodplain and the estimated flood depth there
+        x, y, in_floodplain = model.draw_household_locations()
+        flood_depth_estimated = get_flood_depths(model.flood_map, x, y, model.band_flood_img)
+        flood_depth_estimated[flood_depth_estimated < 0] = 0
+        population.update(x=x, y=y, in_floodplain=in_floodplain, flood_depth_estimated=flood_depth_estimated)
+
+        # Initial flood perception, influenced by whether the household is in the floodplain
+        rng = model.numpy_stream('perception')
+        own_flood_perception = rng.integers(1, 5, size=n).astype(np.int8)
+        own_flood_perception[in_floodplain] = rng.choice(
+            [1, 2, 3, 4], size=int(in_floodplain.sum()), p=PERCEPTION_PROBABILITIES_FLOODPLAIN)
+        population['own_flood_perception'] = own_flood_perception
+        return population
+
+    def label_distribution(self, distribution):
+        """Return the means and standard deviations of a distribution per income label, for every household"""
+        means = np.array([distribution[label][0] for label in INCOME_LABELS])
+        standard_deviations = np.array([distribution[label][1] for label in INCOME_LABELS])
+        return means[self.income_label], standard_deviations[self.income_label]
+
+    def assign_adaptation_measures(self):
+        """Return the cost per m2 of every measure for every household, depending on the subsidies package"""
+        n = self.number_of_households
+        package = self.model.subsidies_package
+        if package == 0:
+            costs = np.tile(FULL_COSTS, (n, 1))
+        elif package == 1:
+            costs = np.tile(REDUCED_COSTS, (n, 1))
+        elif package == 2:
+            # Poor households get the lowest costs, middle-class the reduced costs and rich households no subsidies
+            costs = np.stack([LOW_COSTS, REDUCED_COSTS, FULL_COSTS])[self.income_label]
+        elif package == 3:
+            # The deeper the estimated flood depth, the larger the subsidies
+            costs = np.tile(FULL_COSTS, (n, 1))
+            costs[(self.flood_depth_estimated > 1) & (self.flood_depth_estimated <= 2)] = REDUCED_COSTS
+            costs[self.flood_depth_estimated > 2] = LOW_COSTS
+        else:
+            raise ValueError(f"Unknown subsidies package: {package}. Currently implemented packages are 0, 1, 2 and 3")
+        return costs
+
+    def calculate_network_flood_perception(self, households):
+        """
+        Set the network flood perception of a group of households, which are not friends of each other, to the most
+        common own perception among their friends. Ties go to the perception that comes first among the friends.
+        """
+        self.network_flood_perception[households] = self.model.neighbour_index.most_common_perception(
+            self.own_flood_perception, households)
+
+    def change_own_flood_perception(self, households):
+        """Households adopt the perception of their network, if they have one"""
+        has_network = households[self.network_flood_perception[households] > 0]
+        self.own_flood_perception[has_network] = self.network_flood_perception[has_network]
+
+    def update_adaptation_margins(self, households=slice(None)):
+        """
+        Calculate the margins and costs of the measures of a group of households (all by default), and the measure
+        that they choose with every own flood perception. Called again whenever the estimated flood depth, the
+        house size or the adaptation costs of households change.
+        """
+        # Margin is the damage with the current estimated flood depth minus the damage with the adapted flood depth
+        margins = self.flood_damage_estimated[households, None] - self.model.depth_damage.damage(
+            self.flood_depth_estimated[households, None] - MEASURE_DEPTHS[1:], self.housesize[households, None])
+        self.adaptation_margins[households, 1:] = margins
+        self.measure_costs[households] = self.adaptation_costs[households] * self.housesize[households, None]
+        worthwhile = self.adaptation_margins[households] > self.measure_costs[households]
+        measure_by_perception = np.zeros((len(worthwhile), PERCEPTION_LEVELS), dtype=np.int8)
+        for measure in range(1, len(MEASURES)):
+            # Measures later in the order overrule earlier ones, as in the agent engine
+            considered = np.arange(PERCEPTION_LEVELS) >= MINIMUM_PERCEPTION[measure]
+            measure_by_perception[worthwhile[:, measure, None] & considered] = measure
+        self.measure_by_perception[households] = measure_by_perception
+
+    def decide_on_optimal_adaptation(self):
+        """Choose the optimal measure for every household that has not adapted yet, see Households for the rules"""
+        deciding = np.flatnonzero(~self.is_adapted)
+        # The measure follows from the own flood perception, without a measure the previous choice stays
+        measure = self.measure_by_perception[deciding, self.own_flood_perception[deciding]]
+        chosen = deciding[measure > 0]
+        self.optimal_measure[chosen] = measure[measure > 0]
+        self.going_to_adapt[chosen] = True
+
+    def save_income(self):
+        """Households that are going to adapt save a part of their income, depending on their perception"""
+        saving = self.going_to_adapt
+        self.savings[saving] += (self.own_flood_perception[saving] / 4) * 0.10 * self.income[saving]
+
+    def execute_adaptation(self):
+        """Execute the optimal measure for all households that have saved enough"""
+        cost_per_m2 = self.adaptation_costs[np.arange(self.number_of_households), self.optimal_measure]
+        adapting = ((self.optimal_measure > 0) & ~self.is_adapted & self.going_to_adapt
+                    & (self.savings / self.housesize >= cost_per_m2))
+        measure = self.optimal_measure[adapting]
+        housesize = self.housesize[adapting]
+        totals_before = (self.flood_damage_estimated[adapting], self.cost_of_adaptation[adapting],
+                         self.subsidies_received[adapting])
+
+        self.adaptation_depth[adapting] = MEASURE_DEPTHS[measure]
+        self.cost_of_adaptation[adapting] = cost_per_m2[adapting] * housesize
+        self.savings[adapting] -= self.cost_of_adaptation[adapting]
+        self.subsidies_received[adapting] = FULL_COSTS[measure] * housesize - self.cost_of_adaptation[adapting]
+        self.flood_depth_estimated[adapting] = np.maximum(
+            self.flood_depth_estimated[adapting] - self.adaptation_depth[adapting], 0)
+        self.flood_damage_estimated[adapting] = self.model.depth_damage.damage(
+            self.flood_depth_estimated[adapting], housesize)
+        self.update_adaptation_margins(adapting)
+        self.going_to_adapt[adapting] = False
+        self.adaptation_step[adapting] = self.model.schedule.steps
+        self.is_adapted[adapting] = True
+        # Replace the values in the totals per income label that the model reporters read
+        totals = self.model.income_label_totals
+        income_labels = self.income_label[adapting]
+        totals.add_arrays(income_labels, adapted=np.ones(len(measure)))
+        for metric, values, values_before in (('damage_estimated', self.flood_damage_estimated, totals_before[0]),
+                                              ('cost_of_adaptation', self.cost_of_adaptation, totals_before[1]),
+                                              ('subsidies_received', self.subsidies_received, totals_before[2])):
+            totals.replace_arrays(income_labels, metric, values_before, values[adapting])
+
+    def flood(self, depth_factors):
+        """Apply the flood: the actual flood depth is the estimated flood depth times a factor per household"""
+        self.apply_flood_depths(depth_factors * self.flood_depth_estimated)
+
+    def apply_flood_depths(self, flood_depths):
+        """Set the actual flood depths of all households and their damage, and return the damages"""
+        damage_before = self.flood_damage_actual
+        self.flood_depth_actual = flood_depths
+        self.flood_damage_actual = self.model.depth_damage.damage(self.flood_depth_actual, self.housesize)
+        self.model.income_label_totals.replace_arrays(self.income_label, 'damage_actual', damage_before,
+                                                      self.flood_damage_actual)
+        return self.flood_damage_actual
+
+    def step(self):
+        """One step of all households, in the same order as Households.step"""
+        # The perceptions are updated class after class, so every class sees the updates of the classes before it
+        phase = self.model.phase
+        for households in self.colour_classes:
+            with phase('network_perception'):
+                self.calculate_network_flood_perception(households)
+            with phase('own_perception'):
+                self.change_own_flood_perception(households)
+        with phase('decision'):
+            self.decide_on_optimal_adaptation()
+        with phase('saving'):
+            self.save_income()
+        with phase('adaptation'):
+            self.execute_adaptation()
+
+    def step_saving_households(self):
+        """
+        One step once the flood perceptions have settled (see AdaptationModel.households_settled): the perceptions and
+        decisions no longer change, so only the savings and adaptations of the households that are going to adapt do
+        """
+        self.save_income()
+        self.execute_adaptation()
+
+
+def _array_attribute(name, updates_margins=False, metric=None):
+    """
+    Property that reads and writes element self.index of the household array with the same name. With
+    updates_margins, writing it recalculates the adaptation margins of the household. With metric, the attribute is
+    summed in the totals per income label of the model (see aggregation.METRICS) and writing it adds the change.
+    """
+    def get_value(self):
+        return getattr(self.model.households, name)[self.index].item()
+
+    def set_value(self, value):
+        values = getattr(self.model.households, name)
+        value_before = values[self.index].item()
+        values[self.index] = value
+        if metric is not None:
+            self.model.income_label_totals.replace(self.income_label, metric, value_before, values[self.index].item())
+        if updates_margins:
+            self.model.households.update_adaptation_margins([self.index])
+
+    return property(get_value, set_value)
+
+
+class HouseholdView(Households):
+    """
+    A household of the vectorized engine. It holds no state of its own, every attribute of the Households class
+    is read from and written to the arrays in model.households.
+    """
+
+    __slots__ = ('index',)
+
+    def __init__(self, unique_id, model, index):
+        # The Households initialisation is skipped on purpose, the state already lives in the arrays
+        Agent.__init__(self, unique_id, model)
+        self.index = index
+
+    is_adapted = _array_attribute('is_adapted', metric='adapted')
+    going_to_adapt = _array_attribute('going_to_adapt')
+    income = _array_attribute('income', metric='income')
+    savings = _array_attribute('savings')
+    housesize = _array_attribute('housesize', updates_margins=True)
+    adaptation_depth = _array_attribute('adaptation_depth')
+    cost_of_adaptation = _array_attribute('cost_of_adaptation', metric='cost_of_adaptation')
+    subsidies_received = _array_attribute('subsidies_received', metric='subsidies_received')
+    in_floodplain = _array_attribute('in_floodplain')
+    flood_depth_estimated = _array_attribute('flood_depth_estimated', updates_margins=True)
+    flood_damage_estimated = _array_attribute('flood_damage_estimated', updates_margins=True,
+                                              metric='damage_estimated')
+    flood_depth_actual = _array_attribute('flood_depth_actual')
+    flood_damage_actual = _array_attribute('flood_damage_actual', metric='damage_actual')
+    own_flood_perception = _array_attribute('own_flood_perception')
+    adaptation_step = _array_attribute('adaptation_step')
+    x = _array_attribute('x')
+    y = _array_attribute('y')
+
+    @property
+    def income_label(self):
+        return INCOME_LABELS[self.model.households.income_label[self.index]]
+
+    @income_label.setter
+    def income_label(self, value):
+        self.model.income_label_totals.relabel(self, value)
+        self.model.households.income_label[self.index] = INCOME_LABELS.index(value)
+
+    @property
+    def optimal_measure(self):
+        """Chosen measure, with the step of adaptation appended once it is installed (e.g. 'Drains_12')"""
+        households = self.model.households
+        measure = MEASURES[households.optimal_measure[self.index]]
+        if households.is_adapted[self.index]:
+            return measure + '_' + str(households.adaptation_step[self.index])
+        return measure
+
+    @optimal_measure.setter
+    def optimal_measure(self, value):
+        self.model.households.optimal_measure[self.index] = MEASURES.index(value.split('_')[0])
+
+    @property
+    def network_flood_perception(self):
+        perception = self.model.households.network_flood_perception[self.index].item()
+        return None if perception == -1 else perception
+
+    @network_flood_perception.setter
+    def network_flood_perception(self, value):
+        self.model.households.network_flood_perception[self.index] = -1 if value is None else value
+
+    @property
+    def location(self):
+        """Location as a shapely Point, created on demand"""
+        return Point(self.model.households.x[self.index], self.model.households.y[self.index])
+
+    @property
+    def adaptation_measures(self):
+        """The measures available to this household as {measure: [depth reduction, cost per m2]}"""
+        costs = self.model.households.adaptation_costs[self.index]
+        return {MEASURES[m]: [MEASURE_DEPTHS[m].item(), costs[m].item()] for m in range(1, len(MEASURES))}
+
+    def adaptation_measure(self, measure):
+        code = MEASURES.index(measure)
+        return MEASURE_DEPTHS[code].item(), self.model.households.adaptation_costs[self.index, code].item()
+
+    @property
+    def network(self):
+        """The own flood perception of every friend as {unique_id: perception}"""
+        households = self.model.households
+        return {friend.item(): households.own_flood_perception[friend].item()
+                for friend in self.model.neighbour_index.friends(self.index)}